@@ -34,6 +34,40 @@ except ImportError:
     coverage = None
 
 
+def setup_fixtures(test):
+    """Create the objects the text files share: `author` is a user that
+    writes the posts of the tests (its id is `author_id`) and `make_post`
+    creates a post by that user.  The user is removed after the file ran,
+    together with the posts that are left.
+    """
+    from datetime import datetime
+    from zine.database import db
+    from zine.models import User, Post
+    author = User(u'test_author', None, u'author@example.com',
+                  is_author=True)
+    db.commit()
+    author_id = author.id
+
+    def make_post(title, slug, pub_date=datetime(2010, 1, 1), text=u'Text'):
+        # the session is removed at the end of requests, so the author is
+        # looked up again.
+        return Post(title, User.query.get(author_id), text, slug, pub_date)
+
+    test.globs.update(author=author, author_id=author_id,
+                      make_post=make_post)
+
+
+def teardown_fixtures(test):
+    """Remove the objects created by :func:`setup_fixtures`."""
+    from zine.database import db
+    from zine.models import User
+    db.rollback()
+    author = User.query.get(test.globs['author_id'])
+    if author is not None:
+        db.delete(author)
+        db.commit()
+
+
 def suite(modnames=[], return_covermods=False):
     """Generate the test suite.
 
@@ -87,7 +121,9 @@ def suite(modnames=[], return_covermods=False):
         if filename in test_files:
             globs = {'app': app}
             globs.update(mod.__dict__)
-            suites.append(DocFileSuite(filename, globs=globs))
+            suites.append(DocFileSuite(filename, globs=globs,
+                                       setUp=setup_fixtures,
+                                       tearDown=teardown_fixtures))
         for i, subsuite in enumerate(suites):
             # skip modules without any tests
             if subsuite.countTestCases():
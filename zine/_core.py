@@ -169,10 +169,12 @@ def get_wsgi_app(instance_folder):
 
 
 def override_environ_config(pool_size=None, pool_recycle=None,
-                            pool_timeout=None, behind_proxy=None):
+                            pool_timeout=None, behind_proxy=None,
+                            max_overflow=None):
     """Some configuration parameters are not stored in the zine.ini but
     in the os environment.  These are process wide configuration settings
-    used for different deployments.
+    used for different deployments.  The pool settings override the
+    ones from the zine.ini.
     """
     for key, value in locals().items():
         if value is not None:
@@ -13,6 +13,7 @@
 import sys
 from os import path, remove, makedirs, walk, environ
 from time import time
+from random import random
 from urlparse import urlparse
 from collections import deque
 from inspect import getdoc
@@ -26,7 +27,7 @@ from jinja2 import Environment, BaseLoader, TemplateNotFound
 from sqlalchemy.exceptions import SQLAlchemyError
 
 from werkzeug import Request as RequestBase, Response as ResponseBase, \
-     SharedDataMiddleware, url_quote, routing, redirect as _redirect, \
+     url_quote, routing, redirect as _redirect, \
      escape, cached_property, url_encode
 from werkzeug.exceptions import HTTPException, Forbidden, \
      NotFound
@@ -36,7 +37,8 @@ from zine import _core
 from zine.environment import SHARED_DATA, BUILTIN_TEMPLATE_PATH, \
      BUILTIN_PLUGIN_FOLDER
 from zine.database import db, cleanup_session
-from zine.cache import get_cache
+from zine.cache import get_cache, setup_invalidation, setup_warmup, \
+     PageCacheMiddleware, SharedDataMiddleware
 from zine.utils import ClosingIterator, local, local_manager, dump_json, \
      htmlhelpers
 from zine.utils.datastructures import ReadOnlyMultiMapping
@@ -64,6 +66,7 @@ DEFAULT_THEME_SETTINGS = {
     'archive.per_page':             None,
     'category.per_page':            None,
     'tag.per_page':                 None,
+    'search.per_page':              None,
 
     # datetime formatting settings
     'date.date_format.default':     'medium',
@@ -89,11 +92,13 @@ DEFAULT_THEME_SETTINGS = {
     'sql.archive.lazy':             frozenset(['comments']),
     'sql.category.lazy':            frozenset(['comments']),
     'sql.tag.lazy':                 frozenset(['comments']),
+    'sql.search.lazy':              frozenset(['comments']),
     'sql.index.deferred':           frozenset(),
     'sql.author.deferred':          frozenset(),
     'sql.archive.deferred':         frozenset(),
     'sql.category.deferred':        frozenset(),
-    'sql.tag.deferred':             frozenset()
+    'sql.tag.deferred':             frozenset(),
+    'sql.search.deferred':          frozenset()
 }
 
 
@@ -259,10 +264,17 @@ class Request(RequestBase):
 
     def __init__(self, environ, app=None):
         RequestBase.__init__(self, environ)
-        self.queries = []
         if app is None:
             app = get_application()
         self.app = app
+        self.endpoint = None
+
+        # the queries are collected in debug mode and for the requests
+        # sampled by the query profiler
+        self.queries = None
+        if app.cfg['database_debug'] or (app.cfg['database_profile'] and
+           random() * 100 < app.cfg['database_profile_sample_rate']):
+            self.queries = []
 
         engine = self.app.database_engine
 
@@ -694,12 +706,23 @@ class Zine(object):
             self.iid = '%x' % id(self)
 
         # connect to the database
+        database_debug = self.cfg['database_debug'] or \
+                         self.cfg['database_profile']
+        pool_options = db.get_pool_options(self.cfg)
         self.database_engine = db.create_engine(self.cfg['database_uri'],
                                                 self.instance_folder,
-                                                self.cfg['database_debug'])
+                                                database_debug, pool_options)
+        self.database_replicas = None
+        if self.cfg['database_replica_uris']:
+            self.database_replicas = db.ReplicaSet([db.create_engine(uri,
+                self.instance_folder, database_debug, pool_options)
+                for uri in self.cfg['database_replica_uris']],
+                self.cfg['database_replica_retry'])
 
         # now setup the cache system
         self.cache = get_cache(self)
+        setup_invalidation(self)
+        setup_warmup(self)
 
         # setup core package urls and shared stuff
         import zine
@@ -708,10 +731,13 @@ class Zine(object):
              admin_content_type_handlers, absolute_url_handlers
         from zine.services import all_services
         from zine.parsers import all_parsers
+        from zine.search import all_engines
         self.views = all_views.copy()
         self.content_type_handlers = content_type_handlers.copy()
         self.admin_content_type_handlers = admin_content_type_handlers.copy()
         self.parsers = dict((k, v(self)) for k, v in all_parsers.iteritems())
+        self.search_engines = dict((k, v(self)) for k, v
+                                   in all_engines.iteritems())
         self.markup_extensions = []
         self._url_rules = make_urls(self)
         self._absolute_url_handlers = absolute_url_handlers[:]
@@ -844,9 +870,15 @@ class Zine(object):
             self._template_tests
         self.template_env = env
 
+        # the page cache goes below the static file serving so that
+        # shared files never hit the cache
+        if self.cfg['enable_page_cache']:
+            self.add_middleware(PageCacheMiddleware, self)
+
         # now add the middleware for static file serving
         self.add_shared_exports('core', SHARED_DATA)
-        self.add_middleware(SharedDataMiddleware, self._shared_exports)
+        self.add_middleware(SharedDataMiddleware, self._shared_exports,
+                            path.join(self.instance_folder, 'shared_gz'))
 
         # set up the urls
         self.url_map = routing.Map(self._url_rules)
@@ -857,6 +889,11 @@ class Zine(object):
         self.url_adapter = self.url_map.bind(netloc, script_name,
                                              url_scheme=scheme)
 
+        # drop cached widgets if the data they show changes
+        for widget in self.widgets.itervalues():
+            for event in getattr(widget, 'invalidating_events', ()):
+                self.connect_event(event, widget.invalidate)
+
         # mark the app as finished and override the setup functions
         def _error(*args, **kwargs):
             raise RuntimeError('Cannot register new callbacks after '
@@ -866,6 +903,8 @@ class Zine(object):
         self.cfg.config_vars['default_parser'].choices = \
             self.cfg.config_vars['comment_parser'].choices = \
             self.list_parsers()
+        self.cfg.config_vars['search_engine'].choices = \
+            self.list_search_engines()
 
         # register Zine's upgrade repository
         from zine.upgrades import REPOSITORY_PATH
@@ -1199,6 +1238,13 @@ class Zine(object):
         """
         self.parsers[name] = class_(self)
 
+    @setuponly
+    def add_search_engine(self, name, class_):
+        """Add a new search engine class.  The engine has to be a subclass
+        of :class:`zine.search.SearchEngine`.
+        """
+        self.search_engines[name] = class_(self)
+
     @setuponly
     def add_markup_extension(self, extension):
         """Register a new markup extension."""
@@ -1259,6 +1305,14 @@ class Zine(object):
         return sorted([(key, unicode(parser.name)) for key, parser in
                        self.parsers.iteritems()], key=lambda x: x[1].lower())
 
+    def list_search_engines(self):
+        """Return a sorted list of the search engines that work with the
+        database (engine_id, engine_name).
+        """
+        return sorted([(key, unicode(engine.name)) for key, engine in
+                       self.search_engines.iteritems()
+                       if engine.is_available()], key=lambda x: x[1].lower())
+
     def list_privileges(self):
         """Return a sorted list of privileges."""
         # TODO: somehow add grouping...
@@ -1315,6 +1369,7 @@ class Zine(object):
         """
         for handler in self._absolute_url_handlers:
             try:
+                request.endpoint = handler.__name__
                 rv = handler(request)
                 if rv is not None:
                     return rv
@@ -1372,6 +1427,7 @@ class Zine(object):
         try:
             try:
                 endpoint, args = self.url_adapter.match(request.path)
+                request.endpoint = endpoint
                 response = self.views[endpoint](request, **args)
             except NotFound, e:
                 response = self.handle_not_found(request, e)
@@ -1397,6 +1453,11 @@ class Zine(object):
             from zine.utils.debug import inject_query_info
             inject_query_info(request, response)
 
+        if self.cfg['database_profile'] and request.queries is not None:
+            from zine.utils.debug import record_queries
+            record_queries(request.endpoint or '<unknown>', request.queries,
+                           self.cfg['database_profile_n_plus_one'])
+
         return response
 
     def dispatch_wsgi(self, environ, start_response):
@@ -1501,13 +1562,14 @@ class Zine(object):
         if hasattr(data, 'read'):
             input_stream = data
             data = None
+        query_string = url_encode(query or {})
 
         def make_request():
             try:
                 client = Client(self, response_wrapper)
                 response.append(client.open(path, self.cfg['blog_url'],
                                             method=method, data=data,
-                                            query_string=url_encode(query),
+                                            query_string=query_string,
                                             input_stream=input_stream))
             except:
                 response.append(sys.exc_info())
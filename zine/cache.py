@@ -11,11 +11,109 @@
     :license: BSD, see LICENSE for more details.
 """
 import os
+import mimetypes
+from time import time
+from datetime import datetime
+from random import randrange
+import threading
+from cPickle import dump, dumps, load, loads, HIGHEST_PROTOCOL
+from gzip import GzipFile
+from cStringIO import StringIO
+try:
+    import sqlite3
+except ImportError:
+    try:
+        from pysqlite2 import dbapi2 as sqlite3
+    except ImportError:
+        sqlite3 = None
+try:
+    from hashlib import md5
+except ImportError:
+    from md5 import new as md5
 
-from werkzeug.contrib.cache import NullCache, SimpleCache, FileSystemCache, \
-     MemcachedCache
+from werkzeug import Headers, wrap_file, http_date, url_encode, \
+     SharedDataMiddleware as _SharedDataMiddleware
+from werkzeug.http import is_resource_modified, quote_etag, unquote_etag, \
+     parse_accept_header
+from werkzeug.contrib.cache import BaseCache, NullCache, SimpleCache, \
+     MemcachedCache, FileSystemCache as _FileSystemCache
 
+from sqlalchemy.orm.attributes import get_history
+from sqlalchemy.orm.interfaces import SessionExtension
+
+from zine.database import session_extensions
 from zine.utils import local
+from zine.utils.datastructures import ThreadBuckets
+
+
+#: the key prefix of the generation counters of cache tags
+TAG_KEY_PREFIX = 'cache_tag/'
+
+#: the timeout for generation counters.  If a counter drops out of the
+#: cache all items carrying that tag are considered stale, so we keep the
+#: counters around for a long time.
+TAG_TIMEOUT = 60 * 60 * 24 * 30
+
+#: the key prefix of the regeneration locks
+LOCK_KEY_PREFIX = 'cache_lock/'
+
+#: the tag of all cached items.  It's invalidated if the configuration
+#: (which includes the active theme) changes.
+CONFIG_TAG = 'config'
+
+
+#: responses and shared files with one of these mimetypes (or mimetype
+#: prefixes) are stored compressed in addition to the plain version.
+COMPRESSIBLE_MIMETYPES = ('text/', 'application/atom+xml',
+                          'application/rss+xml', 'application/xml',
+                          'application/javascript',
+                          'application/x-javascript', 'application/json',
+                          'image/svg+xml')
+
+#: bodies smaller than this many bytes are not worth compressing
+MIN_COMPRESS_SIZE = 256
+
+#: the fields of the cache statistics
+STATS_FIELDS = ('hits', 'stale_hits', 'misses', 'sets', 'bytes',
+                'regeneration_time')
+HITS, STALE_HITS, MISSES, SETS, BYTES, REGENERATION_TIME = \
+    range(len(STATS_FIELDS))
+
+
+def _merge_stats(target, bucket):
+    for key, counters in bucket.items():
+        total = target.setdefault(key, [0] * len(STATS_FIELDS))
+        for idx, value in enumerate(counters):
+            total[idx] += value
+
+
+# the statistics are counted per thread so that no locking is required
+# and summed up by `get_stats`.
+_stats = ThreadBuckets(dict, _merge_stats)
+
+
+def _count(key, field, value=1):
+    """Increment a statistics counter for a cache key prefix."""
+    bucket = _stats.get()
+    counters = bucket.get(key)
+    if counters is None:
+        counters = bucket[key] = [0] * len(STATS_FIELDS)
+    counters[field] += value
+
+
+def get_stats():
+    """Return the cache statistics of this process.  The return value is a
+    dict of dicts keyed by the cache key prefix (for example
+    ``'view_func/zine.views.blog.index'`` or ``'page'`` for the page cache)
+    with the counters from `STATS_FIELDS` and the `hit_ratio`.
+    """
+    rv = {}
+    for key, total in _stats.total().iteritems():
+        rv[key] = stats = dict(zip(STATS_FIELDS, total))
+        lookups = stats['hits'] + stats['stale_hits'] + stats['misses']
+        stats['hit_ratio'] = lookups and \
+            (stats['hits'] + stats['stale_hits']) / float(lookups) or 0.0
+    return rv
 
 
 def get_cache(app):
@@ -37,7 +135,7 @@ def get_cache_context(vary, eager_caching=False, request=None):
         # doesn't do anything anyways but if one tests for caching to
         # disable some more expensive caculations in the function we can
         # tell him to not perform anything if the cache won't hold the data
-        request.app.cache is NullCache or
+        isinstance(request.app.cache, NullCache) or
 
         # if this is an eager caching method and eager caching is disabled
         # we don't do anything here
@@ -53,8 +151,247 @@ def get_cache_context(vary, eager_caching=False, request=None):
     )
 
 
+def _tag_key(tag):
+    """The cache key of the generation counter for a tag."""
+    if isinstance(tag, unicode):
+        tag = tag.encode('utf-8')
+    return TAG_KEY_PREFIX + tag
+
+
+def _new_generation():
+    """Return a new generation value.  Generations are random tokens and not
+    increasing numbers so that a counter that was evicted from the cache
+    can never come back with a value an old item was stored with.
+    """
+    return '%x.%x' % (int(time() * 1000), randrange(1 << 30))
+
+
+def get_tag_generations(cache, tags):
+    """Return a dict with the current generations of the given tags.  Tags
+    that don't have a generation yet are assigned one.
+    """
+    tags = list(tags)
+    if not tags:
+        return {}
+    rv = dict(zip(tags, cache.get_many(*map(_tag_key, tags))))
+    missing = [tag for tag, generation in rv.iteritems() if generation is None]
+    if missing:
+        # use `add` so that we don't overwrite a generation another process
+        # created in the meantime, then read back what was actually stored.
+        for tag in missing:
+            rv[tag] = _new_generation()
+            cache.add(_tag_key(tag), rv[tag], TAG_TIMEOUT)
+        for tag, generation in zip(missing, cache.get_many(*map(_tag_key,
+                                                               missing))):
+            if generation is not None:
+                rv[tag] = generation
+    return rv
+
+
+def invalidate_tags(*tags):
+    """Invalidate all cached items that carry one of the tags provided.
+    This only bumps the generations of the tags, the items are not deleted
+    but ignored on the next lookup and eventually expire.
+    """
+    from zine.application import get_application
+    if tags:
+        get_application().cache.set_many(dict((_tag_key(tag),
+            _new_generation()) for tag in tags), TAG_TIMEOUT)
+
+
+def tag(*tags):
+    """Add tags to all cached results and responses that are currently
+    computed.  Views call this with the tags of the objects they render,
+    for example the tags of all the posts on an index page.  Outside of a
+    cached function this does nothing.
+    """
+    stack = getattr(local, 'cache_tags', None)
+    if stack:
+        stack[-1].update(tags)
+
+
+def tag_posts(posts):
+    """Tag the current cached computation with the tags of all posts."""
+    for post in posts:
+        tag(*post.cache_tags)
+
+
+def get_scheduled_timeout(timeout=None):
+    """Return `timeout` but at most the number of seconds until the next
+    scheduled post is published.  Nothing is invalidated when that happens,
+    so pages and widgets that show published posts have to expire then.
+    `timeout` can be the name of a configuration variable, if it's `None`
+    the default timeout of the cache is used.
+    """
+    from zine.application import get_application
+    from zine.models import Post
+    app = get_application()
+    timeout = _get_timeout(app, timeout)
+    if timeout is None:
+        timeout = app.cache.default_timeout
+    pub_date = Post.query.next_scheduled()
+    if pub_date is not None:
+        delta = pub_date - datetime.utcnow()
+        timeout = min(timeout, max(delta.days * 86400 + delta.seconds + 1, 1))
+    return timeout
+
+
+def _call_collecting_tags(f, args, kwargs, tags=()):
+    """Call `f` and return a tuple in the form ``(rv, tags)`` where tags is
+    a set of the given tags and all the tags added by :func:`tag` while `f`
+    was running.  The tags are passed to cached functions further up the
+    stack.
+    """
+    stack = getattr(local, 'cache_tags', None)
+    if stack is None:
+        stack = local.cache_tags = []
+    stack.append(set(tags))
+    try:
+        rv = f(*args, **kwargs)
+    finally:
+        tags = stack.pop()
+    if stack:
+        stack[-1].update(tags)
+    return rv, tags
+
+
+def acquire_lock(cache, key, timeout):
+    """Try to acquire the regeneration lock for a cache key.  Returns a
+    token for :func:`release_lock` or `None` if someone else holds the lock.
+    Locks expire after `timeout` seconds so that a crashed process does not
+    block the regeneration forever.  Cache systems can provide their own
+    `acquire_lock` and `release_lock` methods if `add` is not atomic.
+    """
+    if hasattr(cache, 'acquire_lock'):
+        return cache.acquire_lock(key, timeout)
+    token = _new_generation()
+    cache.add(LOCK_KEY_PREFIX + key, token, timeout)
+    if cache.get(LOCK_KEY_PREFIX + key) == token:
+        return token
+
+
+def release_lock(cache, key, token):
+    """Release a lock acquired with :func:`acquire_lock`."""
+    if hasattr(cache, 'release_lock'):
+        return cache.release_lock(key, token)
+    if cache.get(LOCK_KEY_PREFIX + key) == token:
+        cache.delete(LOCK_KEY_PREFIX + key)
+
+
+def _load_item(cache, key):
+    """Load an item stored by :func:`_store_item`.  Returns a tuple in the
+    form ``(item, fresh)`` where item is a tuple in the form ``(value,
+    generations, expires)`` or `None` if there is no such item.  If the item
+    expired or one of its tags was invalidated `fresh` is `False` and the
+    value may only be used while it's regenerated.
+    """
+    item = cache.get(key)
+    if not isinstance(item, tuple) or len(item) != 3:
+        return None, False
+    generations, expires = item[1:]
+    fresh = expires > time()
+    if generations:
+        if get_tag_generations(cache, generations) != generations:
+            fresh = False
+        tag(*generations)
+    return item, fresh
+
+
+def _store_item(cache, key, value, tags, timeout, grace):
+    """Store a value together with the current generations of its tags.  The
+    item is kept `grace` seconds longer than `timeout` in the cache so that
+    it can be served while it's regenerated.  Returns the stored item.
+    """
+    if timeout is None:
+        timeout = cache.default_timeout
+    tags = set(tags)
+    tags.add(CONFIG_TAG)
+    item = (value, get_tag_generations(cache, tags), time() + timeout)
+    cache.set(key, item, timeout + grace)
+    return item
+
+
+def _get_timeout(app, timeout):
+    """Timeouts can be strings in which case the timeout is the value of the
+    configuration variable with that name.  Callables are called without
+    arguments after the value was created and return the timeout.
+    """
+    if isinstance(timeout, basestring):
+        return app.cfg[timeout]
+    elif callable(timeout):
+        return timeout()
+    return timeout
+
+
+def _cached_call(app, key, stats_key, f, args, kwargs, tags, timeout,
+                 dogpile, finalize=None, publish=None):
+    """Return the cached value for `key` or call `f` to create it.  The
+    value returned by `f` is passed to `finalize` if given which returns a
+    tuple in the form ``(value, cacheable)``.  `publish` is called with
+    the item whenever a fresh item was loaded or stored.  The statistics
+    are recorded for `stats_key`.
+
+    If `dogpile` is enabled and there is an outdated value in the cache
+    only the caller that gets the lock regenerates it, everybody else is
+    served the old value until the new one is stored.
+    """
+    cache = app.cache
+    item, fresh = _load_item(cache, key)
+    if fresh:
+        _count(stats_key, HITS)
+        if publish is not None:
+            publish(item)
+        return item[0]
+
+    grace = dogpile and app.cfg['cache_grace_time'] or 0
+    lock = None
+    if grace and item is not None:
+        lock = acquire_lock(cache, key, grace)
+        if lock is None:
+            _count(stats_key, STALE_HITS)
+            return item[0]
+
+    _count(stats_key, MISSES)
+    try:
+        if callable(tags):
+            tags = tags(*args, **kwargs)
+        start = time()
+        value, tags = _call_collecting_tags(f, args, kwargs, tags)
+        cacheable = True
+        if finalize is not None:
+            value, cacheable = finalize(value)
+        _count(stats_key, REGENERATION_TIME, time() - start)
+        if cacheable:
+            item = _store_item(cache, key, value, tags,
+                               _get_timeout(app, timeout), grace)
+            _count(stats_key, SETS)
+            _count(stats_key, BYTES, len(dumps(item, HIGHEST_PROTOCOL)))
+            if publish is not None:
+                publish(item)
+    finally:
+        if lock is not None:
+            release_lock(cache, key, lock)
+    return value
+
+
+def get_or_create(key, creator, tags=(), timeout=None, stats_key=None):
+    """Return the value for `key` from the cache or call `creator` without
+    arguments to create and store it.  Unlike :func:`result` this does not
+    depend on eager caching or the current request.  `tags` and `timeout`
+    work like for :func:`result`, `timeout` may also be a function that is
+    called after `creator`.  `stats_key` is the key the statistics are
+    recorded for and defaults to `key`.
+    """
+    from zine.application import get_application
+    app = get_application()
+    if isinstance(app.cache, NullCache):
+        return creator()
+    return _cached_call(app, key, stats_key or key, creator, (), {}, tags,
+                        timeout, False)
+
+
 def result(cache_key, vary=(), eager_caching=False, timeout=None,
-           admix_arguments=True, skip_posargs=0):
+           admix_arguments=True, skip_posargs=0, tags=(), dogpile=False):
     """Cache the result of the function for a given timeout.  The `vary`
     argument can be used to keep different caches or limit the cache.
     Currently the following `vary` modifiers are available:
@@ -68,23 +405,29 @@ def result(cache_key, vary=(), eager_caching=False, timeout=None,
     if `admix_arguments` is set to `True` the arguments passed to the function
     will be hashed and added to the cache key.  If you set `eager_caching` to
     `True` this method won't do anything if eager caching is disabled.
+
+    `tags` is a list of cache tags or a function that is called with the
+    arguments of the function and returns such a list.  Additionally the
+    function can add tags by calling :func:`tag`.  The result is dropped
+    from the cache as soon as one of the tags is invalidated.  If `timeout`
+    is a string it's the name of a configuration variable.
+
+    If `dogpile` is `True` only one caller regenerates an outdated result,
+    the others get the old one for up to ``cache_grace_time`` seconds.
     """
     def decorator(f):
         def oncall(*args, **kwargs):
             request, want_cache = get_cache_context(vary, eager_caching)
 
-            if want_cache:
-                key = cache_key
-                if admix_arguments:
-                    key += ':%d' % hash((args[skip_posargs:],
-                                        frozenset(kwargs.iteritems())))
-                result = request.app.cache.get(key)
-                if result is not None:
-                    return result
-            result = f(*args, **kwargs)
-            if want_cache:
-                request.app.cache.set(key, result, timeout)
-            return result
+            if not want_cache:
+                return f(*args, **kwargs)
+
+            key = cache_key
+            if admix_arguments:
+                key += ':%d' % hash((args[skip_posargs:],
+                                    frozenset(kwargs.iteritems())))
+            return _cached_call(request.app, key, cache_key, f, args,
+                                kwargs, tags, timeout, dogpile)
 
         try:
             oncall.__name__ = f.__name__
@@ -96,12 +439,65 @@ def result(cache_key, vary=(), eager_caching=False, timeout=None,
     return decorator
 
 
-def response(vary=(), timeout=None, cache_key=None):
+def is_compressible(mimetype):
+    """Check if data of the given mimetype should be compressed."""
+    for prefix in COMPRESSIBLE_MIMETYPES:
+        if mimetype.startswith(prefix):
+            return True
+    return False
+
+
+def gzip_data(data):
+    """Return `data` gzip compressed."""
+    buffer = StringIO()
+    f = GzipFile(mode='wb', fileobj=buffer, compresslevel=9)
+    try:
+        f.write(data)
+    finally:
+        f.close()
+    return buffer.getvalue()
+
+
+def compress_response(response):
+    """Return a dict of precompressed versions of the body of a frozen
+    response keyed by content coding.  The dict is empty if the response
+    is not worth compressing.
+    """
+    if 'content-encoding' in response.headers or \
+       not is_compressible(response.mimetype or ''):
+        return {}
+    data = response.data
+    if len(data) < MIN_COMPRESS_SIZE:
+        return {}
+    return {'gzip': gzip_data(data)}
+
+
+def accepts_gzip(environ):
+    """Check if the client accepts gzip compressed responses."""
+    accept = parse_accept_header(environ.get('HTTP_ACCEPT_ENCODING'))
+    return accept.quality('gzip') > 0
+
+
+def response(vary=(), timeout=None, cache_key=None, tags=(), dogpile=False,
+             args=()):
     """Cache a complete view function for a number of seconds.  This is a
     little bit different from `result` because it freezes the response
     properly and sets etags.  The current request path is added to the cache
     key to keep them cached properly.  If the response is not 200 no caching
-    is performed.
+    is performed.  `tags`, `timeout` and `dogpile` work like for
+    :func:`result`, a callable `tags` is called with the arguments of the
+    view.
+
+    Text responses are stored gzip compressed as well and the compressed
+    version is sent to clients that accept it.
+
+    `args` are the names of the URL arguments the view reads, they are
+    added to the cache key.  Other URL arguments are ignored, so that
+    random query strings don't fill the cache.
+
+    If the :class:`PageCacheMiddleware` is active the responses are also
+    stored for it, unless the request has a query string that is not
+    exactly the one built from `args`.
 
     This method doesn't do anything if eager caching is disabled (by default).
     """
@@ -109,25 +505,57 @@ def response(vary=(), timeout=None, cache_key=None):
     if not 'method' in vary:
         vary = set(vary)
         vary.add('method')
+
+    def finalize(response):
+        # make sure it's one of our request objects so that we
+        # have the `make_conditional` method on it.
+        response = Response.force_type(response)
+        if response.status_code != 200:
+            return (response, {}), False
+        response.add_etag()
+        response.freeze()
+        return (response, compress_response(response)), True
+
     def decorator(f):
         key = cache_key or 'view_func/%s.%s' % (f.__module__, f.__name__)
         def oncall(request, *args, **kwargs):
             use_cache = get_cache_context(vary, True, request)[1]
-            response = None
-            if use_cache:
-                cache_key = key + request.path.encode('utf-8')
-                response = request.app.cache.get(cache_key)
-
-            if response is None:
-                response = f(request, *args, **kwargs)
+            if not use_cache:
+                return Response.force_type(f(request, *args, **kwargs))
 
-            # make sure it's one of our request objects so that we
-            # have the `make_conditional` method on it.
-            Response.force_type(response)
+            path = request.path.encode('utf-8')
+            key_args = url_encode([(name, value) for name in args
+                                   for value in request.args.getlist(name)])
+            if key_args:
+                path += '?' + key_args
 
-            if use_cache and response.status_code == 200:
-                response.freeze()
-                request.app.cache.set(key, response, timeout)
+            # the pages are keyed on the query string, so a response may
+            # only be published if the query string is the one in the key.
+            page_key = request.environ.get('zine.page_cache_key')
+            publish = None
+            if page_key is not None and \
+               request.environ.get('QUERY_STRING', '') == key_args:
+                publish = lambda item: _publish_page(request.app.cache,
+                                                     page_key, item)
+            response, encodings = _cached_call(request.app, key + path,
+                                               key, f, (request,) + args,
+                                               kwargs, tags, timeout, dogpile,
+                                               finalize, publish)
+            if response.status_code == 200:
+                # in-process caches hand out the cached response itself,
+                # so the headers are changed on a copy.
+                response = Response(response.response, response.status,
+                                    response.headers.to_list())
+                if encodings:
+                    response.vary.add('Accept-Encoding')
+                    if accepts_gzip(request.environ):
+                        data = encodings['gzip']
+                        response.response = [data]
+                        response.headers['Content-Encoding'] = 'gzip'
+                        response.headers['Content-Length'] = str(len(data))
+                        etag, weak = response.get_etag()
+                        if etag is not None:
+                            response.set_etag(etag + '-gzip', weak)
                 response.make_conditional(request)
             return response
         oncall.__name__ = f.__name__
@@ -137,15 +565,922 @@ def response(vary=(), timeout=None, cache_key=None):
     return decorator
 
 
+def conditional(validator):
+    """Answer conditional requests for a view without calling it.  The
+    `validator` is called with the arguments of the view and returns a tuple
+    in the form ``(parts, last_modified)`` or `None` if the request cannot
+    be validated.  The ETag is created from the `parts`, the current user
+    and the modification time of the configuration file, gzip compressed
+    responses get their own variant of it.  If the client
+    already has the current version a 304 response is returned.
+
+    `last_modified` must only be given if every change of the `parts`
+    also moves it forward, otherwise clients that only send
+    ``If-Modified-Since`` get outdated pages.  If it's `None` no
+    Last-Modified header is sent and the page is validated by the ETag
+    only.
+
+    Validators must be cheap, they are called for every GET and HEAD request
+    before the view (and before :func:`response`, this decorator goes on
+    top of it).
+    """
+    from zine.application import Response
+    def decorator(f):
+        def oncall(request, *args, **kwargs):
+            rv = None
+            if request.method in ('GET', 'HEAD'):
+                rv = validator(request, *args, **kwargs)
+            if rv is None:
+                return f(request, *args, **kwargs)
+
+            parts, last_modified = rv
+            cfg = request.app.cfg
+            try:
+                config_mtime = os.path.getmtime(cfg.filename)
+            except OSError:
+                config_mtime = 0
+            etag = md5(repr((f.__name__, parts, request.user.id,
+                             config_mtime))).hexdigest()
+            if last_modified is not None:
+                config_mtime = datetime.utcfromtimestamp(config_mtime)
+                if last_modified < config_mtime:
+                    last_modified = config_mtime
+                # HTTP dates have no microseconds
+                last_modified = last_modified.replace(microsecond=0)
+
+            for variant in etag, etag + '-gzip':
+                if not is_resource_modified(request.environ,
+                                            quote_etag(variant),
+                                            last_modified=last_modified):
+                    response = Response(status=304)
+                    break
+            else:
+                response = Response.force_type(f(request, *args, **kwargs))
+                variant = etag
+                if response.headers.get('Content-Encoding') == 'gzip':
+                    variant += '-gzip'
+            if response.status_code in (200, 304):
+                response.set_etag(variant)
+                if last_modified is not None:
+                    response.last_modified = last_modified
+            return response
+        oncall.__name__ = f.__name__
+        oncall.__module__ = f.__module__
+        oncall.__doc__ = f.__doc__
+        return oncall
+    return decorator
+
+
+def _publish_page(cache, page_key, item):
+    """Store a frozen response for the :class:`PageCacheMiddleware`.  The
+    page shares the tags and the expiration time with the response item.
+    """
+    (response, encodings), generations, expires = item
+    timeout = int(expires - time())
+    if timeout > 0:
+        headers = [(key, value) for key, value in response.headers.to_list()
+                   if key.lower() != 'set-cookie']
+        if encodings:
+            headers.append(('Vary', 'Accept-Encoding'))
+        cache.set(page_key, ((response.status, headers, response.data,
+                              encodings), generations, expires), timeout)
+
+
+class PageCacheMiddleware(object):
+    """Serves pages stored by :func:`response` to anonymous visitors before
+    the request object is created.  Requests with a session cookie and
+    requests other than GET and HEAD are always passed to the application.
+    Pages are keyed on the host, path and query string and fill on the
+    next request the application handles with a cached view.
+    """
+
+    def __init__(self, app, zine_app):
+        self.app = app
+        self.zine_app = zine_app
+
+    def get_page_key(self, environ):
+        """Return the cache key for the page requested."""
+        url = '%s%s%s?%s' % (
+            environ.get('HTTP_HOST') or environ.get('SERVER_NAME', ''),
+            environ.get('SCRIPT_NAME', ''),
+            environ.get('PATH_INFO', ''),
+            environ.get('QUERY_STRING', '')
+        )
+        return 'page/' + md5(url).hexdigest()
+
+    def is_cacheable(self, environ):
+        """Check if the request can be served from the page cache."""
+        cfg = self.zine_app.cfg
+        return environ['REQUEST_METHOD'] in ('GET', 'HEAD') and \
+               cfg['session_cookie_name'] + '=' not in \
+                    environ.get('HTTP_COOKIE', '') and \
+               not cfg['maintenance_mode'] and \
+               not (cfg['force_https'] and
+                    environ['wsgi.url_scheme'] == 'http')
+
+    def __call__(self, environ, start_response):
+        if not self.is_cacheable(environ):
+            return self.app(environ, start_response)
+        page_key = self.get_page_key(environ)
+        item, fresh = _load_item(self.zine_app.cache, page_key)
+        if not fresh:
+            _count('page', MISSES)
+            environ['zine.page_cache_key'] = page_key
+            return self.app(environ, start_response)
+        _count('page', HITS)
+
+        status, headers, body, encodings = item[0]
+        if 'gzip' in encodings and accepts_gzip(environ):
+            body = encodings['gzip']
+            headers = Headers(headers)
+            headers['Content-Encoding'] = 'gzip'
+            headers['Content-Length'] = str(len(body))
+            if 'etag' in headers:
+                etag, weak = unquote_etag(headers['etag'])
+                headers['ETag'] = quote_etag(etag + '-gzip', weak)
+            headers = headers.to_list()
+        etag = [value for key, value in headers if key.lower() == 'etag']
+        if etag and not is_resource_modified(environ, etag[0]):
+            start_response('304 NOT MODIFIED', [('ETag', etag[0])])
+            return []
+        start_response(status, headers)
+        if environ['REQUEST_METHOD'] == 'HEAD':
+            return []
+        return [body]
+
+
+class SharedDataMiddleware(_SharedDataMiddleware):
+    """Like the werkzeug shared data middleware but serves gzip compressed
+    versions of text files to clients that accept them.  The compressed
+    files are created once when the middleware is created and stored in
+    `gzip_folder`, they are only rebuilt if the original file changed.
+    Only exports that point to a folder on the file system are compressed.
+    """
+
+    def __init__(self, app, exports, gzip_folder, **kwargs):
+        _SharedDataMiddleware.__init__(self, app, exports, **kwargs)
+        self.gzip_folder = gzip_folder
+        self.compressed = {}
+        for search_path, directory in exports.iteritems():
+            if isinstance(directory, basestring) and \
+               os.path.isdir(directory):
+                self.compress_folder(search_path, directory)
+
+    def compress_folder(self, search_path, directory):
+        """Create the compressed versions of all the files in `directory`
+        that are exported as `search_path`.
+        """
+        target = os.path.join(self.gzip_folder, search_path.strip('/'))
+        for dirpath, dirnames, filenames in os.walk(directory):
+            for filename in filenames:
+                mimetype = mimetypes.guess_type(filename)[0]
+                if mimetype is None or not is_compressible(mimetype):
+                    continue
+                source = os.path.join(dirpath, filename)
+                relname = source[len(directory):].lstrip(os.sep)
+                gzip_filename = os.path.join(target, relname) + '.gz'
+                try:
+                    if os.path.getsize(source) < MIN_COMPRESS_SIZE:
+                        continue
+                    if not os.path.isfile(gzip_filename) or \
+                       os.path.getmtime(gzip_filename) < \
+                       os.path.getmtime(source):
+                        self.write_compressed(source, gzip_filename)
+                except (IOError, OSError):
+                    continue
+                url = '/'.join([search_path.rstrip('/')] +
+                               relname.split(os.sep))
+                self.compressed[url] = (gzip_filename, mimetype)
+
+    def write_compressed(self, source, gzip_filename):
+        """Compress `source` into `gzip_filename`."""
+        folder = os.path.dirname(gzip_filename)
+        if not os.path.isdir(folder):
+            os.makedirs(folder)
+        f = file(source, 'rb')
+        try:
+            data = f.read()
+        finally:
+            f.close()
+        # write to a temporary file first so that concurrently started
+        # processes never serve a partial file.
+        tmp = '%s.%d.tmp' % (gzip_filename, os.getpid())
+        f = file(tmp, 'wb')
+        try:
+            f.write(gzip_data(data))
+        finally:
+            f.close()
+        os.rename(tmp, gzip_filename)
+
+    def __call__(self, environ, start_response):
+        compressed = self.compressed.get(environ.get('PATH_INFO', ''))
+        if compressed is None:
+            return _SharedDataMiddleware.__call__(self, environ,
+                                                  start_response)
+        if not accepts_gzip(environ):
+            def start_varying_response(status, headers, exc_info=None):
+                headers = list(headers)
+                headers.append(('Vary', 'Accept-Encoding'))
+                return start_response(status, headers, exc_info)
+            return _SharedDataMiddleware.__call__(self, environ,
+                                                  start_varying_response)
+
+        gzip_filename, mimetype = compressed
+        if mimetype.startswith('text/'):
+            mimetype += '; charset=utf-8'
+        try:
+            f = file(gzip_filename, 'rb')
+        except IOError:
+            return _SharedDataMiddleware.__call__(self, environ,
+                                                  start_response)
+        mtime = datetime.utcfromtimestamp(os.path.getmtime(gzip_filename))
+        file_size = os.path.getsize(gzip_filename)
+
+        headers = [('Date', http_date()), ('Vary', 'Accept-Encoding')]
+        if self.cache:
+            timeout = self.cache_timeout
+            etag = self.generate_etag(mtime, file_size, gzip_filename)
+            headers += [
+                ('Etag', '"%s"' % etag),
+                ('Cache-Control', 'max-age=%d, public' % timeout)
+            ]
+            if not is_resource_modified(environ, etag, last_modified=mtime):
+                f.close()
+                start_response('304 Not Modified', headers)
+                return []
+            headers.append(('Expires', http_date(time() + timeout)))
+        else:
+            headers.append(('Cache-Control', 'public'))
+        headers.extend((
+            ('Content-Type', mimetype),
+            ('Content-Encoding', 'gzip'),
+            ('Content-Length', str(file_size)),
+            ('Last-Modified', http_date(mtime))
+        ))
+        start_response('200 OK', headers)
+        return wrap_file(environ, f)
+
+
+class FileSystemCache(_FileSystemCache):
+    """The filesystem cache from Werkzeug with pruning and clearing that
+    work on the actual files and locks that work across processes.
+    """
+
+    def _prune(self):
+        entries = os.listdir(self._path)
+        if len(entries) > self._threshold:
+            now = time()
+            for idx, filename in enumerate(entries):
+                filename = os.path.join(self._path, filename)
+                try:
+                    f = file(filename, 'rb')
+                    try:
+                        if load(f) > now and idx % 3 != 0:
+                            continue
+                    finally:
+                        f.close()
+                except Exception:
+                    pass
+                try:
+                    os.remove(filename)
+                except OSError:
+                    pass
+
+    def clear(self):
+        for filename in os.listdir(self._path):
+            try:
+                os.remove(os.path.join(self._path, filename))
+            except OSError:
+                pass
+
+    def acquire_lock(self, key, timeout):
+        filename = self._get_filename(LOCK_KEY_PREFIX + key)
+        token = _new_generation()
+        for attempt in 0, 1:
+            try:
+                fd = os.open(filename, os.O_CREAT | os.O_EXCL | os.O_WRONLY,
+                             0600)
+            except OSError:
+                # break locks left behind by crashed processes
+                try:
+                    if attempt or os.path.getmtime(filename) > \
+                       time() - timeout:
+                        return None
+                    os.remove(filename)
+                except OSError:
+                    pass
+                continue
+            f = os.fdopen(fd, 'wb')
+            try:
+                dump(int(time() + timeout), f, 1)
+                dump(token, f, HIGHEST_PROTOCOL)
+            finally:
+                f.close()
+            return token
+
+    def release_lock(self, key, token):
+        if self.get(LOCK_KEY_PREFIX + key) == token:
+            self.delete(LOCK_KEY_PREFIX + key)
+
+
+class SQLiteCache(BaseCache):
+    """A cache that stores the items in a SQLite database.  The database is
+    shared by all processes on the host, and it uses write-ahead logging so
+    that readers never wait for writers.  Every item is a single row, so
+    reads and writes never have to look at the other items.
+
+    Expired items and, if there are more than `threshold` items, the least
+    recently used ones are removed now and then when items are added.  The
+    access time of an item is only updated once per `touch_interval`
+    seconds, so that reads rarely need to write to the database.
+    """
+
+    #: on average one in this many writes prunes the cache
+    prune_ratio = 100
+
+    def __init__(self, filename, threshold=10000, default_timeout=300,
+                 touch_interval=60):
+        if sqlite3 is None:
+            raise RuntimeError('no sqlite module found')
+        BaseCache.__init__(self, default_timeout)
+        self.filename = filename
+        self.threshold = threshold
+        self.touch_interval = touch_interval
+        self._local = threading.local()
+        folder = os.path.dirname(filename)
+        if folder and not os.path.isdir(folder):
+            os.makedirs(folder)
+        con = self._get_connection()
+        con.execute('create table if not exists cache_items ('
+                    'key text primary key, value blob not null, '
+                    'expires integer not null, accessed integer not null)')
+        con.execute('create index if not exists cache_items_expires '
+                    'on cache_items (expires)')
+        con.execute('create index if not exists cache_items_accessed '
+                    'on cache_items (accessed)')
+
+    def _get_connection(self):
+        # sqlite connections can't be shared between threads and must not
+        # be used by forked processes.
+        con = getattr(self._local, 'connection', None)
+        if con is None or self._local.pid != os.getpid():
+            con = sqlite3.connect(self.filename, timeout=10,
+                                  isolation_level=None)
+            con.execute('pragma journal_mode = wal')
+            con.execute('pragma synchronous = normal')
+            self._local.connection = con
+            self._local.pid = os.getpid()
+        return con
+
+    def _get_expires(self, timeout):
+        if timeout is None:
+            timeout = self.default_timeout
+        return int(time()) + timeout
+
+    def _prune(self, con):
+        now = int(time())
+        con.execute('delete from cache_items where expires <= ?', (now,))
+        count = con.execute('select count(*) from cache_items').fetchone()[0]
+        if count > self.threshold:
+            con.execute('delete from cache_items where key in (select key '
+                        'from cache_items order by accessed limit ?)',
+                        (count - self.threshold,))
+
+    def _maybe_prune(self, con):
+        if randrange(self.prune_ratio) == 0:
+            self._prune(con)
+
+    def get(self, key):
+        return self.get_dict(key)[key]
+
+    def get_many(self, *keys):
+        rv = self.get_dict(*keys)
+        return [rv[key] for key in keys]
+
+    def get_dict(self, *keys):
+        rv = dict.fromkeys(keys)
+        if not keys:
+            return rv
+        con = self._get_connection()
+        now = int(time())
+        touched = []
+        for key, value, expires, accessed in con.execute(
+                'select key, value, expires, accessed from cache_items '
+                'where key in (%s)' % ', '.join(['?'] * len(keys)), keys):
+            if expires <= now:
+                continue
+            try:
+                rv[key] = loads(str(value))
+            except Exception:
+                continue
+            if accessed < now - self.touch_interval:
+                touched.append((now, key))
+        if touched:
+            con.executemany('update cache_items set accessed = ? '
+                            'where key = ?', touched)
+        return rv
+
+    def set(self, key, value, timeout=None):
+        self.set_many({key: value}, timeout)
+
+    def set_many(self, mapping, timeout=None):
+        expires = self._get_expires(timeout)
+        now = int(time())
+        rows = [(key, sqlite3.Binary(dumps(value, HIGHEST_PROTOCOL)),
+                 expires, now) for key, value in mapping.iteritems()]
+        con = self._get_connection()
+        con.executemany('insert or replace into cache_items (key, value, '
+                        'expires, accessed) values (?, ?, ?, ?)', rows)
+        self._maybe_prune(con)
+
+    def add(self, key, value, timeout=None):
+        expires = self._get_expires(timeout)
+        now = int(time())
+        con = self._get_connection()
+        con.execute('begin immediate')
+        try:
+            con.execute('delete from cache_items where key = ? and '
+                        'expires <= ?', (key, now))
+            added = con.execute('insert or ignore into cache_items (key, '
+                                'value, expires, accessed) values '
+                                '(?, ?, ?, ?)', (key, sqlite3.Binary(
+                                    dumps(value, HIGHEST_PROTOCOL)),
+                                    expires, now)).rowcount == 1
+            con.execute('commit')
+        except:
+            con.execute('rollback')
+            raise
+        if added:
+            self._maybe_prune(con)
+        return added
+
+    def delete(self, key):
+        self.delete_many(key)
+
+    def delete_many(self, *keys):
+        self._get_connection().executemany('delete from cache_items where '
+                                           'key = ?', [(x,) for x in keys])
+
+    def clear(self):
+        self._get_connection().execute('delete from cache_items')
+
+    def inc(self, key, delta=1):
+        con = self._get_connection()
+        con.execute('begin immediate')
+        try:
+            value = (self.get(key) or 0) + delta
+            self.set(key, value)
+            con.execute('commit')
+        except:
+            con.execute('rollback')
+            raise
+        return value
+
+    def dec(self, key, delta=1):
+        return self.inc(key, -delta)
+
+
+class TieredCache(BaseCache):
+    """A small LRU cache inside the process in front of a shared cache such
+    as memcached or the filesystem cache.  The local cache is bounded by the
+    number of items and the number of bytes (the items are stored pickled)
+    and keeps items only for a few seconds.
+
+    Deleting items and clearing the cache bump an epoch in the shared cache.
+    Every process checks that epoch at most once a second and drops its
+    local items if it changed.  Invalidating cache tags bumps a second epoch
+    that only drops the local copies of the tag generations, the cached
+    items are checked against the generations anyways.
+    """
+
+    #: the key of the invalidation epoch in the shared cache
+    epoch_key = 'cache_epoch'
+
+    #: the key of the epoch of the tag generations in the shared cache
+    tag_epoch_key = 'cache_tag_epoch'
+
+    #: the number of seconds between two checks of the epoch
+    epoch_check_interval = 1
+
+    def __init__(self, remote, max_items=1000, max_bytes=16 << 20,
+                 local_timeout=5, default_timeout=300):
+        BaseCache.__init__(self, default_timeout)
+        self.remote = remote
+        self.max_items = max_items
+        self.max_bytes = max_bytes
+        self.local_timeout = local_timeout
+        self.local_hits = self.local_misses = 0
+        self.remote_hits = self.remote_misses = 0
+        self._lock = threading.Lock()
+        self._epoch = self._tag_epoch = None
+        self._epoch_checked = 0
+        self._clear_local()
+
+    def _clear_local(self):
+        # the items are kept in a doubly linked list in the order of their
+        # usage.  each link is a list in the form
+        # ``[prev, next, key, expires, data]``
+        self._lock.acquire()
+        try:
+            self._items = {}
+            self._root = root = []
+            root[:] = [root, root, None, 0, '']
+            self._bytes = 0
+        finally:
+            self._lock.release()
+
+    def _unlink(self, link):
+        link[0][1] = link[1]
+        link[1][0] = link[0]
+        self._bytes -= len(link[4])
+        del self._items[link[2]]
+
+    def _get_local(self, key):
+        self._lock.acquire()
+        try:
+            link = self._items.get(key)
+            if link is None:
+                return None
+            if link[3] < time():
+                self._unlink(link)
+                return None
+            link[0][1] = link[1]
+            link[1][0] = link[0]
+            root = self._root
+            link[0] = root[0]
+            link[1] = root
+            root[0][1] = root[0] = link
+            return link[4]
+        finally:
+            self._lock.release()
+
+    def _set_local(self, key, value, timeout=None):
+        data = dumps(value, HIGHEST_PROTOCOL)
+        if len(data) > self.max_bytes:
+            return
+        if timeout is None or timeout > self.local_timeout:
+            timeout = self.local_timeout
+        self._lock.acquire()
+        try:
+            link = self._items.get(key)
+            if link is not None:
+                self._unlink(link)
+            root = self._root
+            link = [root[0], root, key, time() + timeout, data]
+            root[0][1] = root[0] = self._items[key] = link
+            self._bytes += len(data)
+            while len(self._items) > self.max_items or \
+                  self._bytes > self.max_bytes:
+                self._unlink(root[1])
+        finally:
+            self._lock.release()
+
+    def _delete_local(self, key):
+        self._lock.acquire()
+        try:
+            link = self._items.get(key)
+            if link is not None:
+                self._unlink(link)
+        finally:
+            self._lock.release()
+
+    def _delete_local_tags(self):
+        self._lock.acquire()
+        try:
+            for key, link in self._items.items():
+                if key.startswith(TAG_KEY_PREFIX):
+                    self._unlink(link)
+        finally:
+            self._lock.release()
+
+    def _check_epoch(self):
+        now = time()
+        if now - self._epoch_checked < self.epoch_check_interval:
+            return
+        self._epoch_checked = now
+        epoch, tag_epoch = self.remote.get_many(self.epoch_key,
+                                                self.tag_epoch_key)
+        if epoch != self._epoch:
+            self._clear_local()
+            self._epoch = epoch
+        elif tag_epoch != self._tag_epoch:
+            self._delete_local_tags()
+        self._tag_epoch = tag_epoch
+
+    def _bump_epoch(self):
+        self._epoch = _new_generation()
+        self.remote.set(self.epoch_key, self._epoch, TAG_TIMEOUT)
+        self._clear_local()
+
+    @property
+    def stats(self):
+        """A dict with the hit ratios and sizes of both tiers."""
+        def ratio(hits, misses):
+            if hits + misses:
+                return hits / float(hits + misses)
+        return {
+            'local_hits':       self.local_hits,
+            'local_misses':     self.local_misses,
+            'local_ratio':      ratio(self.local_hits, self.local_misses),
+            'local_items':      len(self._items),
+            'local_bytes':      self._bytes,
+            'remote_hits':      self.remote_hits,
+            'remote_misses':    self.remote_misses,
+            'remote_ratio':     ratio(self.remote_hits, self.remote_misses)
+        }
+
+    def get(self, key):
+        return self.get_many(key)[0]
+
+    def get_many(self, *keys):
+        self._check_epoch()
+        rv = []
+        missing = []
+        for idx, key in enumerate(keys):
+            data = self._get_local(key)
+            if data is None:
+                missing.append(idx)
+                rv.append(None)
+            else:
+                rv.append(loads(data))
+        self.local_hits += len(keys) - len(missing)
+        self.local_misses += len(missing)
+        if missing:
+            values = self.remote.get_many(*[keys[idx] for idx in missing])
+            for idx, value in zip(missing, values):
+                if value is None:
+                    self.remote_misses += 1
+                else:
+                    self.remote_hits += 1
+                    self._set_local(keys[idx], value)
+                    rv[idx] = value
+        return rv
+
+    def get_dict(self, *keys):
+        return dict(zip(keys, self.get_many(*keys)))
+
+    def set(self, key, value, timeout=None):
+        self.set_many({key: value}, timeout)
+
+    def set_many(self, mapping, timeout=None):
+        if timeout is None:
+            timeout = self.default_timeout
+        self.remote.set_many(mapping, timeout)
+        tags_changed = False
+        for key, value in mapping.iteritems():
+            self._set_local(key, value, timeout)
+            if key.startswith(TAG_KEY_PREFIX):
+                tags_changed = True
+        # other processes have to reload their tag generations
+        if tags_changed:
+            self._tag_epoch = _new_generation()
+            self.remote.set(self.tag_epoch_key, self._tag_epoch, TAG_TIMEOUT)
+
+    def add(self, key, value, timeout=None):
+        if timeout is None:
+            timeout = self.default_timeout
+        self.remote.add(key, value, timeout)
+        self._delete_local(key)
+
+    def delete(self, key):
+        self.delete_many(key)
+
+    def delete_many(self, *keys):
+        self.remote.delete_many(*keys)
+        self._bump_epoch()
+
+    def clear(self):
+        self.remote.clear()
+        self._bump_epoch()
+
+    def inc(self, key, delta=1):
+        self._delete_local(key)
+        return self.remote.inc(key, delta)
+
+    def dec(self, key, delta=1):
+        self._delete_local(key)
+        return self.remote.dec(key, delta)
+
+    def acquire_lock(self, key, timeout):
+        return acquire_lock(self.remote, key, timeout)
+
+    def release_lock(self, key, token):
+        return release_lock(self.remote, key, token)
+
+
+def _invalidate_post(post):
+    invalidate_tags('index', 'feeds', *post.cache_tags)
+
+
+def _invalidate_comment(*args):
+    # the comment is always the last argument, `after-comment-saved` is
+    # emitted with the request as first argument.
+    post = args[-1].post
+    if post is not None:
+        invalidate_tags('comments', 'post/%d' % post.id)
+
+
+def _invalidate_category(category):
+    invalidate_tags('index', 'feeds', 'category/' + category.slug)
+
+
+class SlugInvalidationExtension(SessionExtension):
+    """Invalidates the tags of the old and new slugs of categories and
+    tags when their slugs change.  The events only know the new slug, so
+    the slugs are collected when the changes are flushed and invalidated
+    when they are committed.
+    """
+
+    def after_flush(self, session, flush_context):
+        from zine.models import Category, Tag
+        for obj in session.dirty:
+            if isinstance(obj, Category):
+                prefix = 'category/'
+            elif isinstance(obj, Tag):
+                prefix = 'tag/'
+            else:
+                continue
+            added, unchanged, deleted = get_history(obj, 'slug')
+            if deleted:
+                stale = session.__dict__.setdefault('_stale_cache_tags',
+                                                    set())
+                stale.update(prefix + slug for slug in added + deleted
+                             if slug)
+
+    def after_commit(self, session):
+        stale = session.__dict__.pop('_stale_cache_tags', None)
+        if stale:
+            invalidate_tags('index', 'feeds', *stale)
+
+    def after_rollback(self, session):
+        session.__dict__.pop('_stale_cache_tags', None)
+
+
+def setup_invalidation(app):
+    """Connect the events that invalidate cache tags.  This is called by the
+    application during setup.  The following tags are used by the core:
+
+    ``'index'``
+        all post listings.  Invalidated if any post changes.
+
+    ``'feeds'``
+        the post feeds.  Invalidated if any post changes.
+
+    ``'comments'``
+        everything that displays comments of more than one post.
+
+    ``'post/<id>'``, ``'author/<id>'``, ``'category/<slug>'``, ``'tag/<slug>'``
+        everything that shows the post, the posts of the author, the category
+        or the tag.  See :attr:`~zine.models.Post.cache_tags`.  The tags of
+        old slugs are invalidated by the :class:`SlugInvalidationExtension`.
+
+    ``'config'``
+        every cached item (see `CONFIG_TAG`).  Invalidated if the
+        configuration or the theme changes.
+    """
+    for event in 'after-post-saved', 'before-post-deleted':
+        app.connect_event(event, _invalidate_post)
+    for event in ('after-comment-saved', 'before-comment-deleted',
+                  'before-comment-approved', 'before-comment-blocked',
+                  'before-comment-mark-spam', 'before-comment-mark-ham'):
+        app.connect_event(event, _invalidate_comment)
+    for event in 'after-category-saved', 'before-category-deleted':
+        app.connect_event(event, _invalidate_category)
+
+
+def get_warmup_paths(app):
+    """Return the paths (relative to the blog URL) that :func:`warm_cache`
+    requests: the first (existing) index pages, the latest entries, the feeds of the
+    blog, the categories and the tags and the extra URLs from the
+    configuration.
+    """
+    from zine.models import Post, Category, Tag
+    cfg = app.cfg
+    prefix = app.url_adapter.script_name.rstrip('/')
+    def build(endpoint, **values):
+        return app.url_adapter.build(endpoint, values)[len(prefix):] \
+                  .lstrip('/')
+
+    paths = [build('blog/index', page=1)]
+    if cfg['cache_warmup_pages'] > 1:
+        per_page = cfg['posts_per_page']
+        pages = (Post.query.for_index().latest(ignore_privileges=True)
+                     .count() + per_page - 1) // per_page
+        for page in xrange(2, min(pages, cfg['cache_warmup_pages']) + 1):
+            paths.append(build('blog/index', page=page))
+    if cfg['cache_warmup_entries']:
+        posts = Post.query.for_index().latest(ignore_privileges=True) \
+                    .order_by(Post.pub_date.desc()) \
+                    .limit(cfg['cache_warmup_entries']).all()
+        paths.extend(post.slug for post in posts)
+    if cfg['cache_warmup_feeds']:
+        paths.append(build('blog/atom_feed'))
+        for category in Category.query.all():
+            paths.append(build('blog/atom_feed', category=category.slug))
+        for tag in Tag.query.all():
+            paths.append(build('blog/atom_feed', tag=tag.slug))
+    for url in cfg['cache_warmup_urls']:
+        paths.append(url.strip().lstrip('/'))
+    return paths
+
+
+def warm_cache(app, paths=None, concurrency=None, timeout=60,
+               callback=None):
+    """Request `paths` (defaults to :func:`get_warmup_paths`) as anonymous
+    visitor so that the cached views and the page cache are filled.  At most
+    `concurrency` requests (defaults to the configured value) are performed
+    at once.  If given, `callback` is called with the path, the response
+    status (or the exception) and the time the request took after each
+    request.  Returns the number of failed requests.
+    """
+    from Queue import Queue, Empty
+    if paths is None:
+        paths = get_warmup_paths(app)
+    if concurrency is None:
+        concurrency = app.cfg['cache_warmup_concurrency']
+    queue = Queue()
+    for path in paths:
+        queue.put(path)
+    failed = []
+    lock = threading.Lock()
+
+    def worker():
+        while 1:
+            try:
+                path = queue.get_nowait()
+            except Empty:
+                return
+            start = time()
+            try:
+                status = app.perform_subrequest(path, timeout=timeout) \
+                            .status_code
+            except Exception, e:
+                status = e
+            lock.acquire()
+            try:
+                if status != 200:
+                    failed.append(path)
+                if callback is not None:
+                    callback(path, status, time() - start)
+            finally:
+                lock.release()
+
+    workers = [threading.Thread(target=worker)
+               for x in xrange(min(concurrency, len(paths)))]
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    return len(failed)
+
+
+def setup_warmup(app):
+    """Warm up the cache in a background thread once the application is set
+    up if this is enabled in the configuration.  This is called by the
+    application during setup.
+    """
+    if not (app.cfg['cache_warmup_on_setup'] and
+            app.cfg['enable_eager_caching']):
+        return
+
+    def warm_up():
+        from zine.database import cleanup_session
+        try:
+            warm_cache(app)
+        finally:
+            cleanup_session()
+
+    def start_warmup():
+        threading.Thread(target=warm_up).start()
+    app.connect_event('application-setup-done', start_warmup)
+
+
+def _make_tiered(app, factory):
+    return TieredCache(factory(app), app.cfg['local_cache_max_items'],
+                       app.cfg['local_cache_max_size'] * 1024,
+                       app.cfg['local_cache_timeout'], app.cfg['cache_timeout'])
+
+
 #: the cache system factories.
 systems = {
     'null':         lambda app: NullCache(),
-    'simple':       lambda app: SimpleCache(app.cfg['cache_timeout']),
+    'simple':       lambda app: SimpleCache(default_timeout=
+                        app.cfg['cache_timeout']),
     'memcached':    lambda app: MemcachedCache([x.strip() for x in
                         app.cfg['memcached_servers']],
                         app.cfg['cache_timeout']),
     'filesystem':   lambda app: FileSystemCache(
                         os.path.join(app.instance_folder,
                                      app.cfg['filesystem_cache_path']), 500,
-                        app.cfg['cache_timeout'])
+                        app.cfg['cache_timeout']),
+    'sqlite':       lambda app: SQLiteCache(
+                        os.path.join(app.instance_folder,
+                                     app.cfg['sqlite_cache_path']),
+                        app.cfg['sqlite_cache_max_items'],
+                        app.cfg['cache_timeout']),
+    'memcached_local':  lambda app: _make_tiered(app, systems['memcached']),
+    'filesystem_local': lambda app: _make_tiered(app, systems['filesystem'])
 }
+
+
+session_extensions.append(SlugInvalidationExtension())
@@ -42,6 +42,28 @@ DEFAULT_VARS = {
     'database_debug':           BooleanField(default=False, help_text=l_(
         u'If enabled, the database will collect all SQL statements and add '
         u'them to the bottom of the page for easier debugging.')),
+    'database_profile':         BooleanField(default=False, help_text=l_(
+        u'If enabled, the SQL statements of sampled requests are collected '
+        u'in the query profile.')),
+    'database_profile_sample_rate': IntegerField(default=10, min_value=0,
+                                                 max_value=100),
+    'database_profile_n_plus_one': IntegerField(default=10, min_value=1),
+    'database_pool_size':       IntegerField(default=5, min_value=1),
+    'database_pool_max_overflow': IntegerField(default=10, min_value=0),
+    'database_pool_timeout':    IntegerField(default=30, min_value=1),
+    'database_pool_recycle':    IntegerField(default=-1, min_value=-1,
+                                             help_text=l_(
+        u'Connections older than this many seconds are replaced.  -1 '
+        u'disables recycling.')),
+    'database_pool_pre_ping':   BooleanField(default=False, help_text=l_(
+        u'If enabled, connections are tested before they are used so that '
+        u'a restart of the database server doesn\'t cause errors.')),
+    'database_replica_uris':    CommaSeparated(TextField(), default=list,
+                                               help_text=l_(
+        u'The URIs of read replicas of the database.  If given, read-only '
+        u'requests to the blog are answered from one of the replicas.')),
+    'database_replica_retry':   IntegerField(default=30, min_value=1),
+    'database_replica_lag':     IntegerField(default=10, min_value=0),
     'blog_title':               TextField(default=l_(u'My Zine Blog')),
     'blog_tagline':             TextField(default=l_(u'just another Zine blog')),
     'blog_url':                 TextField(default=u'', help_text=l_(
@@ -121,17 +143,41 @@ DEFAULT_VARS = {
 
     # cache settings
     'enable_eager_caching':     BooleanField(default=False),
+    'enable_page_cache':        BooleanField(default=False),
     'cache_timeout':            IntegerField(default=300, min_value=10),
+    'long_cache_timeout':       IntegerField(default=86400, min_value=10),
+    'cache_grace_time':         IntegerField(default=30, min_value=0),
     'cache_system':             ChoiceField(choices=[
         (u'null', l_(u'No Cache')),
         (u'simple', l_(u'Simple Cache')),
         (u'memcached', l_(u'memcached')),
-        (u'filesystem', l_(u'Filesystem'))
+        (u'filesystem', l_(u'Filesystem')),
+        (u'sqlite', l_(u'SQLite')),
+        (u'memcached_local', l_(u'memcached with local cache')),
+        (u'filesystem_local', l_(u'Filesystem with local cache'))
     ], default=u'null'),
     'memcached_servers':        CommaSeparated(TextField(
                                                     validators=[is_netaddr()]),
                                                default=list),
     'filesystem_cache_path':    TextField(default=u'cache'),
+    'sqlite_cache_path':        TextField(default=u'cache.db'),
+    'sqlite_cache_max_items':   IntegerField(default=10000, min_value=1),
+    'local_cache_timeout':      IntegerField(default=5, min_value=1),
+    'local_cache_max_items':    IntegerField(default=1000, min_value=1),
+    'local_cache_max_size':     IntegerField(default=16384, min_value=1),
+    'cache_warmup_on_setup':    BooleanField(default=False),
+    'cache_warmup_pages':       IntegerField(default=3, min_value=0),
+    'cache_warmup_entries':     IntegerField(default=10, min_value=0),
+    'cache_warmup_feeds':       BooleanField(default=True),
+    'cache_warmup_urls':        CommaSeparated(TextField(), default=list),
+    'cache_warmup_concurrency': IntegerField(default=2, min_value=1),
+
+    # search settings.  The choices of the engine are set by the application
+    'search_engine':            ChoiceField(default=u'database', help_text=l_(
+        u'Run the rebuild-search-index script after changing this.')),
+    'search_language':          TextField(default=u'simple', help_text=l_(
+        u'The text search configuration of PostgreSQL, for example '
+        u'“english”.')),
 
     # the default markup parser. Don't ever change the default value! The
     # htmlprocessor module bypasses this test when falling back to
@@ -147,6 +193,10 @@ DEFAULT_VARS = {
         (1, l_(u'An administrator must always approve the comment')),
         (2, l_(u'Automatically approve comments by known comment authors'))
                                             ], default=1),
+    'comment_moderation_events': BooleanField(default=False, help_text=l_(
+        u'If enabled, the moderation of many comments at once emits the '
+        u'events for every comment.  This is slower but plugins like the '
+        u'Akismet spam filter need it to learn from the moderation.')),
     'comments_open_for':        IntegerField(default=0, help_text=l_(
         u'The number of days commenting is possible.  If set to zero, comments '
         u'will be open forever.')),
@@ -160,6 +210,10 @@ DEFAULT_VARS = {
         u'The number of posts that are shown on a page.  This value might not be '
         u'honored by some themes and is probably only used for the index page.')),
     'use_flat_comments':        BooleanField(default=False),
+    'comments_per_page':        IntegerField(default=0, min_value=0,
+                                             help_text=l_(
+        u'The number of comment threads that are shown on a page.  If set to '
+        u'0 all comments are shown on one page.')),
     'index_content_types':      CommaSeparated(TextField(),
                                                default=lambda: [u'entry']),
 
@@ -464,6 +518,8 @@ class Configuration(object):
                     value = '****'
                 elif key == 'database_uri':
                     value = repr(secure_database_uri(value))
+                elif key == 'database_replica_uris':
+                    value = repr([secure_database_uri(x) for x in value])
                 else:
                     #! this event is emitted if the application wants to
                     #! display a configuration value in a publicly.  The
@@ -627,3 +683,12 @@ class ConfigTransaction(object):
         finally:
             self.cfg._lock.release()
         self._committed = True
+
+        # everything in the cache may depend on the configuration or the
+        # theme, so the tag all cached items carry is invalidated.
+        from zine.application import get_application
+        app = get_application()
+        if app is not None and app.cfg is self.cfg and \
+           getattr(app, 'cache', None) is not None:
+            from zine.cache import invalidate_tags, CONFIG_TAG
+            invalidate_tags(CONFIG_TAG)
@@ -0,0 +1,310 @@
+# -*- coding: utf-8 -*-
+"""
+    zine.counters
+    ~~~~~~~~~~~~~
+
+    This module keeps the numbers of posts and comments the blog shows on
+    every page in the `counters` table so that they don't have to be
+    counted for every request.  A counter is identified by a scope and a
+    name:
+
+    ``posts``
+        ``author/<user_id>``: all posts of an author.
+        ``published/<content_type>``: the published posts of a type.
+        ``published/author/<user_id>``, ``published/category/<category_id>``
+        and ``published/tag/<tag_id>``: the published posts of an author,
+        a category or a tag.
+
+    ``comments``
+        ``status/<status>``: the comments with a status.
+        ``status/<status>/author/<user_id>``: the comments with a status on
+        the posts of an author.
+
+    ``redirects``
+        ``version``: incremented whenever the redirects change, see
+        :mod:`zine.utils.redirects`.  Counters like this one don't count
+        items, they start with the first change.
+
+    The published counters include posts with a publication date in the
+    future, see :meth:`~zine.models.Post.query.count_published`.
+
+    The counters are updated in the same transaction as the posts and
+    comments, counters that don't exist yet are created when they change
+    the first time (if another transaction created the counter in the
+    meantime it's updated instead).  Until then the items are counted when the counter is
+    read.  If the counters get out of sync because the database was
+    changed by hand, :func:`repair_counters` or the ``repair-counters``
+    script recompute them.
+
+    :copyright: (c) 2010 by the Zine Team, see AUTHORS for more details.
+    :license: BSD, see LICENSE for more details.
+"""
+import re
+
+from sqlalchemy.exceptions import IntegrityError
+from sqlalchemy.orm.attributes import get_history
+from sqlalchemy.orm.interfaces import SessionExtension
+
+from zine.database import db, counters, posts, comments, post_categories, \
+     post_tags, session_extensions
+from zine.models import Post, Comment, STATUS_PUBLISHED
+
+
+def get_counts(scope, queries):
+    """Return a dict with the values of the counters in a scope.  `queries`
+    is a dict that maps the counter names to queries that count the items
+    if the counter doesn't exist yet.
+    """
+    names = list(queries)
+    if not names:
+        return {}
+    rv = dict(db.execute(db.select([counters.c.name, counters.c.value],
+        (counters.c.scope == scope) & counters.c.name.in_(names))).fetchall())
+    for name in names:
+        if name not in rv:
+            rv[name] = queries[name].count()
+    return rv
+
+
+def get_count(scope, name, query):
+    """Return the value of a single counter.  `query` counts the items if
+    the counter doesn't exist yet.
+    """
+    return get_counts(scope, {name: query})[name]
+
+
+def _values(obj, key):
+    """Return the old and new values of an attribute as lists."""
+    history = get_history(obj, key)
+    unchanged = list(history.unchanged or ())
+    return unchanged + list(history.deleted or ()), \
+           unchanged + list(history.added or ())
+
+
+def _post_names(status, content_type, author_id, categories, tags):
+    """The counters a post with the given values is counted in."""
+    names = []
+    if author_id is not None:
+        names.append('author/%d' % author_id)
+    if status == STATUS_PUBLISHED:
+        names.append('published/%s' % content_type)
+        if author_id is not None:
+            names.append('published/author/%d' % author_id)
+        names.extend('published/category/%d' % x.id for x in categories)
+        names.extend('published/tag/%d' % x.id for x in tags)
+    return [('posts', name) for name in names]
+
+
+def _comment_names(status, post):
+    """The counters a comment with the given values is counted in."""
+    if status is None or post is None:
+        return []
+    names = ['status/%d' % status]
+    if post.author_id is not None:
+        names.append('status/%d/author/%d' % (status, post.author_id))
+    return [('comments', name) for name in names]
+
+
+def _get_changes(obj, is_new, is_deleted):
+    """Return the counters an object was and is counted in."""
+    def first(values):
+        if values:
+            return values[0]
+    if isinstance(obj, Post):
+        status, content_type, author_id, categories, tags = \
+            [_values(obj, key) for key in ('status', 'content_type',
+                                           'author_id', 'categories',
+                                           'tags')]
+        old = _post_names(first(status[0]), first(content_type[0]),
+                          first(author_id[0]), categories[0], tags[0])
+        new = _post_names(first(status[1]), first(content_type[1]),
+                          first(author_id[1]), categories[1], tags[1])
+        # the comments of a post are counted for the author of the post
+        old_author, new_author = first(author_id[0]), first(author_id[1])
+        if not is_new and not is_deleted and old_author != new_author:
+            for comment in obj.comments:
+                comment_status = first(_values(comment, '_status')[0])
+                if comment_status is None:
+                    continue
+                if old_author is not None:
+                    old.append(('comments', 'status/%d/author/%d' %
+                                (comment_status, old_author)))
+                if new_author is not None:
+                    new.append(('comments', 'status/%d/author/%d' %
+                                (comment_status, new_author)))
+    elif isinstance(obj, Comment):
+        status, post = _values(obj, '_status'), _values(obj, 'post')
+        old = _comment_names(first(status[0]), first(post[0]))
+        new = _comment_names(first(status[1]), first(post[1]))
+    else:
+        return (), ()
+    if is_new:
+        old = []
+    if is_deleted:
+        new = []
+    return old, new
+
+
+def _get_families():
+    """Return the counter families as a list of ``(scope, format, columns,
+    from_obj, where)`` tuples.  The counters of a family are counted with
+    one query that groups by `columns`, the names of the counters are
+    created by formatting `format` with the column values.
+    """
+    published = posts.c.status == STATUS_PUBLISHED
+    return [
+        ('posts', 'author/%d', [posts.c.author_id], [posts], None),
+        ('posts', 'published/%s', [posts.c.content_type], [posts],
+         published),
+        ('posts', 'published/author/%d', [posts.c.author_id], [posts],
+         published),
+        ('posts', 'published/category/%d', [post_categories.c.category_id],
+         [post_categories.join(posts)], published),
+        ('posts', 'published/tag/%d', [post_tags.c.tag_id],
+         [post_tags.join(posts)], published),
+        ('comments', 'status/%d', [comments.c.status], [comments], None),
+        ('comments', 'status/%d/author/%d', [comments.c.status,
+         posts.c.author_id], [comments.join(posts, comments.c.post_id ==
+                                            posts.c.post_id)], None)
+    ]
+
+
+def _count_family(scope, format, columns, from_obj, where):
+    """Count the counters of a family.  Returns a dict that maps ``(scope,
+    name)`` tuples to the values.
+    """
+    query = db.select(columns + [db.func.count()], where, from_obj=from_obj,
+                      group_by=columns)
+    result = {}
+    for row in db.execute(query):
+        row = tuple(row)
+        if None not in row[:-1]:
+            result[scope, format % tuple(row[:-1])] = row[-1]
+    return result
+
+
+def _match_family(families, scope, name):
+    """Return the family a counter belongs to."""
+    for family in families:
+        if family[0] == scope and \
+           re.match(re.escape(family[1]).replace('\\%d', r'\d+')
+                                        .replace('\\%s', '[^/]+') + '$',
+                    name):
+            return family
+
+
+def apply_deltas(session, deltas):
+    """Apply changes to the counters.  `deltas` is a dict that maps
+    ``(scope, name)`` tuples to the value that is added to the counter.
+    The changed items must already be in the database because counters
+    that don't exist yet are counted instead.  Counters that don't count
+    items are created with the delta.
+    """
+    if not deltas:
+        return
+
+    def apply_delta(scope, name, delta):
+        if delta:
+            session.execute(counters.update(
+                (counters.c.scope == scope) & (counters.c.name == name),
+                values={counters.c.value: counters.c.value + delta}))
+
+    existing = set()
+    for scope in set(scope for scope, name in deltas):
+        existing.update((scope, name) for name, in session.execute(
+            db.select([counters.c.name], (counters.c.scope == scope) &
+                      counters.c.name.in_([name for key, name in deltas
+                                           if key == scope]))))
+    for (scope, name), delta in deltas.iteritems():
+        if (scope, name) in existing:
+            apply_delta(scope, name, delta)
+
+    # counters that don't exist yet are counted.  The changes are already
+    # in the database, so the deltas are not applied.
+    missing = set(deltas).difference(existing)
+    if not missing:
+        return
+    families = _get_families()
+    counted = []
+    values = {}
+    for scope, name in missing:
+        family = _match_family(families, scope, name)
+        if family is not None and family not in counted:
+            values.update(_count_family(*family))
+            counted.append(family)
+
+    # another transaction may create the same counter at the same time.
+    # The counters are inserted one by one and if the insert fails the
+    # counter was created by the other transaction (which didn't see our
+    # changes), so the delta is applied instead.  SQLite locks the whole
+    # database for writing and doesn't need that, the other databases
+    # get a savepoint so that the error doesn't abort the transaction.
+    connection = session.connection()
+    use_savepoint = connection.dialect.name != 'sqlite'
+    for scope, name in missing:
+        if _match_family(families, scope, name) is None:
+            value = deltas[scope, name]
+        else:
+            value = values.get((scope, name), 0)
+        savepoint = use_savepoint and connection.begin_nested() or None
+        try:
+            connection.execute(counters.insert(), scope=scope, name=name,
+                               value=value)
+        except IntegrityError:
+            if savepoint is not None:
+                savepoint.rollback()
+            apply_delta(scope, name, deltas[scope, name])
+        else:
+            if savepoint is not None:
+                savepoint.commit()
+
+
+class CounterExtension(SessionExtension):
+    """Updates the counters when posts or comments are flushed."""
+
+    def after_flush(self, session, flush_context):
+        deltas = {}
+        for state, (is_deleted, list_only) in flush_context.states.items():
+            obj = state.obj()
+            if list_only or obj is None:
+                continue
+            old, new = _get_changes(obj, state.key is None, is_deleted)
+            for key in old:
+                deltas[key] = deltas.get(key, 0) - 1
+            for key in new:
+                deltas[key] = deltas.get(key, 0) + 1
+        apply_deltas(session, deltas)
+
+
+def repair_counters():
+    """Recompute all counters and fix the ones that are out of sync.  This
+    returns the number of counters that were created or changed.  The
+    changes are not committed.  Counters that don't count items are left
+    alone.
+    """
+    families = _get_families()
+    values = {}
+    for family in families:
+        values.update(_count_family(*family))
+
+    changed = 0
+    for scope, name, value in db.execute(db.select([counters.c.scope,
+                                                    counters.c.name,
+                                                    counters.c.value])) \
+                                .fetchall():
+        if _match_family(families, scope, name) is None:
+            continue
+        new_value = values.pop((scope, name), 0)
+        if new_value != value:
+            db.execute(counters.update((counters.c.scope == scope) &
+                                       (counters.c.name == name)),
+                       dict(value=new_value))
+            changed += 1
+    if values:
+        db.execute(counters.insert(), [dict(scope=scope, name=name,
+                                            value=value) for (scope, name),
+                                       value in values.iteritems()])
+    return changed + len(values)
+
+
+session_extensions.append(CounterExtension())
@@ -19,21 +19,29 @@ import time
 from os import path
 from types import ModuleType
 from copy import deepcopy
+from datetime import date, datetime
+from itertools import count
 
 import sqlalchemy
+import sqlalchemy.pool
 from sqlalchemy import orm
-from sqlalchemy.interfaces import ConnectionProxy
+from sqlalchemy.interfaces import ConnectionProxy, PoolListener
 from sqlalchemy.orm.interfaces import AttributeExtension
 from sqlalchemy.exc import ArgumentError
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.engine.url import make_url, URL
 from sqlalchemy.types import TypeDecorator
+try:
+    from sqlalchemy.sql.expression import UpdateBase
+except ImportError:
+    from sqlalchemy.sql.expression import _UpdateBase as UpdateBase
 from sqlalchemy.ext.associationproxy import association_proxy
 
 from werkzeug import url_decode
 from werkzeug.exceptions import NotFound
 
 from zine.utils import local_manager
+from zine.utils.datastructures import ThreadBuckets
 
 
 if sys.platform == 'win32':
@@ -56,13 +64,105 @@ def get_engine():
     return get_application().database_engine
 
 
-def create_engine(uri, relative_to=None, debug=False):
+#: the fields of the pool statistics
+POOL_STATS_FIELDS = ('checkouts', 'wait_time', 'max_wait_time', 'overflows',
+                     'timeouts', 'disconnects')
+CHECKOUTS, WAIT_TIME, MAX_WAIT_TIME, OVERFLOWS, TIMEOUTS, DISCONNECTS = \
+    range(len(POOL_STATS_FIELDS))
+
+
+def _merge_pool_stats(target, counters):
+    for field, value in counters.items():
+        if field == MAX_WAIT_TIME:
+            target[field] = max(target.get(field, 0), value)
+        else:
+            target[field] = target.get(field, 0) + value
+
+
+# like the cache statistics the pool statistics are counted per thread
+# and summed up by `get_pool_stats`.
+_pool_stats = ThreadBuckets(dict, _merge_pool_stats)
+
+
+def _count_pool(field, value=1):
+    """Increment a pool statistics counter."""
+    _merge_pool_stats(_pool_stats.get(), {field: value})
+
+
+class InstrumentedQueuePool(sqlalchemy.pool.QueuePool):
+    """A queue pool that records how long checkouts wait for a connection
+    and how often the pool has to overflow.
+    """
+
+    def _do_get(self):
+        overflow = self.overflow()
+        start = _timer()
+        try:
+            return sqlalchemy.pool.QueuePool._do_get(self)
+        except sqlalchemy.exc.TimeoutError:
+            _count_pool(TIMEOUTS)
+            raise
+        finally:
+            wait_time = _timer() - start
+            _count_pool(CHECKOUTS)
+            _count_pool(WAIT_TIME, wait_time)
+            _count_pool(MAX_WAIT_TIME, wait_time)
+            if self.overflow() > max(overflow, 0):
+                _count_pool(OVERFLOWS)
+
+
+class PingListener(PoolListener):
+    """Pings connections when they are checked out of the pool.  If the
+    database went away in the meantime the pool replaces the connection
+    instead of handing out a dead one.
+    """
+
+    def checkout(self, dbapi_con, con_record, con_proxy):
+        try:
+            cursor = dbapi_con.cursor()
+            try:
+                cursor.execute('SELECT 1')
+            finally:
+                cursor.close()
+        except Exception:
+            _count_pool(DISCONNECTS)
+            raise sqlalchemy.exc.DisconnectionError()
+
+
+def get_pool_stats(engine=None):
+    """Return the statistics of the connection pool of an engine (by
+    default the one of the active application) in this process.  Besides
+    the counters from `POOL_STATS_FIELDS` the dict contains the current
+    `pool_size`, the connections `in_use` and the current `overflow` if
+    the pool provides them, and the `average_wait_time`.
+    """
+    if engine is None:
+        engine = get_engine()
+    totals = _pool_stats.total()
+    rv = dict((name, totals.get(idx, 0)) for idx, name
+              in enumerate(POOL_STATS_FIELDS))
+    rv['average_wait_time'] = rv['checkouts'] and \
+        rv['wait_time'] / rv['checkouts'] or 0.0
+    pool = engine.pool
+    rv['pool_class'] = pool.__class__.__name__
+    if isinstance(pool, sqlalchemy.pool.QueuePool):
+        rv.update(pool_size=pool.size(), in_use=pool.checkedout(),
+                  overflow=max(pool.overflow(), 0))
+    return rv
+
+
+def create_engine(uri, relative_to=None, debug=False, pool_options=None):
     """Create a new engine.  This works a bit like SQLAlchemy's
     `create_engine` with the difference that it automaticaly set's MySQL
     engines to 'utf-8', and paths for SQLite are relative to the path
     provided as `relative_to`.
 
     Furthermore the engine is created with `convert_unicode` by default.
+
+    `pool_options` is a dict with the ``pool_size``, ``max_overflow``,
+    ``pool_timeout``, ``pool_recycle`` and ``pool_pre_ping`` settings of
+    the connection pool (see :func:`get_pool_options`).  The size related
+    options are ignored for SQLite which doesn't use a queue pool.
     """
     # special case sqlite.  We want nicer urls for that one.
     if uri.startswith('sqlite:'):
@@ -89,18 +189,26 @@ def create_engine(uri, relative_to=None, debug=False):
             info.query.setdefault('charset', 'utf8')
 
     options = {'convert_unicode': True}
-
-    # alternative pool sizes / recycle settings and more.  These are
-    # interpreter wide and not from the config for the following reasons:
-    #
-    # - system administrators can set it independently from the webserver
-    #   configuration via SetEnv and friends.
-    # - this setting is deployment dependent should not affect a development
-    #   server for the same instance or a development shell
-    for key in 'pool_size', 'pool_recycle', 'pool_timeout':
-        value = os.environ.get('ZINE_DATABASE_' + key.upper())
+    pool_options = dict(pool_options or ())
+
+    # the environment variables still override the pool sizes and recycle
+    # settings of the configuration so that system administrators can set
+    # them independently from the webserver configuration via SetEnv and
+    # friends, for example to use smaller pools on a development server
+    # for the same instance.
+    for key in 'pool_size', 'max_overflow', 'pool_recycle', 'pool_timeout':
+        value = os.environ.get('ZINE_' + key.upper(),
+                               os.environ.get('ZINE_DATABASE_' + key.upper()))
         if value is not None:
-            options[key] = int(value)
+            pool_options[key] = int(value)
+
+    if pool_options.pop('pool_pre_ping', False):
+        options['listeners'] = [PingListener()]
+    if info.drivername != 'sqlite':
+        options['poolclass'] = InstrumentedQueuePool
+        options.update(pool_options)
+    elif 'pool_recycle' in pool_options:
+        options['pool_recycle'] = pool_options['pool_recycle']
 
     # if debugging is enabled, hook the ConnectionDebugProxy in
     if debug:
@@ -109,6 +217,19 @@ def create_engine(uri, relative_to=None, debug=False):
     return sqlalchemy.create_engine(info, **options)
 
 
+def get_pool_options(cfg):
+    """Return the pool options for :func:`create_engine` from a
+    configuration.
+    """
+    return {
+        'pool_size':        cfg['database_pool_size'],
+        'max_overflow':     cfg['database_pool_max_overflow'],
+        'pool_timeout':     cfg['database_pool_timeout'],
+        'pool_recycle':     cfg['database_pool_recycle'],
+        'pool_pre_ping':    cfg['database_pool_pre_ping']
+    }
+
+
 def secure_database_uri(uri):
     """Returns the database uri with confidental information stripped."""
     obj = make_url(uri)
@@ -124,21 +245,71 @@ def attribute_loaded(model, attribute):
     return attribute in model.__dict__
 
 
+#: the `strftime` formats for :func:`date_trunc`
+_trunc_formats = {
+    'year':     '%Y',
+    'month':    '%Y-%m',
+    'day':      '%Y-%m-%d'
+}
+
+
+def date_trunc(unit, column, dialect=None):
+    """Return an SQL expression that truncates the datetime `column` to its
+    year, month or day (`unit` is one of ``'year'``, ``'month'`` and
+    ``'day'``).  SQLite, PostgreSQL and MySQL use their own date functions,
+    other databases get an integer built from the extracted fields.  Use
+    :func:`parse_trunc_date` to convert the values to dates.
+    """
+    if unit not in _trunc_formats:
+        raise ValueError('unit must be year, month or day')
+    if dialect is None:
+        dialect = get_engine().dialect.name
+    format = _trunc_formats[unit]
+    if dialect == 'sqlite':
+        return sqlalchemy.func.strftime(format, column)
+    elif dialect in ('postgres', 'postgresql'):
+        return sqlalchemy.func.date_trunc(unit, column)
+    elif dialect == 'mysql':
+        return sqlalchemy.func.date_format(column, format)
+    rv = sqlalchemy.extract('year', column) * 10000
+    if unit != 'year':
+        rv += sqlalchemy.extract('month', column) * 100
+        if unit == 'day':
+            rv += sqlalchemy.extract('day', column)
+    return rv
+
+
+def parse_trunc_date(unit, value):
+    """Convert a value of a :func:`date_trunc` expression to a date."""
+    if isinstance(value, datetime):
+        return value.date()
+    elif isinstance(value, date):
+        return value
+    elif isinstance(value, basestring):
+        return datetime.strptime(value, _trunc_formats[unit]).date()
+    value = int(value)
+    return date(value // 10000, value // 100 % 100 or 1, value % 100 or 1)
+
+
 class ConnectionDebugProxy(ConnectionProxy):
-    """Helps debugging the database."""
+    """Helps debugging the database.  The statements are collected in the
+    `queries` list of the current request unless that is `None` because
+    the request is not profiled.
+    """
 
     def cursor_execute(self, execute, cursor, statement, parameters,
                        context, executemany):
+        from zine.application import get_request
+        request = get_request()
+        if request is None or getattr(request, 'queries', None) is None:
+            return execute(cursor, statement, parameters, context)
         start = _timer()
         try:
             return execute(cursor, statement, parameters, context)
         finally:
-            from zine.application import get_request
             from zine.utils.debug import find_calling_context
-            request = get_request()
-            if request is not None:
-                request.queries.append((statement, parameters, start,
-                                        _timer(), find_calling_context()))
+            request.queries.append((statement, parameters, start,
+                                    _timer(), find_calling_context()))
 
 
 class ZEMLParserData(TypeDecorator):
@@ -200,8 +371,129 @@ class Query(orm.Query):
         return rv
 
 
-session = orm.scoped_session(lambda: orm.create_session(get_engine(),
-                             autoflush=True, autocommit=False),
+class ReplicaSet(object):
+    """The engines of the read replicas.  They are handed out round-robin,
+    a replica that cannot be connected to is skipped for `retry_after`
+    seconds.  A replica that could be connected to is trusted for
+    `check_interval` seconds before it's checked again.
+    """
+
+    def __init__(self, engines, retry_after=30, check_interval=10):
+        self.engines = engines
+        self.retry_after = retry_after
+        self.check_interval = check_interval
+        self._failed = {}
+        self._checked = {}
+        self._counter = count()
+
+    def get_engine(self):
+        """Return a working replica engine or `None` if all replicas are
+        down.
+        """
+        now = time.time()
+        for x in xrange(len(self.engines)):
+            engine = self.engines[self._counter.next() % len(self.engines)]
+            failed = self._failed.get(engine)
+            if failed is not None and failed + self.retry_after > now:
+                continue
+            checked = self._checked.get(engine)
+            if checked is not None and checked + self.check_interval > now:
+                return engine
+            try:
+                engine.connect().close()
+            except sqlalchemy.exc.DBAPIError:
+                self._failed[engine] = now
+                self._checked.pop(engine, None)
+                continue
+            self._failed.pop(engine, None)
+            self._checked[engine] = now
+            return engine
+
+
+def _is_write(clause):
+    """Check if a statement changes the database."""
+    if isinstance(clause, UpdateBase):
+        return True
+    text = getattr(clause, 'text', None)
+    return isinstance(text, basestring) and \
+           text.lstrip()[:6].upper() in ('INSERT', 'UPDATE', 'DELETE')
+
+
+def _may_use_replica(app, request):
+    """Check if the queries of a request may go to a read replica.  That is
+    the case for GET and HEAD requests outside of the admin panel and the
+    account pages, unless the user changed something a moment ago.
+    """
+    if request is None or request.method not in ('GET', 'HEAD') or \
+       getattr(request, 'session', None) is None:
+        return False
+    for prefix in app.cfg['admin_url_prefix'], app.cfg['account_url_prefix']:
+        if request.path == prefix or request.path.startswith(prefix + '/'):
+            return False
+    return request.session.get('db_primary', 0) <= time.time()
+
+
+class Session(orm.Session):
+    """The session sends the queries of read-only requests to one of the
+    read replicas (``database_replica_uris`` in the configuration).  As
+    soon as the session flushes or executes a statement that writes, it
+    switches to the primary database for the rest of the request, and a
+    logged in user keeps reading from the primary for a few seconds so
+    that the changes are visible to them even if the replicas lag behind.
+    """
+
+    _primary = False
+    _replica = None
+    _written = False
+
+    def _use_primary(self):
+        self._primary = True
+        if self._written:
+            return
+        self._written = True
+        from zine.application import get_application, get_request
+        app = get_application()
+        request = get_request()
+        user = getattr(request, 'user', None)
+        if app is not None and app.database_replicas is not None and \
+           user is not None and user.is_somebody:
+            request.session['db_primary'] = int(time.time() +
+                                                app.cfg['database_replica_lag'])
+
+    def _get_replica(self):
+        if self._replica is None and not self._primary:
+            from zine.application import get_application, get_request
+            app = get_application()
+            if app is not None and app.database_replicas is not None and \
+               _may_use_replica(app, get_request()):
+                self._replica = app.database_replicas.get_engine()
+            if self._replica is None:
+                self._primary = True
+        return self._replica
+
+    def get_bind(self, mapper=None, clause=None):
+        if _is_write(clause):
+            self._use_primary()
+        elif not self._primary:
+            replica = self._get_replica()
+            if replica is not None:
+                return replica
+        return orm.Session.get_bind(self, mapper, clause)
+
+    def flush(self, objects=None):
+        if self.new or self.dirty or self.deleted:
+            self._use_primary()
+        return orm.Session.flush(self, objects)
+
+
+#: session extensions that are added to every new session.  Modules that
+#: have to react to flushes (like :mod:`zine.counters`) append to it.
+session_extensions = []
+
+session = orm.scoped_session(lambda: Session(bind=get_engine(),
+                             autoflush=True, autocommit=False,
+                             expire_on_commit=False,
+                             extension=session_extensions),
                              local_manager.get_ident)
 
 
@@ -249,13 +541,18 @@ db.Model = Model
 db.Query = Query
 db.get_engine = get_engine
 db.create_engine = create_engine
+db.get_pool_options = get_pool_options
+db.get_pool_stats = get_pool_stats
 db.session = session
 db.ZEMLParserData = ZEMLParserData
 db.mapper = mapper
 db.basic_mapper = orm.mapper
 db.association_proxy = association_proxy
 db.attribute_loaded = attribute_loaded
+db.date_trunc = date_trunc
+db.parse_trunc_date = parse_trunc_date
 db.AttributeExtension = AttributeExtension
+db.ReplicaSet = ReplicaSet
 
 #: called at the end of a request
 cleanup_session = session.remove
@@ -396,6 +693,35 @@ notification_subscriptions = db.Table('notification_subscriptions', metadata,
     db.UniqueConstraint('user_id', 'notification_system', 'notification_id')
 )
 
+counters = db.Table('counters', metadata,
+    db.Column('scope', db.String(40), primary_key=True),
+    db.Column('name', db.String(200), primary_key=True),
+    db.Column('value', db.Integer, nullable=False, default=0)
+)
+
+search_index = db.Table('search_index', metadata,
+    db.Column('word', db.String(60), primary_key=True),
+    db.Column('post_id', db.Integer, primary_key=True),
+    db.Column('weight', db.Integer, nullable=False)
+)
+
+# indexes for the common queries.  Existing databases get them from the
+# upgrade script 003_post_and_comment_indexes, keep both in sync.
+db.Index('ix_posts_status_pub_date', posts.c.status, posts.c.pub_date)
+db.Index('ix_posts_content_type_status_pub_date', posts.c.content_type,
+         posts.c.status, posts.c.pub_date)
+db.Index('ix_posts_author_id_pub_date', posts.c.author_id, posts.c.pub_date)
+db.Index('ix_comments_post_id_status', comments.c.post_id, comments.c.status,
+         comments.c.pub_date)
+db.Index('ix_comments_status_pub_date', comments.c.status, comments.c.pub_date)
+db.Index('ix_post_categories_post_id', post_categories.c.post_id,
+         post_categories.c.category_id)
+db.Index('ix_post_categories_category_id', post_categories.c.category_id,
+         post_categories.c.post_id)
+db.Index('ix_post_tags_post_id', post_tags.c.post_id, post_tags.c.tag_id)
+db.Index('ix_post_tags_tag_id', post_tags.c.tag_id, post_tags.c.post_id)
+db.Index('ix_search_index_post_id', search_index.c.post_id)
+
 
 def init_database(engine):
     """This is called from the websetup which explains why it takes an engine
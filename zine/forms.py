@@ -659,9 +659,17 @@ class CommentMassModerateForm(forms.Form):
             if comment.id in selection:
                 yield comment
 
+    def moderate_selection(self, action):
+        """Apply a moderation action to the selected comments with the
+        bulk moderation of :mod:`zine.moderation`.  Returns the result of
+        :func:`zine.moderation.moderate`.
+        """
+        from zine.moderation import moderate
+        return moderate(self.data['selected_comments'], action,
+                        get_application().cfg['comment_moderation_events'])
+
     def delete_selection(self):
-        for comment in self.iter_selection():
-            delete_comment(comment)
+        return self.moderate_selection('delete')
 
     def approve_selection(self, comment=None):
         if comment:
@@ -669,28 +677,16 @@ class CommentMassModerateForm(forms.Form):
             comment.status = COMMENT_MODERATED
             comment.blocked_msg = u''
         else:
-            for comment in self.iter_selection():
-                emit_event('before-comment-approved', comment)
-                comment.status = COMMENT_MODERATED
-                comment.blocked_msg = u''
+            return self.moderate_selection('approve')
 
     def block_selection(self):
-        for comment in self.iter_selection():
-            emit_event('before-comment-blocked', comment)
-            comment.status = COMMENT_BLOCKED_USER
-            comment.blocked_msg = _("Comment blocked by %s" %
-                                    get_request().user.display_name)
+        return self.moderate_selection('block')
 
     def mark_selection_as_spam(self):
-        for comment in self.iter_selection():
-            emit_event('before-comment-mark-spam', comment)
-            comment.status = COMMENT_BLOCKED_SPAM
-            comment.blocked_msg = _("Comment marked as spam by %s" %
-                                    get_request().user.display_name)
+        return self.moderate_selection('spam')
+
     def mark_selection_as_ham(self):
-        for comment in self.iter_selection():
-            emit_event('before-comment-mark-ham', comment)
-            self.approve_selection(comment)
+        return self.moderate_selection('ham')
 
 
 class _GroupBoundForm(forms.Form):
@@ -1086,6 +1082,9 @@ class BasicOptionsForm(_ConfigForm):
     use_flat_comments = config_field('use_flat_comments',
         lazy_gettext(u'Use flat comments'),
         help_text=lazy_gettext(u'All comments are posted top-level'))
+    comments_per_page = config_field('comments_per_page',
+        lazy_gettext(u'Comment threads per page'),
+        help_text=lazy_gettext(u'0 shows all comments on one page'))
     default_parser = config_field('default_parser',
                                   lazy_gettext(u'Default parser'))
     comment_parser = config_field('comment_parser',
@@ -1150,21 +1149,71 @@ class CacheOptionsForm(_ConfigForm):
     cache_system = config_field('cache_system', lazy_gettext(u'Cache system'))
     cache_timeout = config_field('cache_timeout',
                                  lazy_gettext(u'Default cache timeout'))
+    long_cache_timeout = config_field('long_cache_timeout',
+                                      lazy_gettext(u'Long cache timeout'))
+    cache_grace_time = config_field('cache_grace_time',
+                                    lazy_gettext(u'Grace time'))
     enable_eager_caching = config_field('enable_eager_caching',
                                         lazy_gettext(u'Enable eager caching'),
                                         help_text=lazy_gettext(u'Enable'))
+    enable_page_cache = config_field('enable_page_cache',
+                                     lazy_gettext(u'Enable page cache'),
+                                     help_text=lazy_gettext(u'Enable'))
     memcached_servers = config_field('memcached_servers')
     filesystem_cache_path = config_field('filesystem_cache_path')
+    sqlite_cache_path = config_field('sqlite_cache_path',
+                                     lazy_gettext(u'Database file'))
+    sqlite_cache_max_items = config_field('sqlite_cache_max_items',
+                                          lazy_gettext(u'Maximum items'))
+    local_cache_timeout = config_field('local_cache_timeout',
+                                       lazy_gettext(u'Local timeout'))
+    local_cache_max_items = config_field('local_cache_max_items',
+                                         lazy_gettext(u'Maximum items'))
+    local_cache_max_size = config_field('local_cache_max_size',
+                                        lazy_gettext(u'Maximum size (KB)'))
+    cache_warmup_on_setup = config_field('cache_warmup_on_setup',
+                                         lazy_gettext(u'Warm up on start'),
+                                         help_text=lazy_gettext(u'Enable'))
+    cache_warmup_pages = config_field('cache_warmup_pages',
+                                      lazy_gettext(u'Index pages'))
+    cache_warmup_entries = config_field('cache_warmup_entries',
+                                        lazy_gettext(u'Latest entries'))
+    cache_warmup_feeds = config_field('cache_warmup_feeds',
+                                      lazy_gettext(u'Feeds'),
+                                      help_text=lazy_gettext(u'Include the '
+                                          u'category and tag feeds'))
+    cache_warmup_urls = config_field('cache_warmup_urls',
+                                     lazy_gettext(u'Additional URLs'))
+    cache_warmup_concurrency = config_field('cache_warmup_concurrency',
+                                            lazy_gettext(u'Concurrent '
+                                                         u'requests'))
 
     def context_validate(self, data):
-        if data['cache_system'] == 'memcached':
+        if data['cache_system'] in ('memcached', 'memcached_local'):
             if not data['memcached_servers']:
                 raise ValidationError(_(u'You have to provide at least one '
                                         u'server to use memcached.'))
-        elif data['cache_system'] == 'filesystem':
+        elif data['cache_system'] in ('filesystem', 'filesystem_local'):
             if not data['filesystem_cache_path']:
                 raise ValidationError(_(u'You have to provide cache folder to '
                                         u'use filesystem cache.'))
+        elif data['cache_system'] == 'sqlite':
+            if not data['sqlite_cache_path']:
+                raise ValidationError(_(u'You have to provide a database file '
+                                        u'to use the SQLite cache.'))
+
+
+class QueryProfileForm(_ConfigForm):
+    """Configures the query profiler."""
+    database_profile = config_field('database_profile',
+                                    lazy_gettext(u'Enable query profiler'),
+                                    help_text=lazy_gettext(u'Enable'))
+    database_profile_sample_rate = config_field(
+        'database_profile_sample_rate',
+        lazy_gettext(u'Profiled requests (%)'))
+    database_profile_n_plus_one = config_field(
+        'database_profile_n_plus_one',
+        lazy_gettext(u'N+1 threshold'))
 
 
 class MaintenanceModeForm(forms.Form):
@@ -1315,7 +1364,11 @@ def make_notification_form(user):
     return _NotificationForm({'subscriptions': subscriptions})
 
 
-def make_import_form(blog):
+def make_import_form(dump, posts):
+    """Create the form for an `ImportDump`.  Only the `posts` (usually the
+    posts of one page of the dump) are on the form, if they are selected
+    is taken from the selection of the dump.
+    """
     user_choices = [('__zine_create_user', _(u'Create new user'))] + [
         (user.id, user.username)
         for user in User.query.order_by('username').all()
@@ -1323,17 +1376,17 @@ def make_import_form(blog):
 
     _authors = dict((author.id, forms.ChoiceField(author.username,
                                                   choices=user_choices))
-                    for author in blog.authors)
+                    for author in dump.authors)
     _posts = dict((post.id, forms.BooleanField(help_text=post.title)) for post
-                  in blog.posts)
+                  in posts)
     _comments = dict((post.id, forms.BooleanField()) for post
-                     in blog.posts)
+                     in posts)
 
     class _ImportForm(forms.Form):
         title = forms.BooleanField(lazy_gettext(u'Blog title'),
-                                   help_text=blog.title)
+                                   help_text=dump.title)
         description = forms.BooleanField(lazy_gettext(u'Blog description'),
-                                         help_text=blog.description)
+                                         help_text=dump.description)
         authors = forms.Mapping(_authors)
         posts = forms.Mapping(_posts)
         comments = forms.Mapping(_comments)
@@ -1342,11 +1395,19 @@ def make_import_form(blog):
                                          u'Load the configuration values '
                                          u'from the import.'))
 
+        def save_selection(self):
+            dump.update_selection(self.data)
+
         def perform_import(self):
             from zine.importers import perform_import
-            return perform_import(get_application(), blog, self.data,
+            self.save_selection()
+            return perform_import(get_application(), dump, self.data,
                                   stream=True)
 
-    _all_true = dict((x.id, True) for x in blog.posts)
-    return _ImportForm({'posts': _all_true.copy(),
-                        'comments': _all_true.copy()})
+    selection = dump.get_selection()
+    return _ImportForm({
+        'posts':    dict((x.id, x.id not in selection['posts'])
+                         for x in posts),
+        'comments': dict((x.id, x.id not in selection['comments'])
+                         for x in posts)
+    })
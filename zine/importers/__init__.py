@@ -7,22 +7,32 @@
     API as well as some core importers we implement as part of the software
     and not as plugin.
 
+    The importers write what they parsed into an import dump in the
+    `import_queue` folder of the instance.  A dump is a file of pickled
+    records: one per post (with its comments), followed by a trailer with
+    the details about the blog and the offsets of the post records, and a
+    footer with the offset of the trailer.  This way the posts never have
+    to be in memory at once, neither while parsing nor while inspecting or
+    importing the dump.
+
     :copyright: (c) 2010 by the Zine Team, see AUTHORS for more details.
     :license: BSD, see LICENSE for more details.
 """
 import os
+import struct
 try:
     from hashlib import md5
 except ImportError:
     from md5 import md5
 from time import time
+from tempfile import mkstemp
 from pickle import dump, load, HIGHEST_PROTOCOL
+from itertools import islice
 from datetime import datetime, MAXYEAR
 from zine.i18n import _
 from zine.database import db, posts
 from zine.utils.xml import escape
-from zine.utils.text import increment_string
-from zine.models import COMMENT_MODERATED, STATUS_PUBLISHED
+from zine.models import COMMENT_MODERATED, STATUS_PUBLISHED, allocate_slug
 from zine.privileges import BLOG_ADMIN, ENTER_ADMIN_PANEL, require_privilege
 
 
@@ -30,6 +40,13 @@ ignored_config_keys = frozenset(['database_uri'])
 
 _distant_future = datetime(MAXYEAR, 12, 31)
 
+#: the footer of a dump: the magic string and the offset of the trailer
+_dump_magic = 'ZINEDUMP'
+_dump_footer = struct.Struct('>8sQ')
+
+#: the number of posts loaded or imported at once
+BATCH_SIZE = 100
+
 
 def _make_id(*args):
     hash = md5()
@@ -40,6 +57,61 @@ def _make_id(*args):
     return hash.hexdigest()
 
 
+def _get_dump_path(app, id):
+    return os.path.join(app.instance_folder, 'import_queue', str(id))
+
+
+def _create_dump_file(app):
+    """Create the file for a new dump in the import queue.  Returns a tuple
+    in the form ``(id, path, f)`` where `f` is the open file ``path +
+    '.part'`` that is renamed to `path` once the dump is complete.  The ids
+    start with the current time and are increased until the name is free,
+    so dumps that are created in the same second don't replace each
+    other.
+    """
+    folder = os.path.join(app.instance_folder, 'import_queue')
+    try:
+        os.makedirs(folder)
+    except OSError:
+        pass
+    id = int(time())
+    while 1:
+        path = _get_dump_path(app, id)
+        if not os.path.exists(path):
+            try:
+                fd = os.open(path + '.part', os.O_CREAT | os.O_EXCL |
+                             os.O_WRONLY | getattr(os, 'O_BINARY', 0))
+            except OSError:
+                pass
+            else:
+                return id, path, os.fdopen(fd, 'wb')
+        id += 1
+
+
+def _finish_dump_file(path, f, success):
+    """Close a file returned by :func:`_create_dump_file` and rename it to
+    the dump or remove it if the dump failed.
+    """
+    f.close()
+    if success:
+        os.rename(path + '.part', path)
+    else:
+        os.remove(path + '.part')
+
+
+def _read_trailer_offset(f):
+    """Return the offset of the trailer or `None` if the file is a dump
+    of an older Zine version that is the pickled `Blog`.
+    """
+    f.seek(0, 2)
+    if f.tell() < _dump_footer.size:
+        return None
+    f.seek(-_dump_footer.size, 2)
+    magic, offset = _dump_footer.unpack(f.read(_dump_footer.size))
+    if magic == _dump_magic:
+        return offset
+
+
 def list_import_queue(app):
     """Return a list of all items in the import queue."""
     path = os.path.join(app.instance_folder, 'import_queue')
@@ -50,8 +122,10 @@ def list_import_queue(app):
         if not id.isdigit():
             continue
         filename = os.path.join(path, id)
-        f = file(filename)
+        f = file(filename, 'rb')
         try:
+            offset = _read_trailer_offset(f)
+            f.seek(offset or 0)
             d = load(f)
         finally:
             f.close()
@@ -65,31 +139,62 @@ def list_import_queue(app):
 
 
 def load_import_dump(app, id):
-    """Load an import dump."""
-    path = os.path.join(app.instance_folder, 'import_queue', str(id))
+    """Load an import dump.  Returns an `ImportDump` or `None`.  Dumps
+    of older Zine versions (a pickled `Blog`) are converted into a copy
+    in the new format the first time they are loaded, the original file
+    is left untouched.
+    """
+    path = _get_dump_path(app, id)
     if not os.path.isfile(path):
         return
     f = file(path, 'rb')
     try:
-        load(f)
-        blog = load(f)
+        if _read_trailer_offset(f) is not None:
+            return ImportDump(path)
     finally:
         f.close()
-    if isinstance(blog, Blog):
-        return blog
+
+    converted = path + '.converted'
+    if not os.path.isfile(converted) or \
+       os.path.getmtime(converted) < os.path.getmtime(path):
+        f = file(path, 'rb')
+        try:
+            d = load(f)
+            blog = load(f)
+        finally:
+            f.close()
+        if not isinstance(blog, Blog):
+            return
+        fd, tmp_filename = mkstemp(dir=os.path.dirname(path))
+        f = os.fdopen(fd, 'wb')
+        try:
+            try:
+                blog.dump(f, d.get('importer'))
+            finally:
+                f.close()
+        except:
+            os.remove(tmp_filename)
+            raise
+        if os.name == 'nt' and os.path.exists(converted):
+            os.remove(converted)
+        os.rename(tmp_filename, converted)
+    return ImportDump(converted)
 
 
 def delete_import_dump(app, id):
     """Delete an import dump."""
-    path = os.path.join(app.instance_folder, 'import_queue', str(id))
-    if os.path.isfile(path):
-        os.remove(path)
+    path = _get_dump_path(app, id)
+    for filename in path, path + '.selection', path + '.converted', \
+                    path + '.converted.selection':
+        if os.path.isfile(filename):
+            os.remove(filename)
 
 
-def _perform_import(app, blog, d):
+def _perform_import(app, dump, d):
     # import models here because they have the same names as our
     # importer objects this module exports
     from zine.models import User, Tag, Category, Post, Comment
+    selection = dump.get_selection()
     author_mapping = {}
     tag_mapping = {}
     category_mapping = {}
@@ -113,6 +218,15 @@ def _perform_import(app, blog, d):
             author_mapping[author.id] = user
         return author_mapping[author.id]
 
+    def is_selected(key, post):
+        """Check if the post or its comments (depending on `key`) are
+        selected in the form data or otherwise in the dump.
+        """
+        value = d.get(key, {}).get(post.id)
+        if value is None:
+            return post.id not in selection[key]
+        return value
+
     def prepare_tag(tag):
         """Get a tag for a tag."""
         t = tag_mapping.get(tag.slug)
@@ -152,86 +266,98 @@ def _perform_import(app, blog, d):
 
     # update blog configuration if user wants that
     if d['title']:
-        app.cfg.change_single('blog_title', blog.title)
+        app.cfg.change_single('blog_title', dump.title)
         yield u'<li>%s</li>\n' % _('set blog title from dump')
     if d['description']:
-        app.cfg.change_single('blog_tagline', blog.description)
+        app.cfg.change_single('blog_tagline', dump.description)
         yield u'<li>%s</li>\n' % _('set blog tagline from dump')
 
-    # convert the posts now
-    for old_post in blog.posts:
-        # in theory that will never happen because there are no
-        # checkboxes for already imported posts on the form, but
-        # who knows what users manage to do and also skip posts
-        # we don't want converted
-        if old_post.already_imported or not d['posts'][old_post.id]:
-            continue
-
-        slug = old_post.slug
-        while Post.query.autoflush(False).filter_by(slug=slug) \
-                  .limit(1).count():
-            slug = increment_string(slug)
-        post = Post(old_post.title, prepare_author(old_post.author),
-                    old_post.text, slug, old_post.pub_date,
-                    old_post.updated, old_post.comments_enabled,
-                    old_post.pings_enabled, parser=old_post.parser,
-                    uid=old_post.uid, content_type=old_post.content_type,
-                    status=old_post.status, extra=old_post.extra)
-        if old_post.parser_data is not None:
-            post.parser_data.clear()
-            post.parser_data.update(old_post.parser_data)
-        yield u'<li><strong>%s</strong>' % escape(post.title)
-
-        for tag in old_post.tags:
-            post.tags.append(prepare_tag(tag))
-            yield u'.'
-
-        for category in old_post.categories:
-            post.categories.append(prepare_category(category))
-            yield u'.'
-
-        # now the comments if user wants them.
-        if d['comments'][old_post.id]:
-            to_create = set(old_post.comments)
-            created = {}
-
-            def _create_comment(comment):
-                parent = None
-                if comment.parent is not None:
-                    if comment.parent in created:
-                        parent = created[comment.parent]
-                    else:
-                        parent = _create_comment(comment.parent)
-                    to_create.discard(comment.parent)
-                if isinstance(comment.author, Author):
-                    author = prepare_author(comment.author)
-                else:
-                    author = comment.author
-                rv = Comment(post, author, comment.body,
-                             comment.author_email, comment.author_url, parent,
-                             comment.pub_date, comment.remote_addr,
-                             comment.parser, comment.is_pingback,
-                             comment.status)
-                if comment.blocked_msg:
-                    rv.blocked_msg = comment.blocked_msg
-                created[comment] = rv
-                return rv
-
-            while to_create:
-                _create_comment(to_create.pop())
+    # convert the posts now.  The posts are read from the dump in
+    # batches and flushed every BATCH_SIZE posts so that neither the posts
+    # of the dump nor the new models have to be in memory at once.  All
+    # of them are committed in one transaction at the end, if anything
+    # goes wrong nothing of the import ends up in the blog.
+    converted = 0
+    try:
+        for old_post in dump.iter_posts():
+            # in theory that will never happen because there are no
+            # checkboxes for already imported posts on the form, but
+            # who knows what users manage to do and also skip posts
+            # we don't want converted
+            if old_post.already_imported or \
+               not is_selected('posts', old_post):
+                continue
+
+            slug = allocate_slug(posts.c.slug, old_post.slug)
+            post = Post(old_post.title, prepare_author(old_post.author),
+                        old_post.text, slug, old_post.pub_date,
+                        old_post.updated, old_post.comments_enabled,
+                        old_post.pings_enabled, parser=old_post.parser,
+                        uid=old_post.uid,
+                        content_type=old_post.content_type,
+                        status=old_post.status, extra=old_post.extra)
+            if old_post.parser_data is not None:
+                post.parser_data.clear()
+                post.parser_data.update(old_post.parser_data)
+            yield u'<li><strong>%s</strong>' % escape(post.title)
+
+            for tag in old_post.tags:
+                post.tags.append(prepare_tag(tag))
                 yield u'.'
 
-        yield u' <em>%s</em></li>\n' % _('done')
+            for category in old_post.categories:
+                post.categories.append(prepare_category(category))
+                yield u'.'
 
-    # send to the database
-    yield u'<li>%s' % _('Committing transaction...')
-    db.commit()
+            # now the comments if user wants them.
+            if is_selected('comments', old_post):
+                to_create = set(old_post.comments)
+                created = {}
+
+                def _create_comment(comment):
+                    parent = None
+                    if comment.parent is not None:
+                        if comment.parent in created:
+                            parent = created[comment.parent]
+                        else:
+                            parent = _create_comment(comment.parent)
+                        to_create.discard(comment.parent)
+                    if isinstance(comment.author, Author):
+                        author = prepare_author(comment.author)
+                    else:
+                        author = comment.author
+                    rv = Comment(post, author, comment.body,
+                                 comment.author_email, comment.author_url,
+                                 parent, comment.pub_date, comment.remote_addr,
+                                 comment.parser, comment.is_pingback,
+                                 comment.status)
+                    if comment.blocked_msg:
+                        rv.blocked_msg = comment.blocked_msg
+                    created[comment] = rv
+                    return rv
+
+                while to_create:
+                    _create_comment(to_create.pop())
+                    yield u'.'
+
+            yield u' <em>%s</em></li>\n' % _('done')
+
+            converted += 1
+            if converted % BATCH_SIZE == 0:
+                db.flush()
+
+        # send to the database
+        yield u'<li>%s' % _('Committing transaction...')
+        db.commit()
+    except:
+        db.rollback()
+        raise
 
     # write config if we have
     if d['load_config']:
         yield u'<li>%s' % _('Updating configuration...')
         t = app.cfg.edit()
-        for key, value in blog.config.iteritems():
+        for key, value in dump.configuration.iteritems():
             if key in t and key not in ignored_config_keys:
                 t.set_from_string(key, value)
         t.commit()
@@ -239,12 +365,15 @@ def _perform_import(app, blog, d):
     yield u' <em>%s</em></li></ul>' % _('done')
 
 
-def perform_import(app, blog, data, stream=False):
-    """Perform an import from form data.  This function was designed to be
+def perform_import(app, dump, data, stream=False):
+    """Perform an import of an `ImportDump` from form data.  The posts and
+    comments that are not in the `posts` and `comments` mappings of the
+    data are imported if they are selected in the dump (see
+    :meth:`ImportDump.update_selection`).  This function was designed to be
     called from a web request, if you call it form outside, make sure the
     config is flushed afterwards.
     """
-    generator = _perform_import(app, blog, data)
+    generator = _perform_import(app, dump, data)
 
     # ignore the debug output, just do the import
     if not stream:
@@ -257,7 +386,9 @@ def perform_import(app, blog, data, stream=False):
 def rewrite_import(app, id, callback, title='Modified Import'):
     """Calls a callback with the blog from the dump `id` for rewriting.  The
     callback can modify the blog in place (it's passed as first argument) and
-    the changes are written back to the filesystem as new dump.
+    the changes are written back to the filesystem as new dump, its id is
+    returned.  Unlike the importers this loads all the posts of the dump
+    into memory.
 
     `app` can either be a `Zine` object that is also bound to the active
     thread or a string with the path to the instance folder.  The latter is
@@ -267,14 +398,16 @@ def rewrite_import(app, id, callback, title='Modified Import'):
         from zine import setup
         app = setup(app)
 
-    blog = load_import_dump(app, id)
+    blog = load_import_dump(app, id).to_blog()
     callback(blog)
-    f = file(os.path.join(app.instance_folder, 'import_queue',
-                          '%d' % time()), 'wb')
+    id, path, f = _create_dump_file(app)
     try:
         blog.dump(f, title)
-    finally:
-        f.close()
+    except:
+        _finish_dump_file(path, f, False)
+        raise
+    _finish_dump_file(path, f, True)
+    return id
 
 
 class Importer(object):
@@ -300,17 +433,25 @@ class Importer(object):
                                      **context)
 
     def enqueue_dump(self, blog):
-        """Enqueue a `Blog` object into the dump space."""
-        path = os.path.join(self.app.instance_folder, 'import_queue')
-        try:
-            os.makedirs(path)
-        except OSError:
-            pass
-        f = file(os.path.join(path, '%d' % time()), 'wb')
+        """Enqueue a `Blog` object into the dump space and return the id
+        of the dump.
+        """
+        return self.enqueue_stream(lambda writer: writer.finish(blog))
+
+    def enqueue_stream(self, callback):
+        """Call `callback` with a `DumpWriter` for a new dump in the dump
+        space and return the id of the dump.  The callback adds the posts
+        to the writer while it parses them and finishes the writer.  If it
+        raises an exception the dump is discarded.
+        """
+        id, path, f = _create_dump_file(self.app)
         try:
-            blog.dump(f, self.title)
-        finally:
-            f.close()
+            callback(DumpWriter(f, self.title))
+        except:
+            _finish_dump_file(path, f, False)
+            raise
+        _finish_dump_file(path, f, True)
+        return id
 
     def __init__(self, app):
         self.app = app
@@ -324,6 +465,169 @@ class Importer(object):
         """
 
 
+class DumpWriter(object):
+    """Writes an import dump into a file.  The posts are added one after
+    another with :meth:`add_post`, :meth:`finish` writes the details about
+    the blog afterwards.
+    """
+
+    def __init__(self, f, importer_name=None):
+        self._f = f
+        self._importer_name = importer_name
+        self._posts = []
+
+    def add_post(self, post):
+        """Write a post with its comments into the dump."""
+        self._posts.append((post.pub_date or _distant_future,
+                            self._f.tell()))
+        dump(post, self._f, HIGHEST_PROTOCOL)
+
+    def finish(self, blog):
+        """Write the posts of the `Blog` object (if there are any) and the
+        details about the blog.  Nothing must be written afterwards.
+        """
+        for post in blog.posts:
+            self.add_post(post)
+        self._posts.sort(reverse=True)
+        offset = self._f.tell()
+        dump({
+            'importer':     self._importer_name,
+            'source':       blog.link,
+            'title':        blog.title,
+            'dump_date':    blog.dump_date
+        }, self._f, HIGHEST_PROTOCOL)
+        dump({
+            'description':      blog.description,
+            'language':         blog.language,
+            'tags':             blog.tags,
+            'categories':       blog.categories,
+            'authors':          blog.authors,
+            'configuration':    blog.configuration,
+            'posts':            [x[1] for x in self._posts]
+        }, self._f, HIGHEST_PROTOCOL)
+        self._f.write(_dump_footer.pack(_dump_magic, offset))
+
+
+class ImportDump(object):
+    """An import dump in the import queue.  The details about the blog are
+    loaded when the dump is opened, the posts are read from the file when
+    they are needed.  The posts that are already in the database have
+    `already_imported` set to `True`.
+
+    Which posts and comments should be imported is stored next to the
+    dump (see :meth:`update_selection`), so that the selection can be
+    changed page by page.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        f = file(filename, 'rb')
+        try:
+            f.seek(_read_trailer_offset(f))
+            info = load(f)
+            details = load(f)
+        finally:
+            f.close()
+        self.importer = info['importer']
+        self.link = info['source']
+        self.title = info['title']
+        self.dump_date = info['dump_date']
+        self.description = details['description']
+        self.language = details['language']
+        self.tags = details['tags']
+        self.categories = details['categories']
+        self.authors = details['authors']
+        self.configuration = details['configuration']
+        self._offsets = details['posts']
+
+    def __len__(self):
+        return len(self._offsets)
+
+    def _load_posts(self, f, offsets):
+        result = []
+        for offset in offsets:
+            f.seek(offset)
+            result.append(load(f))
+        if result:
+            uids = set(x.uid for x in db.execute(db.select([posts.c.uid],
+                posts.c.uid.in_([post.uid for post in result]))))
+            for post in result:
+                post.already_imported = post.uid in uids
+        return result
+
+    def get_posts(self, offset=0, limit=None):
+        """Return a list of the posts in the range, newest first."""
+        stop = limit is not None and offset + limit or None
+        f = file(self.filename, 'rb')
+        try:
+            return self._load_posts(f, self._offsets[offset:stop])
+        finally:
+            f.close()
+
+    def iter_posts(self, batch_size=BATCH_SIZE):
+        """Iterate over all posts, newest first.  The posts are loaded in
+        batches.
+        """
+        f = file(self.filename, 'rb')
+        try:
+            offsets = iter(self._offsets)
+            while 1:
+                batch = self._load_posts(f, islice(offsets, batch_size))
+                if not batch:
+                    break
+                for post in batch:
+                    yield post
+        finally:
+            f.close()
+
+    def get_selection(self):
+        """Return a dict with the ids of the posts that should not be
+        imported (``'posts'``) and the ids of the posts whose comments
+        should not be imported (``'comments'``).
+        """
+        try:
+            f = file(self.filename + '.selection', 'rb')
+        except IOError:
+            return {'posts': set(), 'comments': set()}
+        try:
+            return load(f)
+        finally:
+            f.close()
+
+    def update_selection(self, data):
+        """Update the selection with form data that maps the keys
+        ``'posts'`` and ``'comments'`` to dicts of post ids and booleans.
+        """
+        selection = self.get_selection()
+        for key in 'posts', 'comments':
+            for post_id, selected in data.get(key, {}).iteritems():
+                if selected:
+                    selection[key].discard(post_id)
+                else:
+                    selection[key].add(post_id)
+        f = file(self.filename + '.selection', 'wb')
+        try:
+            dump(selection, f, HIGHEST_PROTOCOL)
+        finally:
+            f.close()
+
+    def to_blog(self):
+        """Load the whole dump into a `Blog` object."""
+        blog = Blog(self.title, self.link, self.description, self.language,
+                    self.tags, self.categories, list(self.iter_posts()),
+                    self.authors, self.configuration)
+        blog.dump_date = self.dump_date
+        return blog
+
+    def __repr__(self):
+        return '<%s %r posts: %d, authors: %d>' % (
+            self.__class__.__name__,
+            self.title,
+            len(self),
+            len(self.authors)
+        )
+
+
 class _Element(object):
     element = None
 
@@ -333,7 +637,10 @@ class _Element(object):
 
 
 class Blog(_Element):
-    """Represents a blog."""
+    """Represents a blog.  The importers don't keep the posts of a blog
+    in memory but write them into the dump while they parse them (see
+    :class:`DumpWriter`), so `posts` is usually empty.
+    """
 
     def __init__(self, title, link, description, language='en', tags=None,
                  categories=None, posts=None, authors=None,
@@ -359,26 +666,9 @@ class Blog(_Element):
             configuration = {}
         self.configuration = configuration
 
-    def __getstate__(self):
-        for post in self.posts:
-            post.__dict__.pop('already_imported', None)
-        return _Element.__getstate__(self)
-
-    def __setstate__(self, d):
-        self.__dict__ = d
-        uids = set(x.uid for x in db.execute(db.select([posts.c.uid])))
-        for post in self.posts:
-            post.already_imported = post.uid in uids
-
     def dump(self, f, importer_name=None):
         """Dump the blog into a file descriptor."""
-        dump({
-            'importer':     importer_name,
-            'source':       self.link,
-            'title':        self.title,
-            'dump_date':    self.dump_date
-        }, f, HIGHEST_PROTOCOL)
-        dump(self, f, HIGHEST_PROTOCOL)
+        DumpWriter(f, importer_name).finish(self)
 
     def __repr__(self):
         return '<%s %r posts: %d, authors: %d>' % (
@@ -472,6 +762,10 @@ class Post(_Element):
         self.status = status
         self.extra = extra or {}
 
+    def __getstate__(self):
+        self.__dict__.pop('already_imported', None)
+        return _Element.__getstate__(self)
+
     @property
     def text(self):
         result = self.body
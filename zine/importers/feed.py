@@ -6,10 +6,19 @@
     This importer can import web feeds.  Currently it is limited to ATOM
     plus optional Zine extensions.
 
+    The feed is parsed incrementally, every entry is written into the
+    import dump once it's parsed and then thrown away.  Because the
+    dependencies of ZXA files (the users) come after the entries, the feed
+    is read twice: the first pass keeps everything but the entries (the
+    extensions can look at them with :meth:`Extension.scan_entry`), the
+    second one parses the entries.
+
     :copyright: (c) 2010 by the Zine Team, see AUTHORS for more details.
     :license: BSD, see LICENSE for more details.
 """
 from pickle import loads
+from shutil import copyfileobj
+from tempfile import TemporaryFile
 from lxml import etree
 from zine.application import get_application
 from zine.i18n import _, lazy_gettext
@@ -18,7 +27,7 @@ from zine.forms import FeedImportForm
 from zine.utils import log
 from zine.utils.admin import flash
 from zine.utils.dates import parse_iso8601
-from zine.utils.xml import Namespace, to_text
+from zine.utils.xml import Namespace, to_text, clear_element
 from zine.utils.http import redirect_to
 from zine.utils.zeml import load_parser_data
 from zine.utils.exceptions import UserException
@@ -89,17 +98,47 @@ def _parser_data(value):
         return load_parser_data(value.decode('base64'))
 
 
-def parse_feed(fd):
-    tree = etree.parse(fd).getroot()
-    if tree.tag == 'rss':
+def _iter_entries(fd):
+    """Iterate over the entries of a feed.  Each entry is thrown away once
+    the next one is parsed.
+    """
+    for event, element in etree.iterparse(fd, tag=atom.entry):
+        if element.getparent().getparent() is None:
+            yield element
+            clear_element(element)
+
+
+def parse_feed(fd, writer):
+    """Parse a feed and write the posts into the `DumpWriter`."""
+    # the feed is read twice, so it has to be in a file we can seek in
+    try:
+        fd.seek(0)
+    except (AttributeError, IOError):
+        tmp = TemporaryFile()
+        copyfileobj(fd, tmp)
+        fd = tmp
+        fd.seek(0)
+
+    # first pass: parse everything but the entries
+    events = etree.iterparse(fd, events=('start', 'end'))
+    event, root = events.next()
+    if root.tag == 'rss':
         parser_class = RSSParser
-    elif tree.tag == atom.feed:
+    elif root.tag == atom.feed:
         parser_class = AtomParser
     else:
         raise FeedImportError(_('Unknown feed uploaded.'))
-    parser = parser_class(tree)
-    parser.parse()
-    return parser.blog
+    parser = parser_class(root)
+    for event, element in events:
+        if event == 'end' and element.tag == atom.entry and \
+           element.getparent() is root:
+            parser.scan_entry(element)
+            element.clear()
+            root.remove(element)
+
+    # second pass: parse the entries
+    fd.seek(0)
+    parser.parse(_iter_entries(fd), writer)
 
 
 class Parser(object):
@@ -111,12 +150,16 @@ class Parser(object):
         self.tags = []
         self.categories = []
         self.authors = []
-        self.posts = []
         self.blog = None
         self.extensions = [extension(self.app, self, tree)
                            for extension in self.app.feed_importer_extensions
                            if self.feed_type in extension.feed_types]
 
+    def scan_entry(self, entry):
+        """Called with every entry in the first pass over the feed."""
+        for extension in self.extensions:
+            extension.scan_entry(entry)
+
     def find_tag(self, **criterion):
         return self._find_criterion(self.tags, criterion)
 
@@ -126,9 +169,6 @@ class Parser(object):
     def find_author(self, **criterion):
         return self._find_criterion(self.authors, criterion)
 
-    def find_post(self, **criterion):
-        return self._find_criterion(self.posts, criterion)
-
     def _find_criterion(self, sequence, d):
         if len(d) != 1:
             raise TypeError('one criterion expected')
@@ -161,15 +201,18 @@ class AtomParser(Parser):
         self._authors_by_username = {}
         self._authors_by_email = {}
 
-    def parse(self):
+    def parse(self, entries, writer):
+        """Parse the entry elements and add the posts to the writer.  The
+        tree of the parser is the feed element without the entries.
+        """
         # atom allows the author to be defined for the whole feed
         # before the entries.  Capture it here.
         self.global_author = self.tree.find(atom.author)
 
-        for entry in self.tree.findall(atom.entry):
+        for entry in entries:
             post = self.parse_post(entry)
             if post is not None:
-                self.posts.append(post)
+                writer.add_post(post)
 
         self.blog = Blog(
             self.tree.findtext(atom.title),
@@ -178,12 +221,13 @@ class AtomParser(Parser):
             self.tree.attrib.get(xml.lang, u'en'),
             self.tags,
             self.categories,
-            self.posts,
+            None,
             self.authors
         )
         self.blog.element = self.tree
         for extension in self.extensions:
             extension.handle_root(self.blog)
+        writer.finish(self.blog)
 
     def parse_post(self, entry):
         # parse the dates first.
@@ -341,12 +385,11 @@ class FeedImporter(Importer):
                 return redirect_to('import/feed')
 
             try:
-                blog = parse_feed(feed)
+                self.enqueue_stream(lambda writer: parse_feed(feed, writer))
             except Exception, e:
                 log.exception(_(u'Error parsing uploaded file'))
                 flash(_(u'Error parsing feed: %s') % e, 'error')
             else:
-                self.enqueue_dump(blog)
                 flash(_(u'Added imported items to queue.'))
                 return redirect_to('admin/import')
 
@@ -363,8 +406,17 @@ class Extension(object):
         self.parser = parser
         self.root = root
 
+    def scan_entry(self, entry):
+        """Called for every entry element in the first pass over the feed,
+        before any of the posts are parsed.  Extensions that need data of
+        later entries to parse a post can collect it here.  While this is
+        called the root element is not parsed completely.
+        """
+
     def handle_root(self, blog):
-        """Called after the whole feed was parsed into a blog object."""
+        """Called after the whole feed was parsed into a blog object.  The
+        posts are not on the blog object, they are in the dump already.
+        """
 
     def postprocess_post(self, post):
         """Postprocess the post.
@@ -424,7 +476,7 @@ class ZEAExtension(Extension):
         self._authors = {}
         self._tags = {}
         self._categories = {}
-        self._dependencies = root.find(zine.dependencies)
+        self._dependencies = None
 
         self._lookup_user = etree.XPath('./zine:user[@dependency=$id]',
                                         namespaces={'zine': ZINE_NS})
@@ -439,6 +491,9 @@ class ZEAExtension(Extension):
     def _get_author(self, dependency):
         author = self._authors.get(dependency)
         if author is None:
+            # the dependencies are only there once the feed is parsed
+            if self._dependencies is None:
+                self._dependencies = self.root.find(zine.dependencies)
             element = self._lookup_user(self._dependencies,
                                         id=str(dependency))[0]
             author = Author(
@@ -17,7 +17,8 @@ from zine.importers import Importer, Blog, Tag, Category, Author, Post, Comment
 from zine.i18n import lazy_gettext, _
 from zine.utils import log
 from zine.utils.admin import flash
-from zine.utils.xml import Namespace, html_entities, escape
+from zine.utils.xml import Namespace, html_entities, escape, \
+     clear_element
 from zine.utils.zeml import parse_html, inject_implicit_paragraphs
 from zine.utils.http import redirect_to
 from zine.utils.net import open_url
@@ -44,59 +45,107 @@ def _wordpress_to_html(markup):
     return inject_implicit_paragraphs(parse_html(markup)).to_html()
 
 
-def parse_broken_wxr(fd):
-    """This method reads from a file descriptor and parses a WXR file as
-    created by current WordPress versions.  This method also injects a
-    custom DTD to not bark on HTML entities and fixes some problems with
-    regular expressions before parsing.  It's not my fault, wordpress is
-    that crazy :-/
+class _WXRFixer(object):
+    """A file object that reads a WXR file as created by current WordPress
+    versions from a file descriptor and fixes it for the XML parser on the
+    fly.  It injects a custom DTD to not bark on HTML entities and fixes
+    some problems with regular expressions.  It's not my fault, wordpress
+    is that crazy :-/
+
+    The input is fixed in chunks that end after an ``</item>``, so the
+    regular expressions never see more than a few items at once.
     """
-    # fix one: add inline doctype that defines the HTML entities so that
-    # the parser doesn't bark on them, wordpress adds such entities to some
-    # sections from time to time
-    inline_doctype = '<!DOCTYPE wordpress [ %s ]>' % ' '.join(
-        '<!ENTITY %s "&#%d;">' % (name, codepoint)
-        for name, codepoint in html_entities.iteritems()
-    )
 
-    # fix two: wordpress 2.6 uses "excerpt:encoded" where excerpt is an
-    # undeclared namespace.  What they did makes no sense whatsoever but
-    # who cares.  We're not treating that element anyways but the XML
-    # parser freaks out.  To fix that problem we're wrapping the whole
-    # thing in another root element
-    extra = '<wxrfix xmlns:excerpt="ignore:me">'
-
-    code = fd.read()
-    xml_decl = _xml_decl_re.search(code)
-    if xml_decl is not None:
-        code = code[:xml_decl.end()] + inline_doctype + extra + \
-               code[xml_decl.end():]
-    else:
-        code = inline_doctype + extra + code
-
-    # fix three: find comment sections and escape them.  Especially trackbacks
-    # tent to break the XML structure.  same applies to wp:meta_value stuff.
-    # this is especially necessary for older wordpress dumps, 2.7 fixes some
-    # of these problems.
-    def escape_if_good_idea(match):
-        before, content, after = match.groups()
-        if not content.lstrip().startswith('<![CDATA['):
-            content = escape(content)
-        return before + content + after
-    code = _meta_value_re.sub(escape_if_good_idea, code)
-    code = _comment_re.sub(escape_if_good_idea, code)
-    code += '</wxrfix>'
-
-    # fix four: WordPress uses CDATA sections for content.  Because it's very
-    # likely ]]> appears in the text as literal the XML parser totally freaks
-    # out there.  We've had at least one dump that does not import without
-    # this hack.
-    def reescape_escaped_content(match):
-        before, content, after = match.groups()
-        return before + escape(content) + after
-    code = _content_encoded_re.sub(reescape_escaped_content, code)
-
-    return etree.fromstring(code).find('rss').find('channel')
+    def __init__(self, fd, chunk_size=65536):
+        self._fd = fd
+        self._chunk_size = chunk_size
+        self._input = ''
+        self._output = ''
+        self._started = False
+        self._finished = False
+
+    def _fix_start(self, code):
+        # fix one: add inline doctype that defines the HTML entities so that
+        # the parser doesn't bark on them, wordpress adds such entities to
+        # some sections from time to time
+        inline_doctype = '<!DOCTYPE wordpress [ %s ]>' % ' '.join(
+            '<!ENTITY %s "&#%d;">' % (name, codepoint)
+            for name, codepoint in html_entities.iteritems()
+        )
+
+        # fix two: wordpress 2.6 uses "excerpt:encoded" where excerpt is an
+        # undeclared namespace.  What they did makes no sense whatsoever but
+        # who cares.  We're not treating that element anyways but the XML
+        # parser freaks out.  To fix that problem we're wrapping the whole
+        # thing in another root element
+        extra = '<wxrfix xmlns:excerpt="ignore:me">'
+
+        xml_decl = _xml_decl_re.search(code)
+        if xml_decl is not None:
+            return code[:xml_decl.end()] + inline_doctype + extra + \
+                   code[xml_decl.end():]
+        return inline_doctype + extra + code
+
+    def _fix_chunk(self, code):
+        # fix three: find comment sections and escape them.  Especially
+        # trackbacks tent to break the XML structure.  same applies to
+        # wp:meta_value stuff.  this is especially necessary for older
+        # wordpress dumps, 2.7 fixes some of these problems.
+        def escape_if_good_idea(match):
+            before, content, after = match.groups()
+            if not content.lstrip().startswith('<![CDATA['):
+                content = escape(content)
+            return before + content + after
+        code = _meta_value_re.sub(escape_if_good_idea, code)
+        code = _comment_re.sub(escape_if_good_idea, code)
+
+        # fix four: WordPress uses CDATA sections for content.  Because it's
+        # very likely ]]> appears in the text as literal the XML parser
+        # totally freaks out there.  We've had at least one dump that does
+        # not import without this hack.
+        def reescape_escaped_content(match):
+            before, content, after = match.groups()
+            return before + escape(content) + after
+        return _content_encoded_re.sub(reescape_escaped_content, code)
+
+    def _fill(self):
+        while not self._finished:
+            data = self._fd.read(self._chunk_size)
+            if not data:
+                self._finished = True
+                code = self._input
+            else:
+                self._input += data
+                pos = self._input.rfind('</item>')
+                if pos < 0:
+                    continue
+                pos += len('</item>')
+                code = self._input[:pos]
+                self._input = self._input[pos:]
+            if not self._started:
+                code = self._fix_start(code)
+                self._started = True
+            self._output += self._fix_chunk(code)
+            if self._finished:
+                self._output += '</wxrfix>'
+            return
+
+    def read(self, size=-1):
+        if not self._output:
+            self._fill()
+        if size < 0:
+            size = len(self._output)
+        rv = self._output[:size]
+        self._output = self._output[size:]
+        return rv
+
+
+def parse_broken_wxr(fd):
+    """Return an iterator over the ``end`` events of the elements of a
+    WXR file as created by current WordPress versions.  The file is fixed
+    for the XML parser with :class:`_WXRFixer`.
+    """
+    return etree.iterparse(_WXRFixer(fd), events=('end',))
 
 
 def parse_wordpress_date(value):
@@ -107,12 +156,13 @@ def parse_wordpress_date(value):
         pass
 
 
-def parse_feed(fd):
+def parse_feed(fd, writer):
     """Parse an extended WordPress RSS feed into a structure the general
-    importer system can handle.  The return value is a `Blog` object.
+    importer system can handle.  The posts are added to the `DumpWriter`
+    while the feed is parsed, afterwards the writer is finished with a
+    `Blog` object.
     """
-    tree = parse_broken_wxr(fd)
-
+    channel = {}
     authors = {}
     def get_author(name):
         if name:
@@ -122,103 +172,117 @@ def parse_feed(fd):
             return author
 
     tags = {}
-    for item in tree.findall(WORDPRESS.tag):
-        tag = Tag(item.findtext(WORDPRESS.tag_slug),
-                  item.findtext(WORDPRESS.tag_name))
-        tags[tag.name] = tag
-
     categories = {}
-    for item in tree.findall(WORDPRESS.category):
-        category = Category(item.findtext(WORDPRESS.category_nicename),
-                            item.findtext(WORDPRESS.cat_name))
-        categories[category.name] = category
-
-    posts = []
     clean_empty_tags = re.compile("\<(?P<tag>\w+?)\>[\r\n]?\</(?P=tag)\>")
 
-    for item in tree.findall('item'):
-        status = {
-            'draft':            STATUS_DRAFT
-        }.get(item.findtext(WORDPRESS.status), STATUS_PUBLISHED)
-        post_name = item.findtext(WORDPRESS.post_name)
-        pub_date = parse_wordpress_date(item.findtext(WORDPRESS.post_date_gmt))
-        content_type={'post': 'entry', 'page': 'page'}.get(
-                                item.findtext(WORDPRESS.post_type), 'entry')
-        slug = None
-
-        if pub_date is None or post_name is None:
-            status = STATUS_DRAFT
-        if status == STATUS_PUBLISHED:
-            slug = gen_timestamped_slug(post_name, content_type, pub_date)
-
-        # Store WordPress comment ids mapped to Comment objects
-        comments = {}
-        for x in item.findall(WORDPRESS.comment):
-            if x.findtext(WORDPRESS.comment_approved) == 'spam':
-                continue
-            commentobj = Comment(
-                x.findtext(WORDPRESS.comment_author),
-                x.findtext(WORDPRESS.comment_content),
-                x.findtext(WORDPRESS.comment_author_email),
-                x.findtext(WORDPRESS.comment_author_url),
-                comments.get(x.findtext(WORDPRESS.comment_parent), None),
-                parse_wordpress_date(x.findtext(
-                                            WORDPRESS.comment_date_gmt)),
-                x.findtext(WORDPRESS.comment_author_ip),
-                'html',
-                x.findtext(WORDPRESS.comment_type) in ('pingback',
-                                                       'traceback'),
-                (COMMENT_UNMODERATED, COMMENT_MODERATED)
-                    [x.findtext(WORDPRESS.comment_approved) == '1']
-            )
-            comments[x.findtext(WORDPRESS.comment_id)] = commentobj
-
-        post_body = item.findtext(CONTENT.encoded)
-        post_intro = item.findtext('description')
-        if post_intro and not post_body:
-            post_body = post_intro
-            post_intro = None
-        elif post_body:
-            find_more_results = re.split('<!--more ?.*?-->', post_body)
-            if len(find_more_results) > 1:
-                post_intro = clean_empty_tags.sub('',
-                                       _wordpress_to_html(find_more_results[0]))
-                post_body = find_more_results[1]
-        else:
-            # hmm. nothing to process. skip that entry
+    for event, element in parse_broken_wxr(fd):
+        parent = element.getparent()
+        if parent is None or parent.tag != 'channel':
             continue
 
-        post_body = clean_empty_tags.sub('', _wordpress_to_html(post_body))
-
-        post = Post(
-            slug,
-            item.findtext('title'),
-            item.findtext('link'),
-            pub_date,
-            get_author(item.findtext(DC_METADATA.creator)),
-            post_intro,
-            post_body,
-            [tags[x.text] for x in item.findall('tag')
-             if x.text in tags],
-            [categories[x.text] for x in item.findall('category')
-             if x.text in categories],
-            comments.values(),
-            item.findtext('comment_status') != 'closed',
-            item.findtext('ping_status') != 'closed',
-            parser='html',
-            content_type=content_type
-        )
-        posts.append(post)
-
-    return Blog(
-        tree.findtext('title'),
-        tree.findtext('link'),
-        tree.findtext('description') or '',
-        tree.findtext('language') or 'en',
+        if element.tag == WORDPRESS.tag:
+            tag = Tag(element.findtext(WORDPRESS.tag_slug),
+                      element.findtext(WORDPRESS.tag_name))
+            tags[tag.name] = tag
+        elif element.tag == WORDPRESS.category:
+            category = Category(element.findtext(WORDPRESS.category_nicename),
+                                element.findtext(WORDPRESS.cat_name))
+            categories[category.name] = category
+        elif element.tag == 'item':
+            post = _parse_item(element, tags, categories, get_author,
+                               clean_empty_tags)
+            if post is not None:
+                writer.add_post(post)
+        elif element.tag in ('title', 'link', 'description', 'language'):
+            channel[element.tag] = element.text
+        clear_element(element)
+
+    writer.finish(Blog(
+        channel.get('title'),
+        channel.get('link'),
+        channel.get('description') or '',
+        channel.get('language') or 'en',
         tags.values(),
         categories.values(),
-        posts,
+        None,
         authors.values()
+    ))
+
+
+def _parse_item(item, tags, categories, get_author, clean_empty_tags):
+    """Parse an ``<item>`` into a post or return `None` if it has no
+    content.
+    """
+    status = {
+        'draft':            STATUS_DRAFT
+    }.get(item.findtext(WORDPRESS.status), STATUS_PUBLISHED)
+    post_name = item.findtext(WORDPRESS.post_name)
+    pub_date = parse_wordpress_date(item.findtext(WORDPRESS.post_date_gmt))
+    content_type={'post': 'entry', 'page': 'page'}.get(
+                            item.findtext(WORDPRESS.post_type), 'entry')
+    slug = None
+
+    if pub_date is None or post_name is None:
+        status = STATUS_DRAFT
+    if status == STATUS_PUBLISHED:
+        slug = gen_timestamped_slug(post_name, content_type, pub_date)
+
+    # Store WordPress comment ids mapped to Comment objects
+    comments = {}
+    for x in item.findall(WORDPRESS.comment):
+        if x.findtext(WORDPRESS.comment_approved) == 'spam':
+            continue
+        commentobj = Comment(
+            x.findtext(WORDPRESS.comment_author),
+            x.findtext(WORDPRESS.comment_content),
+            x.findtext(WORDPRESS.comment_author_email),
+            x.findtext(WORDPRESS.comment_author_url),
+            comments.get(x.findtext(WORDPRESS.comment_parent), None),
+            parse_wordpress_date(x.findtext(
+                                        WORDPRESS.comment_date_gmt)),
+            x.findtext(WORDPRESS.comment_author_ip),
+            'html',
+            x.findtext(WORDPRESS.comment_type) in ('pingback',
+                                                   'traceback'),
+            (COMMENT_UNMODERATED, COMMENT_MODERATED)
+                [x.findtext(WORDPRESS.comment_approved) == '1']
+        )
+        comments[x.findtext(WORDPRESS.comment_id)] = commentobj
+
+    post_body = item.findtext(CONTENT.encoded)
+    post_intro = item.findtext('description')
+    if post_intro and not post_body:
+        post_body = post_intro
+        post_intro = None
+    elif post_body:
+        find_more_results = re.split('<!--more ?.*?-->', post_body)
+        if len(find_more_results) > 1:
+            post_intro = clean_empty_tags.sub('',
+                                   _wordpress_to_html(find_more_results[0]))
+            post_body = find_more_results[1]
+    else:
+        # hmm. nothing to process. skip that entry
+        return
+
+    post_body = clean_empty_tags.sub('', _wordpress_to_html(post_body))
+
+    return Post(
+        slug,
+        item.findtext('title'),
+        item.findtext('link'),
+        pub_date,
+        get_author(item.findtext(DC_METADATA.creator)),
+        post_intro,
+        post_body,
+        [tags[x.text] for x in item.findall('tag')
+         if x.text in tags],
+        [categories[x.text] for x in item.findall('category')
+         if x.text in categories],
+        comments.values(),
+        item.findtext('comment_status') != 'closed',
+        item.findtext('ping_status') != 'closed',
+        parser='html',
+        content_type=content_type
     )
 
 
@@ -243,13 +307,12 @@ class WordPressImporter(Importer):
                 return redirect_to('import/wordpress')
 
             try:
-                blog = parse_feed(dump)
+                self.enqueue_stream(lambda writer: parse_feed(dump, writer))
             except Exception, e:
                 raise
                 log.exception(_(u'Error parsing uploaded file'))
                 flash(_(u'Error parsing uploaded file: %s') % e, 'error')
             else:
-                self.enqueue_dump(blog)
                 flash(_(u'Added imported items to queue.'))
                 return redirect_to('admin/import')
 
@@ -9,19 +9,21 @@
     :license: BSD, see LICENSE for more details.
 """
 from math import log
-from datetime import date, datetime, timedelta
+from datetime import datetime, timedelta
 from urlparse import urljoin
 
 from werkzeug.exceptions import NotFound
+from sqlalchemy.orm.attributes import set_committed_value
 
 from zine.database import users, categories, posts, post_links, \
      post_categories, post_tags, tags, comments, groups, group_users, \
      privileges, user_privileges, group_privileges, texts, \
-     notification_subscriptions, schema_versions, db
+     notification_subscriptions, schema_versions, counters, db
 from zine.utils import zeml
 from zine.utils.text import gen_slug, gen_timestamped_slug, build_tag_uri, \
-     increment_string
-from zine.utils.pagination import Pagination
+     get_free_string, increment_string
+from zine.utils.pagination import Pagination, CommentPagination, \
+     make_cursor, parse_cursor
 from zine.utils.crypto import gen_pwhash, check_pwhash
 from zine.utils.http import make_external_url
 from zine.privileges import _Privilege, privilege_attribute, \
@@ -50,6 +52,56 @@ MODERATE_NONE = 0
 MODERATE_ALL = 1
 MODERATE_UNKNOWN = 2
 
+#: the number of slugs looked up at once for slugs that are just a number
+SLUG_BATCH_SIZE = 10
+
+#: the prefix of the names of the counters read for the tag cloud
+CLOUD_COUNTER_PREFIX = 'published/tag/'
+
+
+def allocate_slug(column, slug):
+    """Return `slug` if it's not used in the slug `column` yet, otherwise
+    the next free slug in the sequence of :func:`increment_string`.  The
+    slugs of that sequence are usually fetched in one query and the slugs
+    allocated in the current transaction are remembered, so that objects
+    that were not flushed yet (for example during an import) don't get the
+    same slug.
+    """
+    session = db.session()
+    reservations = getattr(session, '_slug_reservations', None)
+    if reservations is None or reservations[0] is not session.transaction:
+        reservations = session._slug_reservations = (session.transaction, {})
+    reserved = reservations[1].setdefault(column.table.name, set())
+
+    # the pattern also matches slugs that are not in the sequence (and
+    # underscores and percent signs in the slug match anything), those are
+    # just never picked.
+    prefix = slug.rstrip(u'0123456789')
+    if prefix:
+        taken = set(x for x, in db.execute(db.select([column],
+            (column == slug) | column.like(prefix + u'%'))))
+        rv = get_free_string(slug, taken | reserved)
+
+    # slugs that are just a number have no prefix that limits the pattern,
+    # so the slugs of the sequence are looked up by their exact values in
+    # batches.
+    else:
+        rv = None
+        candidate = slug
+        while rv is None:
+            candidates = []
+            for idx in xrange(SLUG_BATCH_SIZE):
+                candidates.append(candidate)
+                candidate = increment_string(candidate)
+            taken = set(x for x, in db.execute(db.select([column],
+                column.in_(candidates))))
+            free = [x for x in candidates if x not in taken and
+                    x not in reserved]
+            if free:
+                rv = free[0]
+    reserved.add(rv)
+    return rv
+
 
 class _ZEMLContainer(object):
     """A mixin for objects that have ZEML markup stored."""
@@ -397,89 +449,144 @@ class _PostQueryBase(db.Query):
         return query
 
     def get_list(self, endpoint=None, page=1, per_page=None,
-                 url_args=None, raise_if_empty=True):
+                 url_args=None, raise_if_empty=True, cursor=None,
+                 total=None):
         """Return a dict with pagination, the current posts, number of pages,
         total posts and all that stuff for further processing.
+
+        The links of the pagination to the previous and next page carry a
+        cursor in the ``cursor`` URL parameter, views pass it as `cursor`.
+        With a cursor the posts are looked up by the publication date and
+        id of the last post of the page before instead of skipping the
+        posts of all pages before, so that deep pages are as fast as the
+        first one.  Invalid cursors are ignored.
+
+        If the number of posts is known already (for example from
+        :meth:`count_published`) it can be passed as `total`, otherwise the
+        posts of the query are counted.
         """
         if per_page is None:
             app = get_application()
             per_page = app.cfg['posts_per_page']
 
         # send the query
-        offset = per_page * (page - 1)
-        postlist = self.order_by(Post.pub_date.desc()) \
-                       .offset(offset).limit(per_page).all()
+        key = cursor and parse_cursor(cursor)
+        if key:
+            direction, pub_date, post_id = key
+            if direction == 'next':
+                postlist = self.filter((Post.pub_date <= pub_date) &
+                                       ((Post.pub_date < pub_date) |
+                                        (Post.id < post_id))) \
+                               .order_by(Post.pub_date.desc(),
+                                         Post.id.desc()) \
+                               .limit(per_page).all()
+            else:
+                postlist = self.filter((Post.pub_date >= pub_date) &
+                                       ((Post.pub_date > pub_date) |
+                                        (Post.id > post_id))) \
+                               .order_by(Post.pub_date.asc(),
+                                         Post.id.asc()) \
+                               .limit(per_page).all()
+                postlist.reverse()
+        else:
+            offset = per_page * (page - 1)
+            postlist = self.order_by(Post.pub_date.desc(), Post.id.desc()) \
+                           .offset(offset).limit(per_page).all()
 
         # if raising exceptions is wanted, raise it
         if raise_if_empty and (page != 1 and not postlist):
             raise NotFound()
 
+        if total is None:
+            total = self.count()
+        next_cursor = prev_cursor = None
+        if postlist:
+            next_cursor = make_cursor('next', postlist[-1].pub_date,
+                                      postlist[-1].id)
+            prev_cursor = make_cursor('prev', postlist[0].pub_date,
+                                      postlist[0].id)
         pagination = Pagination(endpoint, page, per_page,
-                                self.count(), url_args)
+                                total, url_args, next_cursor=next_cursor,
+                                prev_cursor=prev_cursor)
 
         return {
             'pagination':       pagination,
             'posts':            postlist
         }
 
+    def count_published(self, name):
+        """Return the number of published posts of the query that are
+        visible to anonymous users.  `name` is the name of the counter in
+        the ``posts`` scope (see :mod:`zine.counters`) that counts the
+        published posts of the query.  The counter includes posts that are
+        scheduled for the future, they are counted separately and
+        subtracted.
+        """
+        from zine.counters import get_count
+        published = self.filter(Post.status == STATUS_PUBLISHED)
+        return get_count('posts', name, published) - \
+               published.filter(Post.pub_date > datetime.utcnow()).count()
+
+    def next_scheduled(self):
+        """Return the publication date of the next published post of the
+        query that is scheduled for the future or `None`.  Caches of pages
+        that only show published posts must expire at that time because
+        nothing is changed when a scheduled post is published.
+        """
+        return iter(self.filter((Post.status == STATUS_PUBLISHED) &
+                                (Post.pub_date > datetime.utcnow()))
+                        .order_by(None)
+                        .values(db.func.min(Post.pub_date))).next()[0]
+
+    def get_validator(self):
+        """Return a tuple in the form ``(last_update, pub_date, count,
+        comments)`` for the posts of the query: the time of the most recent
+        change, the most recent publication date, the number of posts and
+        the number of their approved comments.  This is used to answer
+        conditional requests without loading the posts.
+        """
+        return iter(self.order_by(None).values(
+            db.func.max(Post.last_update), db.func.max(Post.pub_date),
+            db.func.count(Post.id), db.func.sum(Post._comment_count))).next()
+
     def get_archive_summary(self, detail='months', limit=None,
                             ignore_privileges=False):
         """Query function to get the archive of the blog. Usually used
         directly from the templates to add some links to the sidebar.
+
+        The published posts of the query are grouped by year, month or day
+        (`detail` is ``'years'``, ``'months'`` or ``'days'``) in the
+        database, so only the periods that have posts are returned, newest
+        first.  The number of posts of each period is in ``'counts'``.  If
+        `ignore_privileges` is `True` only the posts visible to anonymous
+        users are taken into account.
         """
-        # XXX: currently we also return months without articles in it.
-        # other blog systems do not, but because we use sqlalchemy we have
-        # to go with the functionality provided.  Currently there is no way
-        # to do date truncating in a database agnostic way.  When this is done
-        # ignore_privileges should no longer be a noop
-        last = self.filter(Post.pub_date != None) \
-                   .order_by(Post.pub_date.asc()).first()
-        now = datetime.utcnow()
+        if detail not in ('years', 'months', 'days'):
+            raise ValueError('detail must be years, months, or days')
+        unit = detail[:-1]
+        # group and order by the label so that the parameters of the date
+        # function are not repeated, postgres would not match them up.
+        bucket = db.literal_column('archive_bucket')
+        query = self.published(ignore_privileges=ignore_privileges) \
+                    .order_by(None).group_by(bucket) \
+                    .order_by(bucket.desc())
+        if limit is not None:
+            query = query.limit(limit + 1)
 
-        there_are_more = False
         result = []
-
-        if last is not None:
-            now = date(now.year, now.month, now.day)
-            oldest = date(last.pub_date.year, last.pub_date.month,
-                          last.pub_date.day)
-            result = [now]
-
-            there_are_more = False
-            if detail == 'years':
-                now, oldest = [x.replace(month=1, day=1) for x in now, oldest]
-                while True:
-                    now = now.replace(year=now.year - 1)
-                    if now < oldest:
-                        break
-                    result.append(now)
-                else:
-                    there_are_more = True
-            elif detail == 'months':
-                now, oldest = [x.replace(day=1) for x in now, oldest]
-                while limit is None or len(result) < limit:
-                    if not now.month - 1:
-                        now = now.replace(year=now.year - 1, month=12)
-                    else:
-                        now = now.replace(month=now.month - 1)
-                    if now < oldest:
-                        break
-                    result.append(now)
-                else:
-                    there_are_more = True
-            elif detail == 'days':
-                while limit is None or len(result) < limit:
-                    now = now - timedelta(days=1)
-                    if now < oldest:
-                        break
-                    result.append(now)
-                else:
-                    there_are_more = True
-            else:
-                raise ValueError('detail must be years, months, or days')
+        counts = []
+        for value, count in query.values(db.date_trunc(unit, Post.pub_date)
+                                           .label('archive_bucket'),
+                                         db.func.count(Post.id)):
+            result.append(db.parse_trunc_date(unit, value))
+            counts.append(count)
+        there_are_more = limit is not None and len(result) > limit
+        if there_are_more:
+            del result[limit:], counts[limit:]
 
         return {
             detail:     result,
+            'counts':   counts,
             'more':     there_are_more,
             'empty':    not result
         }
@@ -509,16 +616,21 @@ class _PostQueryBase(db.Query):
         )
 
     def search(self, query):
-        """Search for posts by a query."""
-        # XXX: use a sophisticated search
-        q = self
-        for word in query.split():
-            q = q.filter(
-                posts.c.body.like('%%%s%%' % word) |
-                posts.c.intro.like('%%%s%%' % word) |
-                posts.c.title.like('%%%s%%' % word)
-            )
-        return q.all()
+        """Return a query for the posts that contain all the words of the
+        search query, the best matches first.  The posts are looked up in
+        the index of the search engine (see :mod:`zine.search`).
+        """
+        from zine.search import get_search_engine, tokenize
+        words = tokenize(query)
+        matches = None
+        if words:
+            matches = get_search_engine().match(words)
+        if matches is None:
+            # nothing can match
+            return self.filter(Post.id == None)
+        matches = matches.alias('search_matches')
+        return self.filter(Post.id == matches.c.post_id) \
+                   .order_by(matches.c.score.desc(), Post.pub_date.desc())
 
 
 class _PostBase(object):
@@ -548,14 +660,21 @@ class _PostBase(object):
         """Return only the comments for this post that are visible to
         the user.
         """
-        return [x for x in self.comments if x.visible]
+        return self.get_comment_thread().comments
 
     @property
     def visible_root_comments(self):
         """Return only the comments for this post that are visible to
         the user and that don't have a parent.
         """
-        return [x for x in self.comments if x.visible and x.parent is None]
+        return self.get_comment_thread().roots
+
+    def get_comment_thread(self, page=1, per_page=None, user=None):
+        """Return the :class:`CommentThread` with the comments of this post
+        that are visible to the user (by default the current user).  If
+        `per_page` is given the thread is paginated by the root comments.
+        """
+        return CommentThread(self, page, per_page, user)
 
     @property
     def comment_count(self):
@@ -583,6 +702,16 @@ class _PostBase(object):
         """True if this post is unpublished."""
         return self.status == STATUS_DRAFT
 
+    @property
+    def cache_tags(self):
+        """The cache tags for this post.  Cached responses that show this
+        post carry those tags and are invalidated if the post changes.
+        """
+        rv = ['post/%d' % self.id, 'author/%d' % self.author_id]
+        rv.extend('category/' + x.slug for x in self.categories)
+        rv.extend('tag/' + x.slug for x in self.tags)
+        return rv
+
     def sync_comment_count(self):
         """Sync the reflected comment count."""
         self._comment_count = Comment.query.comments_for_post(self) \
@@ -598,10 +727,7 @@ class _PostBase(object):
         full_slug = gen_timestamped_slug(slug, self.content_type, self.pub_date)
 
         if full_slug != self.slug:
-            while Post.query.autoflush(False).filter_by(slug=full_slug) \
-                      .limit(1).count():
-                full_slug = increment_string(full_slug)
-            self.slug = full_slug
+            self.slug = allocate_slug(posts.c.slug, full_slug)
 
     def touch_times(self, pub_date=None):
         """Touches the times for this post.  If the pub_date is given the
@@ -881,10 +1007,7 @@ class Category(object):
                                .order_by(Category.id.desc()).first()
             full_slug = unicode(category and category.id or u'1')
         if full_slug != self.slug:
-            while Category.query.autoflush(False) \
-                          .filter_by(slug=full_slug).limit(1).count():
-                full_slug = increment_string(full_slug)
-            self.slug = full_slug
+            self.slug = allocate_slug(categories.c.slug, full_slug)
 
     def get_url_values(self):
         return 'blog/show_category', {
@@ -1182,46 +1305,130 @@ class Comment(_ZEMLContainer):
         )
 
 
+class CommentThread(object):
+    """The comments of a post that are visible to a user arranged as a
+    tree.  The comments (with their users) are fetched in one query unless
+    the post has them loaded already, the replies and the visibility are
+    looked up in memory afterwards so that rendering the thread doesn't
+    cause any further queries.
+    """
+
+    def __init__(self, post, page=1, per_page=None, user=None):
+        self.post = post
+        request = get_request()
+        if request is None:
+            show_all = True
+            shown = ()
+        else:
+            if user is None:
+                user = request.user
+            show_all = user.has_privilege(MODERATE_COMMENTS) or \
+                (post.author_id == user.id and
+                 user.has_privilege(MODERATE_OWN_ENTRIES | MODERATE_OWN_PAGES))
+            shown = frozenset(request.session.get('visible_comments', ()))
+
+        if db.attribute_loaded(post, 'comments'):
+            all_comments = post.comments
+        else:
+            all_comments = Comment.query.comments_for_post(post) \
+                .order_by(Comment.pub_date.asc(), Comment.id.asc()).all()
+            set_committed_value(post, 'comments', all_comments)
+
+        #: the visible comments in the order they were written
+        self.comments = []
+        roots = []
+        self._children = {}
+        for comment in all_comments:
+            if not (show_all or not comment.blocked or comment.id in shown):
+                continue
+            self.comments.append(comment)
+            if comment.parent_id is None:
+                roots.append(comment)
+            else:
+                self._children.setdefault(comment.parent_id, []) \
+                    .append(comment)
+
+        #: the pagination for the root comments or `None`
+        self.pagination = None
+        if per_page:
+            page = max(page, 1)
+            self.pagination = CommentPagination(post, page, per_page,
+                                                len(roots))
+            roots = roots[(page - 1) * per_page:page * per_page]
+
+        #: the visible root comments on the current page
+        self.roots = roots
+
+    def children(self, comment):
+        """Return the visible replies to a comment."""
+        return self._children.get(comment.id, ())
+
+    def __iter__(self):
+        return iter(self.comments)
+
+    def __len__(self):
+        return len(self.comments)
+
+    def __repr__(self):
+        return '<%s %r: %d comments>' % (
+            self.__class__.__name__,
+            self.post.title,
+            len(self.comments)
+        )
+
+
 class TagQuery(db.Query):
 
     def get_cloud(self, max=None, ignore_privileges=False):
-        """Get a categorycloud."""
+        """Get a categorycloud.
+
+        The number of published posts per tag is read from the counters
+        (see :mod:`zine.counters`) in one statement: the counters of the
+        tags are a range of the primary key of the counters table.  They
+        include posts scheduled for the future, those are counted in the
+        same statement and subtracted so that posts show up in the cloud as
+        soon as their publication date is reached.
+        """
         # XXX: ignore_privileges is currently ignored and no privilege
         # checking is performed.  As a matter of fact only published posts
         # appear in the cloud.
-
-        # get a query
+        c = counters.c
+        t = tags.c
         pt = post_tags.c
         p = posts.c
-        t = tags.c
 
-        q = ((pt.tag_id == t.tag_id) &
-             (pt.post_id == p.post_id) &
-             (p.status == STATUS_PUBLISHED) &
-             (p.pub_date <= datetime.utcnow()))
+        scheduled = db.select([pt.tag_id, db.func.count().label('count')],
+            (pt.post_id == p.post_id) &
+            (p.status == STATUS_PUBLISHED) &
+            (p.pub_date > datetime.utcnow()),
+            group_by=[pt.tag_id]).alias('scheduled')
+        # the names of the counters are ``published/tag/<tag_id>``, the
+        # range ends with the character after the slash.
+        tag_id = db.cast(db.func.substr(c.name, len(CLOUD_COUNTER_PREFIX) + 1),
+                         db.Integer)
+        count = c.value - db.func.coalesce(scheduled.c.count, 0)
+        rows = db.execute(db.select([t.tag_id, t.slug, t.name, count],
+            (c.scope == 'posts') &
+            (c.name >= CLOUD_COUNTER_PREFIX) &
+            (c.name < CLOUD_COUNTER_PREFIX[:-1] + '0') &
+            (count > 0),
+            from_obj=[counters.join(tags, t.tag_id == tag_id)
+                      .outerjoin(scheduled, scheduled.c.tag_id == t.tag_id)]
+        )).fetchall()
+
+        items = []
+        for tag_id, slug, name, count in rows:
+            items.append({
+                'id':       tag_id,
+                'slug':     slug,
+                'name':     name,
+                'count':    count,
+                'size':     100 + log(count) * 20
+            })
 
-        s = db.select(
-            [t.tag_id, t.slug, t.name,
-             db.func.count(p.post_id).label('s_count')],
-            q, group_by=[t.slug, t.name, t.tag_id]).alias('post_count_query').c
-
-        options = {'order_by': [db.asc(s.s_count)]}
         if max is not None:
-            options['limit'] = max
-
-        # the label statement circumvents a bug for sqlite3 on windows
-        # see #65
-        q = db.select([s.tag_id, s.slug, s.name, s.s_count.label('s_count')],
-                      **options)
-
-        items = [{
-            'id':       row.tag_id,
-            'slug':     row.slug,
-            'name':     row.name,
-            'count':    row.s_count,
-            'size':     100 + log(row.s_count or 1) * 20
-        } for row in db.execute(q)]
-
+            items.sort(key=lambda x: x['count'])
+            del items[max:]
         items.sort(key=lambda x: x['name'].lower())
         return items
 
@@ -1252,10 +1459,7 @@ class Tag(object):
             tag = Tag.query.autoflush(False).order_by(Tag.id.desc()).first()
             full_slug = unicode(tag and tag.id or u'1')
         if full_slug != self.slug:
-            while Tag.query.autoflush(False) \
-                          .filter_by(slug=full_slug).limit(1).count():
-                full_slug = increment_string(full_slug)
-            self.slug = full_slug
+            self.slug = allocate_slug(tags.c.slug, full_slug)
 
     def get_url_values(self):
         return 'blog/show_tag', {'slug': self.slug}
@@ -1336,7 +1540,8 @@ db.mapper(Comment, db.join(comments, texts), properties={
     'email':        db.synonym('_email'),
     '_www':         comments.c.www,
     'www':          db.synonym('_www'),
-    '_status':      comments.c.status,
+    '_status':      db.column_property(comments.c.status,
+                                       active_history=True),
     'status':       db.synonym('_status'),
     'children':     db.relation(Comment,
         primaryjoin=comments.c.parent_id == comments.c.comment_id,
@@ -1360,6 +1565,13 @@ db.mapper(Post, db.join(posts, texts), properties={
     'text_id':          [posts.c.text_id, texts.c.text_id],
     '_text':            texts.c.text,
     'text':             db.synonym('_text'),
+    # the counters need the old values of these columns
+    'status':           db.column_property(posts.c.status,
+                                           active_history=True),
+    'content_type':     db.column_property(posts.c.content_type,
+                                           active_history=True),
+    'author_id':        db.column_property(posts.c.author_id,
+                                           active_history=True),
     'comments':         db.relation(Comment, backref=db.backref('post', lazy=True),
                                     primaryjoin=posts.c.post_id ==
                                         comments.c.post_id,
@@ -1399,3 +1611,9 @@ db.mapper(NotificationSubscription, notification_subscriptions, properties={
                             )
                         )
 })
+
+
+# the counters and the search index are kept up to date by session
+# extensions
+import zine.counters
+import zine.search
@@ -0,0 +1,346 @@
+# -*- coding: utf-8 -*-
+"""
+    zine.moderation
+    ~~~~~~~~~~~~~~~
+
+    Moderation of many comments at once.  Instead of loading every comment
+    and changing it through the models, the comments are changed with a few
+    UPDATE and DELETE statements per chunk of comments.  The comment counts
+    of the posts, the counters (see :mod:`zine.counters`) and the cache
+    tags of the affected posts and of the widgets that show comments are
+    updated afterwards.
+
+    The events that are emitted for every comment when a single comment is
+    moderated (like ``before-comment-mark-spam``) are only emitted if
+    `emit_events` is enabled because that requires loading the comments.
+    Plugins that learn from moderation decisions (like the Akismet spam
+    filter) need them, the ``comment_moderation_events`` configuration
+    value enables them for the mass moderation in the admin panel.
+
+    Sets with more than `BACKGROUND_THRESHOLD` comments are moderated in a
+    background thread (see :func:`start_moderation`) that writes its
+    progress into a status file in the instance folder, so that the admin
+    panel can show it.
+
+    :copyright: (c) 2010 by the Zine Team, see AUTHORS for more details.
+    :license: BSD, see LICENSE for more details.
+"""
+import os
+import threading
+from time import time
+from cPickle import dump, load, HIGHEST_PROTOCOL
+
+from zine.i18n import _
+from zine.application import get_application, get_request, emit_event
+from zine.cache import invalidate_tags
+from zine.counters import apply_deltas
+from zine.database import db, comments, posts, texts, cleanup_session
+from zine.models import User, Comment, COMMENT_MODERATED, \
+     COMMENT_BLOCKED_USER, COMMENT_BLOCKED_SPAM, COMMENT_DELETED
+from zine.utils import log
+
+
+#: the number of comments changed per chunk
+CHUNK_SIZE = 500
+
+#: sets with more comments are moderated in a background thread
+BACKGROUND_THRESHOLD = CHUNK_SIZE
+
+#: the results of :func:`moderate`
+MODERATED, STARTED, RUNNING = range(3)
+
+#: the file in the instance folder with the progress of the background
+#: moderation
+STATUS_FILENAME = 'moderation.status'
+
+#: a background moderation is considered dead if its status file was not
+#: written for that many seconds
+STATUS_TIMEOUT = 300
+
+#: the actions mapped to the new status and the events emitted per
+#: comment.  The comments are deleted with the `'delete'` action.
+ACTIONS = {
+    'approve':  (COMMENT_MODERATED, ('before-comment-approved',)),
+    'block':    (COMMENT_BLOCKED_USER, ('before-comment-blocked',)),
+    'spam':     (COMMENT_BLOCKED_SPAM, ('before-comment-mark-spam',)),
+    'ham':      (COMMENT_MODERATED, ('before-comment-mark-ham',
+                                     'before-comment-approved')),
+    'delete':   (COMMENT_DELETED, ('before-comment-deleted',))
+}
+
+
+def _count_comments(where):
+    """Return the comment counter deltas for the comments that match
+    `where` as if they were removed.
+    """
+    deltas = {}
+    query = db.select([comments.c.status, posts.c.author_id,
+                       db.func.count(comments.c.comment_id)], where,
+                      from_obj=[comments.join(posts, comments.c.post_id ==
+                                              posts.c.post_id)],
+                      group_by=[comments.c.status, posts.c.author_id])
+    for status, author_id, count in db.execute(query):
+        names = ['status/%d' % status]
+        if author_id is not None:
+            names.append('status/%d/author/%d' % (status, author_id))
+        for name in names:
+            key = ('comments', name)
+            deltas[key] = deltas.get(key, 0) - count
+    return deltas
+
+
+def _merge_deltas(deltas, other, factor=1):
+    for key, value in other.iteritems():
+        deltas[key] = deltas.get(key, 0) + value * factor
+
+
+def _get_blocked_msg(action, user):
+    if user is None:
+        return u''
+    elif action == 'block':
+        return _(u'Comment blocked by %s') % user.display_name
+    elif action == 'spam':
+        return _(u'Comment marked as spam by %s') % user.display_name
+    return u''
+
+
+def _delete_comments(comment_ids, emit_events=False):
+    """Delete the comments.  Like :func:`zine.forms.delete_comment` the
+    comments with replies are only emptied and marked as deleted, deleted
+    comments without replies are removed together with their deleted
+    parents.  The emptied comments keep their parser.  Returns the counter
+    deltas for the removed comments that were not in `comment_ids`, if
+    `emit_events` is enabled ``before-comment-deleted`` is emitted for
+    them before they are removed.
+    """
+    app = get_application()
+    from zine.parsers import parse
+    text_rows = db.execute(db.select([texts.c.text_id, texts.c.parser_data],
+        (comments.c.text_id == texts.c.text_id) &
+        comments.c.comment_id.in_(comment_ids))).fetchall()
+    db.execute(comments.update(comments.c.comment_id.in_(comment_ids)),
+               dict(status=COMMENT_DELETED, user_id=None, author=None,
+                    email=None, www=None))
+
+    # the texts are emptied with one statement per parser
+    by_parser = {}
+    for text_id, parser_data in text_rows:
+        parser = parser_data and parser_data.get('parser') or \
+                 app.cfg['comment_parser']
+        by_parser.setdefault(parser, []).append(text_id)
+    for parser, text_ids in by_parser.iteritems():
+        db.execute(texts.update(texts.c.text_id.in_(text_ids)),
+                   dict(text=u'', parser_data={
+                       'parser': parser,
+                       'body':   parse(u'', parser, 'comment')
+                   }))
+
+    deltas = {}
+    selected = set(comment_ids)
+    candidates = selected
+    children = comments.alias('children')
+    while candidates:
+        where = comments.c.comment_id.in_(candidates) & \
+                (comments.c.status == COMMENT_DELETED) & \
+                ~db.exists([children.c.comment_id],
+                           children.c.parent_id == comments.c.comment_id)
+        rows = db.execute(db.select([comments.c.comment_id,
+                                     comments.c.text_id,
+                                     comments.c.parent_id], where)).fetchall()
+        if not rows:
+            break
+        ids = [row[0] for row in rows]
+        outside = [x for x in ids if x not in selected]
+        if outside:
+            _merge_deltas(deltas, _count_comments(
+                comments.c.comment_id.in_(outside)))
+            if emit_events:
+                for comment in Comment.query.filter(Comment.id.in_(outside)):
+                    emit_event('before-comment-deleted', comment)
+                db.flush()
+        db.execute(comments.delete(comments.c.comment_id.in_(ids)))
+        db.execute(texts.delete(texts.c.text_id.in_([row[1] for row
+                                                      in rows])))
+        candidates = set(row[2] for row in rows if row[2] is not None)
+    return deltas
+
+
+def sync_comment_counts(post_ids):
+    """Recompute the number of public comments of the posts with one
+    statement.
+    """
+    if not post_ids:
+        return
+    count = db.select([db.func.count(comments.c.comment_id)],
+                      (comments.c.post_id == posts.c.post_id) &
+                      (comments.c.status == COMMENT_MODERATED)).as_scalar()
+    db.execute(posts.update(posts.c.post_id.in_(post_ids),
+                            values={posts.c.comment_count: count}))
+
+
+def moderate_comments(comment_ids, action, emit_events=False,
+                      chunk_size=CHUNK_SIZE, commit=False, user=None,
+                      callback=None):
+    """Apply a moderation action (one of `ACTIONS`) to the comments with
+    the given ids and return the number of processed comments.  The
+    comments are changed in chunks.  If `commit` is `True` every chunk is
+    committed on its own, so huge sets don't end up in one long
+    transaction.  If given, `callback` is called with the number of
+    processed comments after every chunk.  `user` is the moderator and
+    defaults to the user of the current request.
+    """
+    status, events = ACTIONS[action]
+    app = get_application()
+    if user is None:
+        request = get_request()
+        user = request and request.user or None
+    blocked_msg = _get_blocked_msg(action, user)
+
+    # the widgets that show comments are dropped from the cache like for
+    # the events of the action, even if no events are emitted.
+    widget_tags = ['widget/' + widget.name for widget
+                   in app.widgets.itervalues()
+                   if set(events).intersection(getattr(widget,
+                                                       'invalidating_events',
+                                                       ()))]
+
+    comment_ids = list(comment_ids)
+    for offset in xrange(0, len(comment_ids), chunk_size):
+        chunk = comment_ids[offset:offset + chunk_size]
+        if emit_events:
+            for comment in Comment.query.filter(Comment.id.in_(chunk)):
+                for event in events:
+                    emit_event(event, comment)
+            db.flush()
+
+        in_chunk = comments.c.comment_id.in_(chunk)
+        post_ids = [x for x, in db.execute(db.select([comments.c.post_id],
+                                                     in_chunk,
+                                                     distinct=True))]
+        deltas = _count_comments(in_chunk)
+        if action == 'delete':
+            _merge_deltas(deltas, _delete_comments(chunk, emit_events))
+        else:
+            db.execute(comments.update(in_chunk),
+                       dict(status=status, blocked_msg=blocked_msg))
+        _merge_deltas(deltas, _count_comments(in_chunk), -1)
+        apply_deltas(db.session, deltas)
+        sync_comment_counts(post_ids)
+
+        invalidate_tags('comments', *(widget_tags +
+                                      ['post/%d' % x for x in post_ids]))
+        if commit:
+            db.commit()
+        if callback is not None:
+            callback(offset + len(chunk))
+
+    # the comments and posts in the session don't know about the changes
+    db.session.expire_all()
+    return len(comment_ids)
+
+
+def _get_status_filename(app):
+    return os.path.join(app.instance_folder, STATUS_FILENAME)
+
+
+def get_moderation_status(app):
+    """Return a dict with the status of the background moderation.
+    `running` is `True` if any process of the blog is moderating comments
+    in the background right now, `action`, `done` and `total` are the
+    action, the number of processed comments and the number of comments
+    of the running moderation.
+    """
+    filename = _get_status_filename(app)
+    rv = {
+        'running':  False,
+        'action':   None,
+        'done':     0,
+        'total':    0
+    }
+    try:
+        if time() - os.path.getmtime(filename) >= STATUS_TIMEOUT:
+            return rv
+        f = file(filename, 'rb')
+        try:
+            rv.update(load(f))
+        finally:
+            f.close()
+    except (OSError, IOError, EOFError):
+        # there is no status file or it's written right now
+        return rv
+    rv['running'] = True
+    return rv
+
+
+def _write_status(filename, action, done, total):
+    f = file(filename, 'wb')
+    try:
+        dump({'action': action, 'done': done, 'total': total}, f,
+             HIGHEST_PROTOCOL)
+    finally:
+        f.close()
+
+
+def start_moderation(app, comment_ids, action, emit_events=False,
+                     user=None):
+    """Apply a moderation action to the comments in a background thread.
+    Every chunk is committed on its own and the progress is written into a
+    status file, which is also used to track the running moderation in all
+    processes of the blog (see :func:`get_moderation_status`).  Returns
+    `False` if a background moderation is running already.
+    """
+    filename = _get_status_filename(app)
+    if os.path.exists(filename):
+        if get_moderation_status(app)['running']:
+            return False
+        # the process that moderated died
+        try:
+            os.remove(filename)
+        except OSError:
+            pass
+    try:
+        os.close(os.open(filename, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+    except OSError:
+        return False
+
+    comment_ids = list(comment_ids)
+    if user is None:
+        request = get_request()
+        user = request and request.user or None
+    user_id = user and user.id
+    _write_status(filename, action, 0, len(comment_ids))
+
+    def progress(done):
+        _write_status(filename, action, done, len(comment_ids))
+
+    def run():
+        try:
+            moderate_comments(comment_ids, action, emit_events, commit=True,
+                              user=user_id and User.query.get(user_id),
+                              callback=progress)
+        except Exception:
+            log.exception(_(u'Error while moderating comments'),
+                          'moderation')
+        finally:
+            cleanup_session()
+            os.remove(filename)
+
+    thread = threading.Thread(target=run)
+    thread.setDaemon(True)
+    thread.start()
+    return True
+
+
+def moderate(comment_ids, action, emit_events=False, commit=False):
+    """Moderate the comments right away or, if there are more than
+    `BACKGROUND_THRESHOLD` comments, in the background.  Returns
+    `MODERATED`, `STARTED` or `RUNNING` if nothing was done because a
+    background moderation is running already.
+    """
+    comment_ids = list(comment_ids)
+    if len(comment_ids) <= BACKGROUND_THRESHOLD:
+        moderate_comments(comment_ids, action, emit_events, commit=commit)
+        return MODERATED
+    if start_moderation(get_application(), comment_ids, action, emit_events):
+        return STARTED
+    return RUNNING
@@ -10,7 +10,9 @@
 """
 
 from zine.importers import Tag, Comment
-from zine.importers.feed import Extension, SkipItem, atom
+from zine.importers.feed import Extension, SkipItem, atom, \
+     _get_html_content
+from zine.utils.dates import parse_iso8601
 from zine.utils.xml import Namespace
 
 BLOGGER_LABEL_SCHEME_URI = 'http://www.blogger.com/atom/ns#'
@@ -42,8 +44,7 @@ class BloggerExtension(Extension):
 
     def __init__(self, app, parser, root):
         Extension.__init__(self, app, parser, root)
-        self._posts = {}
-        self._comments = []
+        self._comments = {}
         self._settings = {}
         self._authors = {}
 
@@ -72,38 +73,30 @@ class BloggerExtension(Extension):
         cfg['posts_per_page'] = int(get('BLOG_MAX_NUM', 10))
         cfg['blog_email'] = get('BLOG_COMMENT_EMAIL', '')
 
-    def _assign_comments(self):
-        """Assign comments to their respective posts."""
-        for (entry, body, pub_date) in self._comments:
-            for related in entry.findall(thr['in-reply-to']):
-                # this tag has the reference to the post the comment belongs to
-                post_id = related.attrib.get('ref')
-                if not post_id:
-                    continue
-                if post_id not in self._posts:
-                    print 'XXX unknown post for comment:', post_id
-                    continue
-                post = self._posts[post_id]
-                author_tag = entry.find(atom.author)
-                if author_tag is not None:
-                    author_uri = author_tag.findtext(atom.uri)
-                    # find the author -- either it's one of the post authors, in
-                    # which case we can use the same object
-                    if author_uri in self._authors:
-                        author = self._authors[author_uri]
-                        www = None
-                    # otherwise, make it an anonymous user
-                    else:
-                        author = author_tag.findtext(atom.name)
-                        www = author_tag.findtext(atom.uri)
-                else:
-                    author = None
-                comment = Comment(author, body, None, www, None,
-                                  pub_date, None, 'html')
-                post.comments.append(comment)
+    def scan_entry(self, entry):
+        # the comments are entries on their own that come after the posts,
+        # so they are collected before the posts are parsed
+        if self._blogger_entry_kind(entry) != 'comment':
+            return
+        pub_date = entry.findtext(atom.published) or \
+                   entry.findtext(atom.updated)
+        if pub_date is not None:
+            pub_date = parse_iso8601(pub_date)
+        body = _get_html_content(entry.findall(atom.content))
+        author_tag = entry.find(atom.author)
+        if author_tag is not None:
+            author = (author_tag.findtext(atom.name),
+                      author_tag.findtext(atom.uri))
+        else:
+            author = None
+        for related in entry.findall(thr['in-reply-to']):
+            # this tag has the reference to the post the comment belongs to
+            post_id = related.attrib.get('ref')
+            if post_id:
+                self._comments.setdefault(post_id, []).append(
+                    (author, body, pub_date))
 
     def handle_root(self, blog):
-        self._assign_comments()
         self._convert_settings(blog)
 
     def postprocess_post(self, post):
@@ -115,9 +108,7 @@ class BloggerExtension(Extension):
             # not a blogger entry
             return
         elif kind == 'post':
-            # ok, this is really a post, record it by ID and its author
-            self._posts[entry.findtext(atom.id)] = post
-            self._authors[post.author.www] = post.author
+            # ok, this is really a post
             return
         elif kind == 'settings':
             # put the settings in a dictionary; they are assigned to Zine
@@ -130,9 +121,7 @@ class BloggerExtension(Extension):
             # no way to keep that
             raise SkipItem
         elif kind == 'comment':
-            # keep the whole entry, but also don't throw away what parsing the
-            # Parser class already did for us
-            self._comments.append((entry, post.body, post.pub_date))
+            # the comments were collected by scan_entry()
             raise SkipItem
         else:
             # unknown blogger entry kind
@@ -148,9 +137,27 @@ class BloggerExtension(Extension):
             raise SkipItem
 
     def parse_comments(self, post):
-        # no way to parse comments here, we have to do this after all entries
-        # (which comments are in the blogger output) are parsed
-        return None
+        if self._blogger_entry_kind(post.element) != 'post':
+            return None
+        if post.author is not None:
+            self._authors[post.author.www] = post.author
+        result = []
+        for author, body, pub_date in self._comments.pop(
+                post.element.findtext(atom.id), ()):
+            www = None
+            if author is not None:
+                name, uri = author
+                # find the author -- either it's one of the post authors, in
+                # which case we can use the same object
+                if uri in self._authors:
+                    author = self._authors[uri]
+                # otherwise, make it an anonymous user
+                else:
+                    author = name
+                    www = uri
+            result.append(Comment(author, body, None, www, None,
+                                  pub_date, None, 'html'))
+        return result
 
     def tag_or_category(self, category):
         # assigning labels as tags, since they don't have a description
@@ -0,0 +1,402 @@
+# -*- coding: utf-8 -*-
+"""
+    zine.search
+    ~~~~~~~~~~~
+
+    Full text search for posts.  The posts are looked up in an index that
+    is kept by a search engine.  The engine is selected with the
+    ``search_engine`` configuration value, the following engines are
+    built in:
+
+    ``database``
+        an inverted index in the `search_index` table.  It works on every
+        database and is the fallback if the configured engine is not ready.
+
+    ``sqlite_fts``
+        a FTS5 table, if the database is SQLite and FTS5 was compiled in.
+
+    ``postgres``
+        a table with a `tsvector` column and a GIN index on PostgreSQL.
+        The text search configuration is the ``search_language``
+        configuration value.
+
+    Plugins can add engines with
+    :meth:`~zine.application.Zine.add_search_engine`.  The index is built
+    from the title and the text of the ZEML tree of a post, so markup never
+    ends up in it, and it's updated in the same transaction whenever posts
+    are flushed.  After switching to another engine the
+    ``rebuild-search-index`` script creates and fills its index.
+
+    :copyright: (c) 2010 by the Zine Team, see AUTHORS for more details.
+    :license: BSD, see LICENSE for more details.
+"""
+import re
+
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.orm.attributes import get_history
+from sqlalchemy.orm.interfaces import SessionExtension
+
+from zine.i18n import lazy_gettext
+from zine.application import get_application
+from zine.database import db, search_index, posts, texts, session_extensions
+from zine.models import Post
+
+
+#: words shorter or longer than that are not indexed
+MIN_WORD_LENGTH = 2
+MAX_WORD_LENGTH = 60
+
+#: a word in the title counts as much as that many words in the text
+TITLE_WEIGHT = 5
+
+_word_re = re.compile(r'\w+', re.UNICODE)
+
+
+def tokenize(text):
+    """Split a text into the lowercase words that are indexed.
+
+    >>> tokenize(u'Hello World, hello Zine-2!')
+    [u'hello', u'world', u'hello', u'zine']
+    """
+    return [word for word in _word_re.findall(text.lower())
+            if MIN_WORD_LENGTH <= len(word) <= MAX_WORD_LENGTH]
+
+
+def get_zeml_text(element):
+    """Return the text of a ZEML element without any markup."""
+    result = []
+    def _walk(element):
+        result.append(element.text or u'')
+        for child in getattr(element, 'children', ()):
+            _walk(child)
+            result.append(child.tail or u'')
+    if element is not None:
+        _walk(element)
+    return u' '.join(result)
+
+
+def get_document_text(parser_data):
+    """Return the text of the intro and body in the parser data of a
+    post.
+    """
+    if not parser_data:
+        return u''
+    return u' '.join(get_zeml_text(parser_data.get(key))
+                     for key in ('intro', 'body'))
+
+
+def get_terms(title, parser_data):
+    """Return a dict that maps the words of a post to their weights."""
+    terms = {}
+    for word in tokenize(title or u''):
+        terms[word] = terms.get(word, 0) + TITLE_WEIGHT
+    for word in tokenize(get_document_text(parser_data)):
+        terms[word] = terms.get(word, 0) + 1
+    return terms
+
+
+def iter_documents(batch_size=100):
+    """Iterate over all posts as ``(post_id, title, parser_data)`` tuples.
+    The posts are loaded in batches, without the models.
+    """
+    last_id = None
+    while 1:
+        query = db.select([posts.c.post_id, posts.c.title,
+                           texts.c.parser_data],
+                          from_obj=[posts.join(texts)],
+                          order_by=[posts.c.post_id], limit=batch_size)
+        if last_id is not None:
+            query = query.where(posts.c.post_id > last_id)
+        rows = db.execute(query).fetchall()
+        if not rows:
+            break
+        for row in rows:
+            yield tuple(row)
+        last_id = rows[-1][0]
+
+
+class SearchEngine(object):
+    """Baseclass for search engines.  An engine is created once per
+    application, the documents it indexes are ``(post_id, title,
+    parser_data)`` tuples.
+    """
+
+    #: the name of the engine shown to the user
+    name = None
+
+    def __init__(self, app):
+        self.app = app
+
+    def is_available(self):
+        """Return `True` if the engine works with the database."""
+        return True
+
+    def is_ready(self):
+        """Return `True` if the index of the engine exists.  Until then the
+        builtin engine is used.
+        """
+        return True
+
+    def create(self):
+        """Create the index if it doesn't exist yet."""
+
+    def clear(self, session):
+        """Remove all posts from the index."""
+        raise NotImplementedError()
+
+    def index_posts(self, session, documents):
+        """Add the documents to the index or update them."""
+        raise NotImplementedError()
+
+    def remove_posts(self, session, post_ids):
+        """Remove the posts with the given ids from the index."""
+        raise NotImplementedError()
+
+    def match(self, words):
+        """Return a select for the posts that contain all the words (see
+        :func:`tokenize`) with a ``post_id`` and a ``score`` column or
+        `None` if no post matches.  Higher scores are better matches.
+        """
+        raise NotImplementedError()
+
+
+class DatabaseSearchEngine(SearchEngine):
+    """An inverted index in the `search_index` table.  The score of a post
+    is the weight of each word divided by the number of posts with the
+    word, so that rare words count more.
+    """
+
+    name = lazy_gettext(u'Built-in index')
+
+    def clear(self, session):
+        session.execute(search_index.delete())
+
+    def index_posts(self, session, documents):
+        documents = list(documents)
+        self.remove_posts(session, [x[0] for x in documents])
+        rows = []
+        for post_id, title, parser_data in documents:
+            for word, weight in get_terms(title, parser_data).iteritems():
+                rows.append(dict(word=word, post_id=post_id, weight=weight))
+        if rows:
+            session.execute(search_index.insert(), rows)
+
+    def remove_posts(self, session, post_ids):
+        if post_ids:
+            session.execute(search_index.delete(
+                search_index.c.post_id.in_(post_ids)))
+
+    def match(self, words):
+        words = set(words)
+        frequencies = dict(db.execute(db.select([search_index.c.word,
+            db.func.count(search_index.c.post_id)],
+            search_index.c.word.in_(words),
+            group_by=[search_index.c.word])).fetchall())
+        if len(frequencies) < len(words):
+            return None
+        idf = db.case([(search_index.c.word == word, 1.0 / count)
+                       for word, count in frequencies.iteritems()])
+        return db.select([search_index.c.post_id,
+                          db.func.sum(search_index.c.weight * idf)
+                            .label('score')],
+                         search_index.c.word.in_(words),
+                         group_by=[search_index.c.post_id],
+                         having=db.func.count(search_index.c.word) ==
+                                len(words))
+
+
+class _ExternalSearchEngine(SearchEngine):
+    """Baseclass for engines that keep their index in a table that is not
+    part of the core schema and has to be created with :meth:`create`.
+    """
+
+    table = None
+    _ready = False
+
+    def is_ready(self):
+        if not self._ready:
+            self._ready = self.app.database_engine.has_table(self.table) \
+                and self.is_available()
+        return self._ready
+
+    def clear(self, session):
+        session.execute(db.text('DELETE FROM %s' % self.table))
+
+
+class SQLiteSearchEngine(_ExternalSearchEngine):
+    """Uses a FTS5 table of SQLite, ranked with bm25."""
+
+    name = lazy_gettext(u'SQLite full text search')
+    table = 'search_fts'
+
+    def is_available(self):
+        engine = self.app.database_engine
+        if engine.dialect.name != 'sqlite':
+            return False
+        try:
+            engine.execute('CREATE VIRTUAL TABLE temp.search_fts_check '
+                           'USING fts5(text)')
+            engine.execute('DROP TABLE temp.search_fts_check')
+        except DBAPIError:
+            return False
+        return True
+
+    def create(self):
+        self.app.database_engine.execute('CREATE VIRTUAL TABLE IF NOT '
+                                         'EXISTS search_fts USING '
+                                         'fts5(title, text)')
+        self._ready = False
+
+    def index_posts(self, session, documents):
+        documents = list(documents)
+        self.remove_posts(session, [x[0] for x in documents])
+        if documents:
+            session.execute(db.text('INSERT INTO search_fts (rowid, title, '
+                                    'text) VALUES (:post_id, :title, '
+                                    ':text)'),
+                            [dict(post_id=post_id, title=title or u'',
+                                  text=get_document_text(parser_data))
+                             for post_id, title, parser_data in documents])
+
+    def remove_posts(self, session, post_ids):
+        if post_ids:
+            session.execute(db.text('DELETE FROM search_fts WHERE rowid '
+                                    'IN (%s)' % ', '.join('%d' % x for x
+                                                          in post_ids)))
+
+    def match(self, words):
+        # the words only contain word characters, so quoting them makes
+        # sure FTS5 doesn't take them for operators.
+        query = u' '.join(u'"%s"' % word for word in words)
+        return db.select([db.literal_column('rowid').label('post_id'),
+                          db.literal_column('-bm25(search_fts, %d, 1)' %
+                                            TITLE_WEIGHT).label('score')],
+                         db.text('search_fts MATCH :search_query',
+                                 bindparams=[db.bindparam('search_query',
+                                                          query)]),
+                         from_obj=[db.table('search_fts')])
+
+
+class PostgresSearchEngine(_ExternalSearchEngine):
+    """Uses a `tsvector` column with a GIN index, ranked with `ts_rank`.
+    Words in the title get the weight A, the text the weight B.
+    """
+
+    name = lazy_gettext(u'PostgreSQL full text search')
+    table = 'search_documents'
+
+    def is_available(self):
+        return self.app.database_engine.dialect.name in ('postgres',
+                                                         'postgresql')
+
+    def create(self):
+        engine = self.app.database_engine
+        if not engine.has_table(self.table):
+            engine.execute('CREATE TABLE search_documents (post_id integer '
+                           'PRIMARY KEY, document tsvector NOT NULL)')
+            engine.execute('CREATE INDEX ix_search_documents_document ON '
+                           'search_documents USING gin(document)')
+        self._ready = False
+
+    def index_posts(self, session, documents):
+        documents = list(documents)
+        self.remove_posts(session, [x[0] for x in documents])
+        if documents:
+            language = self.app.cfg['search_language']
+            session.execute(db.text('INSERT INTO search_documents (post_id, '
+                                    'document) VALUES (:post_id, setweight('
+                                    'to_tsvector(:language, :title), \'A\') '
+                                    '|| setweight(to_tsvector(:language, '
+                                    ':text), \'B\'))'),
+                            [dict(post_id=post_id, language=language,
+                                  title=title or u'',
+                                  text=get_document_text(parser_data))
+                             for post_id, title, parser_data in documents])
+
+    def remove_posts(self, session, post_ids):
+        if post_ids:
+            session.execute(db.text('DELETE FROM search_documents WHERE '
+                                    'post_id IN (%s)' % ', '.join('%d' % x
+                                    for x in post_ids)))
+
+    def match(self, words):
+        query = db.func.plainto_tsquery(self.app.cfg['search_language'],
+                                        u' '.join(words))
+        document = db.literal_column('document')
+        return db.select([db.literal_column('post_id'),
+                          db.func.ts_rank(document, query).label('score')],
+                         document.op('@@')(query),
+                         from_obj=[db.table('search_documents')])
+
+
+def get_search_engine():
+    """Return the configured search engine or the builtin one if the
+    index of the configured engine was not created yet.
+    """
+    app = get_application()
+    engine = app.search_engines.get(app.cfg['search_engine'])
+    if engine is None or not engine.is_ready():
+        engine = app.search_engines['database']
+    return engine
+
+
+def rebuild_index(engine=None):
+    """Create the index of the engine (by default the configured one) and
+    index all posts again.  Returns the number of indexed posts.  The
+    changes are not committed.
+    """
+    if engine is None:
+        app = get_application()
+        engine = app.search_engines[app.cfg['search_engine']]
+    engine.create()
+    engine.clear(db.session)
+    count = 0
+    batch = []
+    for document in iter_documents():
+        batch.append(document)
+        if len(batch) >= 100:
+            engine.index_posts(db.session, batch)
+            count += len(batch)
+            del batch[:]
+    engine.index_posts(db.session, batch)
+    return count + len(batch)
+
+
+def _is_changed(post):
+    """Check if the indexed attributes of a post changed."""
+    for key in 'title', 'parser_data':
+        history = get_history(post, key)
+        if history.added or history.deleted:
+            return True
+    return False
+
+
+class SearchIndexExtension(SessionExtension):
+    """Updates the search index when posts are flushed."""
+
+    def after_flush(self, session, flush_context):
+        documents = []
+        removed = []
+        for state, (is_deleted, list_only) in flush_context.states.items():
+            post = state.obj()
+            if list_only or not isinstance(post, Post):
+                continue
+            if is_deleted:
+                removed.append(post.id)
+            elif state.key is None or _is_changed(post):
+                documents.append((post.id, post.title, post.parser_data))
+        if documents or removed:
+            engine = get_search_engine()
+            engine.remove_posts(session, removed)
+            engine.index_posts(session, documents)
+
+
+#: the builtin search engines
+all_engines = {
+    'database':         DatabaseSearchEngine,
+    'sqlite_fts':       SQLiteSearchEngine,
+    'postgres':         PostgresSearchEngine
+}
+
+
+session_extensions.append(SearchIndexExtension())
@@ -10,8 +10,11 @@
 """
 from werkzeug import abort
 
-from zine.models import Comment, Tag
-from zine.privileges import MODERATE_COMMENTS
+from zine.application import url_for
+from zine.cache import get_stats as get_cache_stats
+from zine.database import get_pool_stats
+from zine.models import Comment, Tag, SummarizedPost
+from zine.privileges import MODERATE_COMMENTS, BLOG_ADMIN
 from zine.utils.dates import to_timestamp
 
 
@@ -48,7 +51,44 @@ def do_get_taglist(req):
     }
 
 
+def do_search_posts(req):
+    query = req.values.get('q', u'').strip()
+    page = max(req.values.get('page', 1, type=int), 1)
+    per_page = min(max(req.values.get('per_page', 10, type=int), 1), 50)
+    posts = SummarizedPost.query.published().search(query)
+    return {
+        'query':        query,
+        'page':         page,
+        'total':        posts.count(),
+        'posts':        [{
+            'id':           post.id,
+            'title':        post.title,
+            'url':          url_for(post, _external=True),
+            'pub_date':     to_timestamp(post.pub_date)
+        } for post in posts.offset(per_page * (page - 1)).limit(per_page)]
+    }
+
+
+def do_get_cache_stats(req):
+    if not req.user.has_privilege(BLOG_ADMIN):
+        abort(403)
+    return {
+        'stats':        get_cache_stats()
+    }
+
+
+def do_get_pool_stats(req):
+    if not req.user.has_privilege(BLOG_ADMIN):
+        abort(403)
+    return {
+        'stats':        get_pool_stats()
+    }
+
+
 all_services = {
     'get_comment':          do_get_comment,
-    'get_taglist':          do_get_taglist
+    'get_taglist':          do_get_taglist,
+    'search_posts':         do_search_posts,
+    'get_cache_stats':      do_get_cache_stats,
+    'get_pool_stats':       do_get_pool_stats
 }
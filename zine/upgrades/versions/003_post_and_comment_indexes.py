@@ -0,0 +1,104 @@
+"""Indexes for the post listings, comments, tags and categories"""
+from sqlalchemy.exceptions import ProgrammingError, OperationalError
+
+from zine.upgrades.versions import *
+
+metadata = db.MetaData()
+
+# Define tables here.  Only the indexed columns are required.
+posts = db.Table('posts', metadata,
+    db.Column('post_id', db.Integer, primary_key=True),
+    db.Column('pub_date', db.DateTime),
+    db.Column('author_id', db.Integer),
+    db.Column('content_type', db.String(40)),
+    db.Column('status', db.Integer)
+)
+
+comments = db.Table('comments', metadata,
+    db.Column('comment_id', db.Integer, primary_key=True),
+    db.Column('post_id', db.Integer),
+    db.Column('pub_date', db.DateTime),
+    db.Column('status', db.Integer, nullable=False)
+)
+
+post_categories = db.Table('post_categories', metadata,
+    db.Column('post_id', db.Integer),
+    db.Column('category_id', db.Integer)
+)
+
+post_tags = db.Table('post_tags', metadata,
+    db.Column('post_id', db.Integer),
+    db.Column('tag_id', db.Integer)
+)
+
+indexes = [
+    db.Index('ix_posts_status_pub_date', posts.c.status, posts.c.pub_date),
+    db.Index('ix_posts_content_type_status_pub_date', posts.c.content_type,
+             posts.c.status, posts.c.pub_date),
+    db.Index('ix_posts_author_id_pub_date', posts.c.author_id,
+             posts.c.pub_date),
+    db.Index('ix_comments_post_id_status', comments.c.post_id,
+             comments.c.status, comments.c.pub_date),
+    db.Index('ix_comments_status_pub_date', comments.c.status,
+             comments.c.pub_date),
+    db.Index('ix_post_categories_post_id', post_categories.c.post_id,
+             post_categories.c.category_id),
+    db.Index('ix_post_categories_category_id', post_categories.c.category_id,
+             post_categories.c.post_id),
+    db.Index('ix_post_tags_post_id', post_tags.c.post_id, post_tags.c.tag_id),
+    db.Index('ix_post_tags_tag_id', post_tags.c.tag_id, post_tags.c.post_id)
+]
+
+
+def create_index(index, migrate_engine):
+    """Create an index without blocking writes to the table where the
+    database supports it, so that large blogs can stay online.
+    """
+    dialect = migrate_engine.dialect.name
+    columns = ', '.join(column.name for column in index.columns)
+    if dialect in ('postgres', 'postgresql'):
+        # concurrent index builds are not possible inside a transaction
+        # block, so the connection is switched to autocommit for it.
+        con = migrate_engine.raw_connection()
+        try:
+            con.connection.set_isolation_level(0)
+            try:
+                con.cursor().execute('CREATE INDEX CONCURRENTLY %s ON %s '
+                                     '(%s)' % (index.name, index.table.name,
+                                               columns))
+            finally:
+                con.connection.set_isolation_level(1)
+        finally:
+            con.close()
+    elif dialect == 'mysql':
+        try:
+            migrate_engine.execute(text('ALTER TABLE %s ADD INDEX %s (%s), '
+                                        'ALGORITHM=INPLACE, LOCK=NONE' % (
+                                        index.table.name, index.name,
+                                        columns)))
+        except (ProgrammingError, OperationalError):
+            # MySQL before 5.6 doesn't know about online index creation
+            index.create(migrate_engine)
+    else:
+        index.create(migrate_engine)
+
+
+def upgrade(migrate_engine):
+    # Upgrade operations go here. Don't create your own engine
+    # bind migrate_engine to your metadata
+    yield '<p>Creating indexes for the most frequent queries.  This can '
+    yield 'take a while on large blogs.</p>\n'
+    yield '<ul>'
+    for index in indexes:
+        yield '  <li>Create index %s</li>\n' % index.name
+        create_index(index, migrate_engine)
+    yield '</ul>'
+
+
+def downgrade(migrate_engine):
+    # Operations to reverse the above upgrade go here.
+    yield '<ul>'
+    for index in reversed(indexes):
+        yield '  <li>Drop index %s</li>\n' % index.name
+        index.drop(migrate_engine)
+    yield '</ul>'
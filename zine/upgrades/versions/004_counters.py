@@ -0,0 +1,38 @@
+"""Counters for the number of posts and comments"""
+from zine.upgrades.versions import *
+
+metadata = db.MetaData()
+
+# Define tables here.  The counted tables are the ones of zine.counters.
+counters = db.Table('counters', metadata,
+    db.Column('scope', db.String(40), primary_key=True),
+    db.Column('name', db.String(200), primary_key=True),
+    db.Column('value', db.Integer, nullable=False, default=0)
+)
+
+
+def upgrade(migrate_engine):
+    # Upgrade operations go here. Don't create your own engine
+    # bind migrate_engine to your metadata
+    from zine.counters import _get_families
+    yield '<ul>'
+    yield '  <li>Create the counters table</li>\n'
+    counters.create(migrate_engine)
+    yield '  <li>Count the posts and comments</li>\n'
+    for scope, format, columns, from_obj, where in _get_families():
+        query = db.select(columns + [db.func.count()], where,
+                          from_obj=from_obj, group_by=columns)
+        rows = [dict(scope=scope, name=format % row[:-1], value=row[-1])
+                for row in map(tuple, migrate_engine.execute(query))
+                if None not in row[:-1]]
+        if rows:
+            migrate_engine.execute(counters.insert(), rows)
+    yield '</ul>'
+
+
+def downgrade(migrate_engine):
+    # Operations to reverse the above upgrade go here.
+    yield '<ul>'
+    yield '  <li>Drop the counters table</li>\n'
+    yield '</ul>'
+    counters.drop(migrate_engine)
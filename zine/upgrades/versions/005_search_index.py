@@ -0,0 +1,60 @@
+"""Search index for the posts"""
+from zine.upgrades.versions import *
+
+metadata = db.MetaData()
+
+# Define tables here.  Only the indexed columns are required.
+texts = db.Table('texts', metadata,
+    db.Column('text_id', db.Integer, primary_key=True),
+    db.Column('parser_data', db.ZEMLParserData)
+)
+
+posts = db.Table('posts', metadata,
+    db.Column('post_id', db.Integer, primary_key=True),
+    db.Column('title', db.String(150)),
+    db.Column('text_id', db.Integer, db.ForeignKey('texts.text_id'))
+)
+
+search_index = db.Table('search_index', metadata,
+    db.Column('word', db.String(60), primary_key=True),
+    db.Column('post_id', db.Integer, primary_key=True),
+    db.Column('weight', db.Integer, nullable=False)
+)
+
+post_id_index = db.Index('ix_search_index_post_id', search_index.c.post_id)
+
+
+def upgrade(migrate_engine):
+    # Upgrade operations go here. Don't create your own engine
+    # bind migrate_engine to your metadata
+    from zine.search import get_terms
+    yield '<ul>'
+    yield '  <li>Create the search index table</li>\n'
+    search_index.create(migrate_engine)
+    post_id_index.create(migrate_engine)
+    yield '  <li>Index the posts</li>\n'
+    last_id = 0
+    while 1:
+        rows = migrate_engine.execute(db.select([posts.c.post_id,
+            posts.c.title, texts.c.parser_data], posts.c.post_id > last_id,
+            from_obj=[posts.join(texts)], order_by=[posts.c.post_id],
+            limit=100)).fetchall()
+        if not rows:
+            break
+        values = []
+        for post_id, title, parser_data in rows:
+            for word, weight in get_terms(title, parser_data).iteritems():
+                values.append(dict(word=word, post_id=post_id,
+                                   weight=weight))
+        if values:
+            migrate_engine.execute(search_index.insert(), values)
+        last_id = rows[-1][0]
+    yield '</ul>'
+
+
+def downgrade(migrate_engine):
+    # Operations to reverse the above upgrade go here.
+    yield '<ul>'
+    yield '  <li>Drop the search index table</li>\n'
+    yield '</ul>'
+    search_index.drop(migrate_engine)
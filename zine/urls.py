@@ -24,6 +24,7 @@ def make_urls(app):
         ]),
         Rule('/page/<int:page>', endpoint='blog/index'),
         Rule('/archive', endpoint='blog/archive'),
+        Rule('/search', endpoint='blog/search'),
         Submount(app.cfg['profiles_url_prefix'], [
             Rule('/', endpoint='blog/authors'),
             Rule('/<string:username>', defaults={'page': 1}, endpoint='blog/show_author'),
@@ -137,10 +138,14 @@ def make_urls(app):
         Rule('/options/configuration', endpoint='admin/configuration'),
         Rule('/system/', endpoint='admin/information'),
         Rule('/system/maintenance', endpoint='admin/maintenance'),
+        Rule('/system/queries', endpoint='admin/query_profile'),
         Rule('/system/log', defaults={'page': 1}, endpoint='admin/log'),
         Rule('/system/log/page/<int:page>', endpoint='admin/log'),
         Rule('/system/import/', endpoint='admin/import'),
-        Rule('/system/import/<int:id>', endpoint='admin/inspect_import'),
+        Rule('/system/import/<int:id>', defaults={'page': 1},
+             endpoint='admin/inspect_import'),
+        Rule('/system/import/<int:id>/page/<int:page>',
+             endpoint='admin/inspect_import'),
         Rule('/system/import/<int:id>/delete', endpoint='admin/delete_import'),
         Rule('/system/export', endpoint='admin/export'),
         Rule('/system/plugins/', endpoint='admin/plugins'),
@@ -8,6 +8,9 @@
     :copyright: (c) 2010 by the Zine Team, see AUTHORS for more details.
     :license: BSD, see LICENSE for more details.
 """
+import atexit
+import threading
+from weakref import ref as weakref
 from itertools import izip, imap
 from copy import deepcopy
 
@@ -78,6 +81,105 @@ class ReadOnlyMultiMapping(object):
         return result
 
 
+class _BucketOwner(object):
+    """Stored in the thread local of :class:`ThreadBuckets`, it goes away
+    together with the thread.
+    """
+    __slots__ = ('__weakref__',)
+
+
+class ThreadBuckets(object):
+    """Statistics that are counted per thread so that counting doesn't
+    require a lock.  :meth:`get` returns the bucket of the current thread
+    which is created by calling `factory`, `merge` is called with a target
+    bucket and another bucket and adds the values of the latter to the
+    target.  When a thread ends its bucket is merged into the bucket of the
+    ended threads, so the number of buckets only grows with the number of
+    threads that are alive.
+
+    >>> def merge(target, bucket):
+    ...     for key, value in bucket.iteritems():
+    ...         target[key] = target.get(key, 0) + value
+    >>> buckets = ThreadBuckets(dict, merge)
+    >>> buckets.get()['hits'] = 1
+    >>> def count():
+    ...     buckets.get()['hits'] = 2
+    >>> thread = threading.Thread(target=count)
+    >>> thread.start(); thread.join()
+    >>> buckets.total()
+    {'hits': 3}
+    >>> buckets.reset()
+    >>> buckets.total()
+    {}
+    """
+
+    #: set when the interpreter shuts down.  The buckets of the threads
+    #: that are still running are not merged then because the modules of
+    #: the merge functions are already torn down.
+    _shutdown = False
+
+    def __init__(self, factory, merge):
+        self.factory = factory
+        self.merge = merge
+        self._local = threading.local()
+        self._lock = threading.RLock()
+        self._buckets = {}
+        self._ended = factory()
+
+    def get(self):
+        """Return the bucket of the current thread."""
+        try:
+            return self._local.bucket
+        except AttributeError:
+            pass
+        bucket = self._local.bucket = self.factory()
+        owner = self._local.owner = _BucketOwner()
+        self._lock.acquire()
+        try:
+            self._buckets[weakref(owner, self._thread_ended)] = bucket
+        finally:
+            self._lock.release()
+        return bucket
+
+    def _thread_ended(self, owner):
+        if self._shutdown:
+            return
+        self._lock.acquire()
+        try:
+            bucket = self._buckets.pop(owner, None)
+            if bucket is not None:
+                self.merge(self._ended, bucket)
+        finally:
+            self._lock.release()
+
+    def total(self):
+        """Return a new bucket with the values of all buckets."""
+        rv = self.factory()
+        self._lock.acquire()
+        try:
+            for bucket in [self._ended] + self._buckets.values():
+                self.merge(rv, bucket)
+        finally:
+            self._lock.release()
+        return rv
+
+    def reset(self):
+        """Empty all the buckets.  This requires buckets with a `clear`
+        method (like dicts).
+        """
+        self._lock.acquire()
+        try:
+            for bucket in [self._ended] + self._buckets.values():
+                bucket.clear()
+        finally:
+            self._lock.release()
+
+
+def _mark_shutdown():
+    ThreadBuckets._shutdown = True
+atexit.register(_mark_shutdown)
+
+
 class _PickleProtocol2Sucks(object):
     """This class implements a dummy container that just eats up all
     the stuff appended to it.  It exists because pickle protocol 2 feeds
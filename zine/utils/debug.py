@@ -14,17 +14,34 @@ import sys
 from werkzeug import escape
 
 from zine.application import url_for
+from zine.utils.datastructures import ThreadBuckets
 
 
 _body_end_re = re.compile(r'</\s*(body|html)(?i)')
+_literal_re = re.compile(r"'(?:[^']|'')*'|%\(\w+\)s|%s|:\w+|\?|"
+                         r"(?<![\w.])-?\d+(?:\.\d+)?(?![\w.])")
+_value_list_re = re.compile(r'\(\s*\?(?:\s*,\s*\?)*\s*\)')
+_whitespace_re = re.compile(r'\s+')
 
 
 def find_calling_context(skip=2):
-    """Finds the calling context."""
+    """Finds the calling context.  If the call happened while a template
+    was rendered, the template line is added.
+    """
     frame = sys._getframe(skip)
+    rv = None
     while frame.f_back is not None:
+        template = frame.f_globals.get('__jinja_template__')
+        if template is not None:
+            location = '%s:%s (template)' % (
+                template.name,
+                template.get_corresponding_lineno(frame.f_lineno)
+            )
+            if rv is None:
+                return location
+            return '%s from %s' % (rv, location)
         name = frame.f_globals.get('__name__')
-        if name and name.startswith('zine.'):
+        if rv is None and name and name.startswith('zine.'):
             funcname = frame.f_code.co_name
             if 'self' in frame.f_locals:
                 funcname = '%s.%s of %s' % (
@@ -32,13 +49,131 @@ def find_calling_context(skip=2):
                     funcname,
                     hex(id(frame.f_locals['self']))
                 )
-            return '%s:%s (%s)' % (
+            rv = '%s:%s (%s)' % (
                 frame.f_code.co_filename,
                 frame.f_lineno,
                 funcname
             )
         frame = frame.f_back
-    return '<unknown>'
+    return rv or '<unknown>'
+
+
+def normalize_statement(statement):
+    """Normalize an SQL statement for the query profile.  Literals and
+    parameters are replaced with question marks and lists of them with
+    an ellipsis, so that all executions of a query have the same shape.
+
+    >>> normalize_statement("SELECT * FROM posts\\nWHERE post_id IN (%s, %s) "
+    ...                     "AND status = 2 AND slug = 'foo'")
+    'SELECT * FROM posts WHERE post_id IN (...) AND status = ? AND slug = ?'
+    """
+    statement = _literal_re.sub('?', statement)
+    statement = _value_list_re.sub('(...)', statement)
+    return _whitespace_re.sub(' ', statement).strip()
+
+
+def _merge_profiles(target, bucket):
+    for endpoint, (requests, queries, duration, statements) \
+            in bucket.items():
+        total = target.get(endpoint)
+        if total is None:
+            total = target[endpoint] = [0, 0, 0.0, {}]
+        total[0] += requests
+        total[1] += queries
+        total[2] += duration
+        for key, stats in statements.items():
+            merged = total[3].get(key)
+            if merged is None:
+                total[3][key] = list(stats)
+                continue
+            merged[0] += stats[0]
+            merged[1] += stats[1]
+            merged[2] = max(merged[2], stats[2])
+            merged[3] += stats[3]
+            if stats[4]:
+                merged[5] = stats[5]
+            merged[4] += stats[4]
+
+
+# the query profile is collected per thread so that no locking is
+# required, like the cache statistics.
+_profiles = ThreadBuckets(dict, _merge_profiles)
+
+
+def record_queries(endpoint, queries, n_plus_one_threshold):
+    """Add the queries of a request to the query profile of the endpoint.
+    `queries` is the list of queries collected by the
+    :class:`~zine.database.ConnectionDebugProxy`.  Statements with the same
+    shape that are executed more than `n_plus_one_threshold` times in the
+    request are flagged as N+1 queries.
+    """
+    executions = {}
+    for statement, parameters, start, end, calling_context in queries:
+        key = normalize_statement(statement)
+        item = executions.get(key)
+        if item is None:
+            item = executions[key] = [0, 0.0, 0.0, calling_context]
+        item[0] += 1
+        item[1] += end - start
+        item[2] = max(item[2], end - start)
+
+    bucket = _profiles.get()
+    profile = bucket.get(endpoint)
+    if profile is None:
+        profile = bucket[endpoint] = [0, 0, 0.0, {}]
+    profile[0] += 1
+    for key, (count, duration, max_duration, calling_context) \
+            in executions.iteritems():
+        profile[1] += count
+        profile[2] += duration
+        stats = profile[3].get(key)
+        if stats is None:
+            stats = profile[3][key] = [0, 0.0, 0.0, 0, 0, calling_context]
+        stats[0] += count
+        stats[1] += duration
+        stats[2] = max(stats[2], max_duration)
+        stats[3] += 1
+        if count > n_plus_one_threshold:
+            stats[4] += 1
+            stats[5] = calling_context
+
+
+def get_query_profile():
+    """Return the query profile of this process.  The return value is a
+    list of dicts, one for each endpoint, with the number of `requests`,
+    `queries` and the `time` spent in the database.  The `statements` of
+    an endpoint are dicts with the normalized `statement`, the `count` and
+    `time` of all executions, the `max_time` of one execution, the number
+    of `requests` that executed it and how many of them executed it often
+    enough to be an N+1 query (`n_plus_one`).  `context` is the calling
+    context, for N+1 queries the one of the last flagged request.
+    """
+    rv = []
+    for endpoint, (requests, queries, duration, statements) \
+            in _profiles.total().iteritems():
+        rv.append({
+            'endpoint':     endpoint,
+            'requests':     requests,
+            'queries':      queries,
+            'time':         duration,
+            'statements':   sorted([{
+                'statement':    key,
+                'count':        stats[0],
+                'time':         stats[1],
+                'max_time':     stats[2],
+                'requests':     stats[3],
+                'n_plus_one':   stats[4],
+                'context':      stats[5]
+            } for key, stats in statements.iteritems()],
+                key=lambda x: -x['time'])
+        })
+    rv.sort(key=lambda x: -x['time'])
+    return rv
+
+
+def reset_query_profile():
+    """Forget the query profile of this process."""
+    _profiles.reset()
 
 
 def render_query_table(queries):
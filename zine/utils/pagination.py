@@ -9,17 +9,60 @@
     :license: BSD, see LICENSE for more details.
 """
 import math
+from base64 import urlsafe_b64encode, urlsafe_b64decode
+from datetime import datetime
+
+from werkzeug import url_encode
 
 from zine.i18n import _
 
 
+def make_cursor(direction, pub_date, post_id):
+    """Create an opaque cursor for keyset pagination.  `direction` is
+    ``'next'`` for the posts after the post with the given publication date
+    and id or ``'prev'`` for the posts before it.
+
+    >>> make_cursor('next', datetime(2010, 2, 3, 4, 5, 6), 42)
+    'bjIwMTAwMjAzMDQwNTA2MDAwMDAwLjQy'
+    """
+    value = '%s%s.%d' % (direction[0], pub_date.strftime('%Y%m%d%H%M%S') +
+                         '%06d' % pub_date.microsecond, post_id)
+    return urlsafe_b64encode(value).rstrip('=')
+
+
+def parse_cursor(cursor):
+    """Parse a cursor created by :func:`make_cursor`.  Returns a tuple in
+    the form ``(direction, pub_date, post_id)`` or `None` if the cursor is
+    invalid.
+
+    >>> parse_cursor('bjIwMTAwMjAzMDQwNTA2MDAwMDAwLjQy')
+    ('next', datetime.datetime(2010, 2, 3, 4, 5, 6), 42)
+    >>> parse_cursor('garbage') is None
+    True
+    """
+    try:
+        value = urlsafe_b64decode(str(cursor) + '=' * (-len(cursor) % 4))
+        direction = {'n': 'next', 'p': 'prev'}[value[0]]
+        date_string, post_id = value[1:].split('.')
+        pub_date = datetime(*map(int, (date_string[:4], date_string[4:6],
+                                       date_string[6:8], date_string[8:10],
+                                       date_string[10:12], date_string[12:14],
+                                       date_string[14:])))
+        return direction, pub_date, int(post_id)
+    except (TypeError, ValueError, KeyError, IndexError, UnicodeError):
+        return None
+
+
 class Pagination(object):
-    """Pagination helper."""
+    """Pagination helper.  If `next_cursor` and `prev_cursor` are given the
+    links to the next and previous page carry them so that the posts of
+    those pages can be looked up without an offset.
+    """
 
     _skip_theme_defaults = False
 
     def __init__(self, endpoint, page, per_page, total, url_args=None,
-                 post_id=None):
+                 post_id=None, next_cursor=None, prev_cursor=None):
         self.endpoint = endpoint
         self.page = page
         self.per_page = per_page
@@ -28,6 +71,22 @@ class Pagination(object):
         self.post_id = post_id
         self.url_args = url_args or {}
         self.necessary = self.pages > 1
+        self.next_cursor = next_cursor
+        self.prev_cursor = prev_cursor
+
+    def get_url(self, page):
+        """Return the URL of a page."""
+        from zine.application import url_for
+        args = dict(self.url_args)
+        if page == self.page + 1 and self.next_cursor is not None:
+            args['cursor'] = self.next_cursor
+        # the first page is always linked without cursor so that there
+        # is only one URL for it
+        elif page == self.page - 1 and page > 1 and \
+             self.prev_cursor is not None:
+            args['cursor'] = self.prev_cursor
+        return url_for(self.endpoint, page=page, per_page=self.per_page,
+                       post_id=self.post_id, **args)
 
     def __unicode__(self):
         return self.generate()
@@ -38,8 +97,7 @@ class Pagination(object):
         These arguments have the same name as the theme setting variables
         without the `pagination.` prefix.
         """
-        from zine.application import url_for, get_application, \
-             DEFAULT_THEME_SETTINGS
+        from zine.application import get_application, DEFAULT_THEME_SETTINGS
 
         if self._skip_theme_defaults:
             settings = DEFAULT_THEME_SETTINGS
@@ -71,9 +129,7 @@ class Pagination(object):
         result = []
         prev = None
         next = None
-        get_link = lambda x: url_for(self.endpoint, page=x,
-                                     per_page=self.per_page,
-                                     post_id=self.post_id, **self.url_args)
+        get_link = self.get_url
 
         if simple:
             result.append(active % {
@@ -130,3 +186,20 @@ class AdminPagination(Pagination):
     that the settings from the theme do not affect the display.
     """
     _skip_theme_defaults = True
+
+
+class CommentPagination(Pagination):
+    """Pagination for the root comments of a post.  The pages are linked
+    with the ``comments_page`` argument on the URL of the post.
+    """
+
+    def __init__(self, post, page, per_page, total):
+        Pagination.__init__(self, None, page, per_page, total)
+        self.post = post
+
+    def get_url(self, page):
+        from zine.application import url_for
+        url = url_for(self.post)
+        if page > 1:
+            url += '?' + url_encode({'comments_page': page})
+        return url + '#comments'
@@ -5,14 +5,115 @@
 
     This module implements the access to the redirect table.
 
+    Every process keeps the whole table in a dict so that URLs that are
+    not found (which are looked up here before the 404 page is shown)
+    don't cause a database query.  Changes to the table bump the
+    ``'redirects'`` cache tag when the transaction is committed, the
+    processes check the generation of the tag every few seconds and load
+    the table again if it changed.  If the cache is not shared between the
+    processes the ``redirects/version`` counter (which is incremented in
+    the same transaction as the changes) is checked instead.
+
     :copyright: (c) 2010 by the Zine Team, see AUTHORS for more details.
     :license: BSD, see LICENSE for more details.
 """
+from threading import Lock
+from time import time
+
+from sqlalchemy.orm.interfaces import SessionExtension
+from werkzeug.contrib.cache import NullCache, SimpleCache
+
 from zine.application import get_application
-from zine.database import redirects, db
+from zine.cache import get_tag_generations, invalidate_tags
+from zine.counters import apply_deltas
+from zine.database import redirects, counters, db, session_extensions
 from zine.utils.http import make_external_url
 
 
+#: the number of seconds a process uses its redirect map before it checks
+#: if the map changed in another process
+CHECK_INTERVAL = 5
+
+
+class RedirectMap(object):
+    """The redirects of an application.  Maps the stripped original URLs
+    to the stripped new URLs.
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self._redirects = None
+        self._generation = None
+        self._checked = 0
+        self._lock = Lock()
+
+    def _get_generation(self):
+        # the tag generations of caches that exist once per process
+        # don't change when another process changes the redirects.
+        if isinstance(self.app.cache, (NullCache, SimpleCache)):
+            return db.execute(db.select([counters.c.value],
+                (counters.c.scope == 'redirects') &
+                (counters.c.name == 'version'))).scalar()
+        return get_tag_generations(self.app.cache, ['redirects'])['redirects']
+
+    def get(self):
+        """Return the current redirects as dict, load them if necessary."""
+        now = time()
+        if self._redirects is not None and \
+           self._checked + CHECK_INTERVAL > now:
+            return self._redirects
+        self._lock.acquire()
+        try:
+            if self._redirects is None or \
+               self._checked + CHECK_INTERVAL <= now:
+                generation = self._get_generation()
+                if self._redirects is None or generation != self._generation:
+                    self._redirects = dict(db.execute(db.select([
+                        redirects.c.original, redirects.c.new])).fetchall())
+                    self._generation = generation
+                self._checked = now
+            return self._redirects
+        finally:
+            self._lock.release()
+
+    def reset(self):
+        """Forget the redirects so that they are loaded again on the next
+        lookup.
+        """
+        self._redirects = None
+
+
+def _get_map():
+    """Return the redirect map of the current application."""
+    app = get_application()
+    rv = getattr(app, '_redirect_map', None)
+    if rv is None:
+        rv = app._redirect_map = RedirectMap(app)
+    return rv
+
+
+def _mark_changed():
+    """Note that the redirects changed in the current transaction."""
+    session = db.session()
+    session._redirects_changed = True
+    apply_deltas(session, {('redirects', 'version'): 1})
+
+
+class RedirectInvalidationExtension(SessionExtension):
+    """Invalidates the redirect maps when the changes to the redirects
+    are committed.
+    """
+
+    def after_commit(self, session):
+        if getattr(session, '_redirects_changed', False):
+            session._redirects_changed = False
+            invalidate_tags('redirects')
+            _get_map().reset()
+
+    def after_rollback(self, session):
+        session._redirects_changed = False
+
+
 def _strip_url(url):
     """Strip an URL so that only the path is left."""
     cfg = get_application().cfg
@@ -25,11 +126,9 @@ def lookup_redirect(url):
     """Looks up a redirect.  If there is not redirect for the given URL,
     the return value is `None`.
     """
-    row = db.execute(redirects.select(
-        redirects.c.original == _strip_url(url)
-    )).fetchone()
-    if row:
-        return make_external_url(row.new)
+    new_url = _get_map().get().get(_strip_url(url))
+    if new_url is not None:
+        return make_external_url(new_url)
 
 
 def register_redirect(original, new_url):
@@ -40,6 +139,7 @@ def register_redirect(original, new_url):
         original=original,
         new=_strip_url(new_url)
     ))
+    _mark_changed()
 
 
 def unregister_redirect(url):
@@ -47,12 +147,13 @@ def unregister_redirect(url):
     rv = db.execute(redirects.delete(redirects.c.original == _strip_url(url)))
     if not rv.rowcount:
         raise ValueError('no such URL')
+    _mark_changed()
 
 
 def get_redirect_map():
     """Return a dict of all redirects."""
-    return dict((row.original, make_external_url(row.new)) for row in
-                db.execute(redirects.select()))
+    return dict((original, make_external_url(new_url)) for original, new_url
+                in _get_map().get().iteritems())
 
 
 def change_url_prefix(old, new):
@@ -80,3 +181,6 @@ def change_url_prefix(old, new):
         new_slug = new + post.slug[cut_off:]
         register_redirect(post.slug, new_slug)
         post.slug = new_slug
+
+
+session_extensions.append(RedirectInvalidationExtension())
@@ -92,6 +92,22 @@ def increment_string(string):
     return string[:match.start()] + unicode(int(match.group(1)) + 1)
 
 
+def get_free_string(string, taken):
+    """Return the string or, if it's in `taken`, the first string that
+    isn't by incrementing it like :func:`increment_string`:
+
+    >>> get_free_string(u'test', set([u'test', u'test2', u'test4']))
+    u'test3'
+    >>> get_free_string(u'test9', set([u'test9']))
+    u'test10'
+    >>> get_free_string(u'test', set())
+    u'test'
+    """
+    while string in taken:
+        string = increment_string(string)
+    return string
+
+
 def transliterate(string, table='long'):
     """Transliterate to 8 bit using one of the tables given.  The table
     must either be ``'long'``, ``'short'`` or ``'single'``.
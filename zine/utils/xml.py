@@ -77,6 +77,16 @@ def to_text(element):
     return u''.join(result)
 
 
+def clear_element(element):
+    """Clear an element parsed with `iterparse` and remove the elements
+    before it from the parent, so that the parsed tree doesn't grow while
+    a big file is parsed.
+    """
+    element.clear()
+    while element.getprevious() is not None:
+        del element.getparent()[0]
+
+
 def strip_tags(s, normalize_whitespace=True):
     """Remove HTML tags in a text.  This also resolves entities."""
     s = _striptags_re.sub('', s)
@@ -24,6 +24,7 @@ all_views = {
     'blog/tags':                blog.tags,
     'blog/show_author':         blog.show_author,
     'blog/authors':             blog.authors,
+    'blog/search':              blog.search,
     'blog/service_rsd':         blog.service_rsd,
     'blog/json_service':        blog.json_service,
     'blog/xml_service':         blog.xml_service,
@@ -83,6 +84,7 @@ all_views = {
     'admin/plugins':            admin.plugins,
     'admin/remove_plugin':      admin.remove_plugin,
     'admin/cache':              admin.cache,
+    'admin/query_profile':      admin.query_profile,
     'admin/configuration':      admin.configuration,
     'admin/maintenance':        admin.maintenance,
     'admin/import':             admin.import_dump,
@@ -12,7 +12,7 @@
 """
 from urlparse import urlparse
 
-from werkzeug import escape
+from werkzeug import escape, wrap_file
 from werkzeug.exceptions import NotFound, BadRequest, Forbidden
 
 from zine.privileges import assert_privilege, \
@@ -21,9 +21,16 @@ from zine.privileges import assert_privilege, \
      MODERATE_OWN_ENTRIES, MODERATE_OWN_PAGES, MANAGE_CATEGORIES, BLOG_ADMIN
 from zine.i18n import _, ngettext
 from zine.application import get_request, url_for, emit_event, \
-     render_response
-from zine.models import User, Group, Post, Category, Comment
+     render_response, Response
+from zine.models import User, Group, Post, Category, Comment, \
+     COMMENT_MODERATED, COMMENT_UNMODERATED, COMMENT_BLOCKED_USER, \
+     COMMENT_BLOCKED_SPAM
+from zine.counters import get_count, get_counts
+from zine.moderation import moderate, get_moderation_status, MODERATED, \
+     STARTED
 from zine.database import db, secure_database_uri
+from zine.cache import get_stats as get_cache_stats
+from zine.utils.debug import get_query_profile, reset_query_profile
 from zine.utils.admin import flash, load_zine_reddit, require_admin_privilege
 from zine.utils.pagination import AdminPagination
 from zine.utils.http import redirect_to, redirect
@@ -37,9 +44,9 @@ from zine.forms import ChangePasswordForm, PluginForm, \
      PostDeleteForm, EditCommentForm, DeleteCommentForm, \
      ApproveCommentForm, BlockCommentForm, EditCategoryForm, \
      DeleteCategoryForm, EditUserForm, DeleteUserForm, \
-     CommentMassModerateForm, CacheOptionsForm, EditGroupForm, \
-     DeleteGroupForm, ThemeOptionsForm, DeleteImportForm, ExportForm, \
-     MaintenanceModeForm, MarkCommentForm, RemovePluginForm, \
+     CommentMassModerateForm, CacheOptionsForm, QueryProfileForm, \
+     EditGroupForm, DeleteGroupForm, ThemeOptionsForm, DeleteImportForm, \
+     ExportForm, MaintenanceModeForm, MarkCommentForm, RemovePluginForm, \
      make_config_form, make_import_form
 
 #: how many posts / comments should be displayed per page?
@@ -102,24 +109,35 @@ def render_admin_response(template_name, _active_menu_item=None, **values):
         blocked = Comment.query.blocked()
         spam = Comment.query.spam()
 
-        if request.user.has_privilege(MODERATE_OWN_ENTRIES |
-                                      MODERATE_OWN_PAGES):
+        # moderators of their own posts only count the comments on them
+        suffix = ''
+        if not request.user.has_privilege(MODERATE_COMMENTS):
+            suffix = '/author/%d' % request.user.id
             unmoderated = unmoderated.for_user(request.user)
             approved = approved.for_user(request.user)
             blocked = blocked.for_user(request.user)
             spam = spam.for_user(request.user)
 
+        counts = get_counts('comments', {
+            'status/%d%s' % (COMMENT_UNMODERATED, suffix):  unmoderated,
+            'status/%d%s' % (COMMENT_MODERATED, suffix):    approved,
+            'status/%d%s' % (COMMENT_BLOCKED_USER, suffix): blocked,
+            'status/%d%s' % (COMMENT_BLOCKED_SPAM, suffix): spam
+        })
+        def count(status):
+            return counts['status/%d%s' % (status, suffix)]
+
         navigation_bar.append(
             ('comments', url_for('admin/manage_comments'), _(u'Comments'), [
                 ('overview', url_for('admin/manage_comments'), _(u'Overview')),
                 ('unmoderated', url_for('admin/show_unmoderated_comments'),
-                 _(u'Awaiting Moderation (%d)') % unmoderated.count()),
+                 _(u'Awaiting Moderation (%d)') % count(COMMENT_UNMODERATED)),
                 ('approved', url_for('admin/show_approved_comments'),
-                 _(u'Approved (%d)') % approved.count()),
+                 _(u'Approved (%d)') % count(COMMENT_MODERATED)),
                 ('blocked', url_for('admin/show_blocked_comments'),
-                 _(u'Blocked (%d)') % blocked.count()),
+                 _(u'Blocked (%d)') % count(COMMENT_BLOCKED_USER)),
                 ('spam', url_for('admin/show_spam_comments'),
-                 _(u'Spam (%d)') % spam.count())
+                 _(u'Spam (%d)') % count(COMMENT_BLOCKED_SPAM))
             ])
         )
 
@@ -147,6 +165,8 @@ def render_admin_response(template_name, _active_menu_item=None, **values):
         system_items[0:0] = [
             ('information', url_for('admin/information'),
              _(u'Information')),
+            ('query_profile', url_for('admin/query_profile'),
+             _(u'Query Profile')),
             ('maintenance', url_for('admin/maintenance'),
              _(u'Maintenance')),
             ('plugins', url_for('admin/plugins'), _(u'Plugins')),
@@ -284,7 +304,9 @@ def index(request):
     return render_admin_response('admin/index.html', 'dashboard',
         drafts=Post.query.drafts().all(), unmoderated_comments=
             Comment.query.post_lightweight().unmoderated().for_user(request.user).all(),
-        your_posts=Post.query.filter(Post.author_id==request.user.id).count(),
+        your_posts=get_count('posts', 'author/%d' % request.user.id,
+                             Post.query.filter(Post.author_id ==
+                                               request.user.id)),
         last_posts=Post.query.published(ignore_privileges=True)
             .order_by(Post.pub_date.desc()).limit(5).all(),
         show_reddit = request.app.cfg['dashboard_reddit']
@@ -497,6 +519,21 @@ def delete_page(request, post):
                                  form=form.as_widget())
 
 
+def _flash_moderation(result, message=None):
+    """Flash the result of :func:`zine.moderation.moderate`.  `message` is
+    flashed if the comments were moderated right away.
+    """
+    if result == MODERATED:
+        if message is not None:
+            flash(message)
+    elif result == STARTED:
+        flash(_(u'The comments are moderated in the background.  Reload '
+                u'this page to check the progress.'))
+    else:
+        flash(_(u'Other comments are moderated in the background right '
+                u'now, please try again later.'), 'error')
+
+
 def _handle_comments(identifier, title, query, page, per_page, post_id=None,
                      endpoint='admin/manage_comments'):
     request = get_request()
@@ -533,7 +570,7 @@ def _handle_comments(identifier, title, query, page, per_page, post_id=None,
         if 'cancel' not in request.form and form.validate(request.form):
             if 'delete' in request.form:
                 if 'confirm' in request.form:
-                    form.delete_selection()
+                    _flash_moderation(form.delete_selection())
                     db.commit()
                     return redirect_to(endpoint, page=page, per_page=per_page)
                 return render_admin_response('admin/delete_comments.html', tab,
@@ -544,18 +581,16 @@ def _handle_comments(identifier, title, query, page, per_page, post_id=None,
                     flash(_(u'“Delete All” can only be issued for “Spam” and '
                             u'“Blocked” comment types.'), 'error')
                 elif 'confirm' in request.form:
-                    comments = query.all()
-                    # Don't use .count() means a 2nd query and it's
-                    # aprox. 0.111 secs slower; rough average calculation :)
-                    count = len(comments)
-                    for comment in comments:
-                        # Although we're deleting spam or blocked comments,
-                        # they're still comments, so emit the right event
-                        emit_event('before-comment-deleted', comment)
-                        db.delete(comment)
-                    db.commit()
+                    # the comments are deleted in chunks that are
+                    # committed on their own so that huge amounts of spam
+                    # don't end up in one transaction, big sets are
+                    # deleted in the background.
+                    comment_ids = [x for x, in query.values(Comment.id)]
                     # XXX: untranslatable
-                    flash(_(u'Deleted %d %s comments.') % (count, identifier))
+                    _flash_moderation(moderate(comment_ids, 'delete',
+                        request.app.cfg['comment_moderation_events'],
+                        commit=True), _(u'Deleted %d %s comments.') %
+                        (len(comment_ids), identifier))
                     return redirect_to(endpoint, page=page, per_page=per_page)
                 return render_admin_response('admin/delete_comments_all.html',
                                              tab, form=form.as_widget(),
@@ -564,17 +599,17 @@ def _handle_comments(identifier, title, query, page, per_page, post_id=None,
 
             # or approve them all
             elif 'approve' in request.form:
-                form.approve_selection()
+                _flash_moderation(form.approve_selection(),
+                                  _(u'Approved all the selected comments.'))
                 db.commit()
-                flash(_(u'Approved all the selected comments.'))
                 return redirect_to(endpoint, page=page, per_page=per_page)
 
             # or block them all
             elif 'block' in request.form:
                 if 'confirm' in request.form:
-                    form.block_selection()
+                    _flash_moderation(form.block_selection(),
+                                      _(u'Blocked all the selected comments.'))
                     db.commit()
-                    flash(_(u'Blocked all the selected comments.'))
                     return redirect_to(endpoint, page=page, per_page=per_page)
                 return render_admin_response('admin/block_comments.html', tab,
                                              form=form.as_widget())
@@ -582,25 +617,26 @@ def _handle_comments(identifier, title, query, page, per_page, post_id=None,
             # or mark them all as spam
             elif 'spam' in request.form:
                 if 'confirm' in request.form:
-                    form.mark_selection_as_spam()
+                    _flash_moderation(form.mark_selection_as_spam(),
+                        _(u'Reported all the selected comments as SPAM.'))
                     db.commit()
-                    flash(_(u'Reported all the selected comments as SPAM.'))
                     return redirect_to(endpoint, page=page, per_page=per_page)
                 return render_admin_response('admin/mark_spam_comments.html',
                                              tab, form=form.as_widget())
             # or mark them all as ham
             elif 'ham' in request.form:
                 if 'confirm' in request.form:
-                    form.mark_selection_as_ham()
+                    _flash_moderation(form.mark_selection_as_ham(),
+                        _(u'Reported all the selected comments as NOT SPAM.'))
                     db.commit()
-                    flash(_(u'Reported all the selected comments as NOT SPAM.'))
                     return redirect_to(endpoint, page=page, per_page=per_page)
                 return render_admin_response('admin/mark_ham_comments.html',
                                              tab, form=form.as_widget())
     return render_admin_response(
         'admin/manage_comments.html', tab, comments_title=title,
         form=form.as_widget(), pagination=pagination,
-        akismet_active = request.app.plugins['akismet_spam_filter'].active)
+        akismet_active = request.app.plugins['akismet_spam_filter'].active,
+        moderation=get_moderation_status(request.app))
 
 
 @require_admin_privilege(MODERATE_COMMENTS | MODERATE_OWN_ENTRIES |
@@ -850,6 +886,9 @@ def edit_category(request, category_id=None):
                 msg = _(u'Category “%s” updated successfully.')
                 msg_type = 'info'
             db.commit()
+            #! this event is emitted after a category was created or
+            #! changed and the changes were committed to the database.
+            emit_event('after-category-saved', category)
             flash(msg % escape(category.name), msg_type)
             return redirect_to('admin/manage_categories')
 
@@ -1170,7 +1209,33 @@ def cache(request):
             return redirect_to('admin/cache')
 
     return render_admin_response('admin/cache.html', 'options.cache',
-                                 form=form.as_widget())
+                                 form=form.as_widget(),
+                                 tier_stats=getattr(request.app.cache,
+                                                    'stats', None),
+                                 cache_stats=sorted(get_cache_stats()
+                                                    .iteritems()))
+
+
+@require_admin_privilege(BLOG_ADMIN)
+def query_profile(request):
+    """Show the query profile and configure the query profiler."""
+    form = QueryProfileForm()
+
+    if request.method == 'POST':
+        if 'reset_profile' in request.form:
+            reset_query_profile()
+            flash(_(u'The query profile was reset.'), 'configure')
+            return redirect_to('admin/query_profile')
+        elif form.validate(request.form):
+            form.apply()
+            flash(_(u'Query profiler settings were changed successfully.'),
+                  'configure')
+            return redirect_to('admin/query_profile')
+
+    return render_admin_response('admin/query_profile.html',
+                                 'system.query_profile',
+                                 form=form.as_widget(),
+                                 profile=get_query_profile())
 
 
 @require_admin_privilege(BLOG_ADMIN)
@@ -1232,12 +1297,19 @@ def import_dump(request):
 
 
 @require_admin_privilege(BLOG_ADMIN)
-def inspect_import(request, id):
-    """Inspect a database dump."""
-    blog = load_import_dump(request.app, id)
-    if blog is None:
+def inspect_import(request, id, page):
+    """Inspect a database dump.  The posts of the dump are shown page by
+    page, the selection of the posts is stored with the dump.
+    """
+    dump = load_import_dump(request.app, id)
+    if dump is None:
         raise NotFound()
-    form = make_import_form(blog)
+    posts = dump.get_posts(PER_PAGE * (page - 1), PER_PAGE)
+    if not posts and page != 1:
+        raise NotFound()
+    pagination = AdminPagination('admin/inspect_import', page, PER_PAGE,
+                                 len(dump), url_args={'id': id})
+    form = make_import_form(dump, posts)
 
     # perform the actual import here
     if request.method == 'POST':
@@ -1246,6 +1318,21 @@ def inspect_import(request, id):
         elif 'delete' in request.form:
             return redirect_to('admin/delete_import', id=id)
         elif form.validate(request.form):
+            if 'save' in request.form:
+                form.save_selection()
+                flash(_(u'The selection was saved.'))
+                return redirect_to('admin/inspect_import', id=id, page=page)
+            # the pagination submits the form so that the selection of
+            # the current page is saved before going to another page
+            elif 'goto_page' in request.form:
+                form.save_selection()
+                try:
+                    target = int(request.form['goto_page'])
+                except ValueError:
+                    target = page
+                target = max(1, min(target, pagination.pages))
+                return redirect_to('admin/inspect_import', id=id,
+                                   page=target)
             return render_admin_response('admin/perform_import.html',
                                          'system.import',
                 live_log=form.perform_import(),
@@ -1253,7 +1340,8 @@ def inspect_import(request, id):
             )
 
     return render_admin_response('admin/inspect_import.html',
-                                 'system.import', blog=blog,
+                                 'system.import', blog=dump, posts=posts,
+                                 pagination=pagination,
                                  form=form.as_widget(), dump_id=id)
 
 
@@ -1284,18 +1372,36 @@ def delete_import(request, id):
 
 @require_admin_privilege(BLOG_ADMIN)
 def export(request):
-    """Export the blog to the ZXA format."""
+    """Export the blog to the ZXA format.  The export runs in the
+    background, once it's finished the file can be downloaded.
+    """
+    from zine.zxa import start_export, get_export_status, \
+         get_export_filename
     form = ExportForm()
+    status = get_export_status(request.app)
+
+    if request.args.get('do') == 'download' and status['finished']:
+        f = file(get_export_filename(request.app), 'rb')
+        response = Response(wrap_file(request.environ, f),
+                            mimetype='application/x-gzip',
+                            direct_passthrough=True)
+        response.headers['Content-Length'] = str(status['size'])
+        response.headers['Content-Disposition'] = 'attachment; ' \
+            'filename="%s.zxa.gz"' % '_'.join(request.app.cfg['blog_title']
+                                              .split())
+        return response
 
     if request.method == 'POST' and form.validate(request.form):
         if request.form.get('format') == 'zxa':
-            from zine.zxa import export
-            response = export(request.app)
-            response.headers['Content-Disposition'] = 'attachment; ' \
-                'filename="%s.zxa"' % '_'.join(request.app.cfg['blog_title'].split())
-            return response
+            if start_export(request.app):
+                flash(_(u'The export was started.  Reload this page to '
+                        u'check if it\'s finished.'))
+            else:
+                flash(_(u'The export is already running.'), 'error')
+            return redirect_to('admin/export')
     return render_admin_response('admin/export.html', 'system.export',
-        form=form.as_widget()
+        form=form.as_widget(),
+        status=status
     )
 
 
@@ -1381,6 +1487,7 @@ def information(request):
                           if name not in DEFAULT_FILTERS],
         instance_path=request.app.instance_folder,
         database_uri=database_uri,
+        pool_stats=db.get_pool_stats(),
         platform=platform(),
         export=export
     )
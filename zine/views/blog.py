@@ -15,18 +15,87 @@ from zine import cache, pingback
 from zine.i18n import _
 from zine.application import add_link, url_for, render_response, \
      iter_listeners, Response
-from zine.models import Post, Category, User, Tag
+from zine.models import Post, Category, User, Tag, Comment
+from zine.database import db
 from zine.utils import dump_json, log
 from zine.utils.text import build_tag_uri
 from zine.utils.xml import generate_rsd, dump_xml
 from zine.utils.http import redirect_to, redirect
+from zine.utils.pagination import Pagination
 from zine.utils.redirects import lookup_redirect
 from zine.forms import NewCommentForm
 from zine.feeds import Rss201rev2Feed as RssFeed, Atom1Feed
 from werkzeug.exceptions import NotFound, Forbidden
 
 
-@cache.response(vary=('user',))
+def _get_timeout():
+    """The pages are cached for ``long_cache_timeout`` seconds, but only
+    until the next scheduled post is published.
+    """
+    return cache.get_scheduled_timeout('long_cache_timeout')
+
+
+def _validate_posts(query):
+    """Return the validator for a page that shows the posts of a query.
+    Because the query is filtered with `published` for the current user
+    private posts never change the validator for others.
+
+    There is no modification time that covers deleted posts and scheduled
+    posts that became visible, so the pages are only validated with the
+    ETag and don't send a Last-Modified header.
+    """
+    validator = query.get_validator()
+    if validator[2]:
+        return validator, None
+
+
+def _validate_index(req, page=1):
+    return _validate_posts(Post.query.published().for_index())
+
+
+def _validate_archive(req, year=None, month=None, day=None, page=1):
+    query = Post.query.published().for_index()
+    if year:
+        query = query.date_filter(year, month, day)
+    return _validate_posts(query)
+
+
+def _validate_feed(req, post=None, **kwargs):
+    # comment feeds are validated by `dispatch_content_type`
+    if post is None:
+        return _validate_posts(Post.query.published())
+
+
+def _validate_content(req):
+    slug = req.path[1:]
+    if slug.endswith('/feed.atom'):
+        slug = slug[:-10]
+    slugs = [slug, slug.rstrip('/') + '/']
+    rv = _validate_posts(Post.query.published()
+                             .filter(Post.slug.in_(slugs)))
+    if rv is not None:
+        # only count the comments the user can see, moderators see
+        # unapproved comments too
+        comments = Comment.query.latest(ignore_blocked=False) \
+            .filter(Comment.post_id.in_(db.select([Post.id],
+                                                  Post.slug.in_(slugs))))
+        comments = iter(comments.order_by(None).values(
+            db.func.count(Comment.id), db.func.max(Comment.pub_date))).next()
+        return rv[0] + comments, rv[1]
+
+
+def _count_published(req, query, name):
+    """Return the number of published posts of a query from the counters.
+    Logged in users may see more than the published posts, the posts are
+    counted for them (this returns `None` then).
+    """
+    if not req.user.is_somebody:
+        return query.count_published(name)
+
+
+@cache.conditional(_validate_index)
+@cache.response(vary=('user',), timeout=_get_timeout,
+                dogpile=True, args=('cursor',), tags=('index',))
 def index(req, page=1):
     """Render the most recent posts.
 
@@ -41,15 +110,25 @@ def index(req, page=1):
     :Template name: ``index.html``
     :URL endpoint: ``blog/index``
     """
+    total = None
+    if not req.user.is_somebody:
+        total = sum(Post.query.type(content_type)
+                              .count_published('published/' + content_type)
+                    for content_type in req.app.cfg['index_content_types'])
     data = Post.query.theme_lightweight('index').published() \
                .for_index().get_list(endpoint='blog/index',
-                                     page=page)
+                                     page=page, total=total,
+                                     cursor=req.args.get('cursor'))
+    cache.tag_posts(data['posts'])
 
     add_link('alternate', url_for('blog/atom_feed'), 'application/atom+xml',
              _(u'Recent Posts Feed'))
     return render_response('index.html', **data)
 
 
+@cache.conditional(_validate_archive)
+@cache.response(vary=('user',), timeout=_get_timeout,
+                dogpile=True, args=('cursor',), tags=('index',))
 def archive(req, year=None, month=None, day=None, page=1):
     """Render the monthly archives.
 
@@ -69,7 +148,7 @@ def archive(req, year=None, month=None, day=None, page=1):
     """
     if not year:
         return render_response('archive.html', month_list=True,
-                               **Post.query.published().for_index()
+                               **Post.query.for_index()
                                      .get_archive_summary())
 
     url_args = dict(year=year, month=month, day=day)
@@ -77,7 +156,9 @@ def archive(req, year=None, month=None, day=None, page=1):
     data = Post.query.theme_lightweight('archive_overview') \
                .published().for_index().date_filter(year, month, day) \
                .get_list(page=page, endpoint='blog/archive',
-                         url_args=url_args, per_page=per_page)
+                         url_args=url_args, per_page=per_page,
+                         cursor=req.args.get('cursor'))
+    cache.tag_posts(data['posts'])
 
     add_link('alternate', url_for('blog/atom_feed', **url_args),
              'application/atom+xml', _(u'Recent Posts Feed'))
@@ -109,7 +190,12 @@ def show_category(req, slug, page=1):
     data = category.posts.theme_lightweight('category') \
                    .published().get_list(page=page, per_page=per_page,
                                          endpoint='blog/show_category',
-                                         url_args=dict(slug=slug))
+                                         url_args=dict(slug=slug),
+                                         cursor=req.args.get('cursor'),
+                                         total=_count_published(req,
+                                            category.posts,
+                                            'published/category/%d' %
+                                            category.id))
 
     add_link('alternate', url_for('blog/atom_feed', category=slug),
              'application/atom+xml', _(u'All posts in category %s') % category.name)
@@ -138,7 +224,11 @@ def show_tag(req, slug, page=1):
     data = tag.posts.theme_lightweight('tag') \
                     .published().get_list(page=page, endpoint='blog/show_tag',
                                           per_page=per_page,
-                                          url_args=dict(slug=slug))
+                                          url_args=dict(slug=slug),
+                                          cursor=req.args.get('cursor'),
+                                          total=_count_published(req,
+                                            tag.posts, 'published/tag/%d' %
+                                            tag.id))
 
     add_link('alternate', url_for('blog/atom_feed', tag=slug),
              'application/atom+xml', _(u'All posts tagged %s') % tag.name)
@@ -188,7 +278,10 @@ def show_author(req, username, page=1):
     data = user.posts.theme_lightweight('author').published() \
                      .get_list(page=page, per_page=per_page,
                                endpoint='blog/show_author',
-                               url_args=dict(username=user.username))
+                               url_args=dict(username=user.username),
+                               cursor=req.args.get('cursor'),
+                               total=_count_published(req, user.posts,
+                                    'published/author/%d' % user.id))
 
     add_link('alternate', url_for('blog/atom_feed', author=user.username),
              'application/atom+xml', _(u'All posts written by %s') %
@@ -211,7 +304,54 @@ def authors(req):
     return render_response('authors.html', authors=User.query.authors().all())
 
 
-@cache.response(vary=('user',))
+def search(req):
+    """Search the posts.  The search words are in the ``q`` URL parameter,
+    the best matches are shown first.
+
+    Available template variables:
+
+        `query`:
+            the search words as entered by the user
+
+        `posts`:
+            a list of post objects that match the query
+
+        `pagination`:
+            a pagination object to render a pagination
+
+    :Template name: ``search.html``
+    :URL endpoint: ``blog/search``
+    """
+    query = req.args.get('q', u'').strip()
+    page = max(req.args.get('page', 1, type=int), 1)
+    per_page = req.app.theme.settings['search.per_page'] or \
+               req.app.cfg['posts_per_page']
+    postlist = []
+    total = 0
+    if query:
+        posts = Post.query.theme_lightweight('search').published() \
+                    .search(query)
+        postlist = posts.offset(per_page * (page - 1)).limit(per_page).all()
+        if page != 1 and not postlist:
+            raise NotFound()
+        total = posts.count()
+    pagination = Pagination('blog/search', page, per_page, total,
+                            dict(q=query))
+    return render_response('search.html', query=query, posts=postlist,
+                           pagination=pagination)
+
+
+def _get_comment_thread(req, post):
+    """Return the comment thread of a post for the comment page of the
+    request.
+    """
+    return post.get_comment_thread(req.args.get('comments_page', 1, type=int),
+                                   req.app.cfg['comments_per_page'])
+
+
+@cache.response(vary=('user',), timeout=_get_timeout,
+                dogpile=True, args=('comments_page',),
+                tags=lambda req, post, form: post.cache_tags)
 @pingback.inject_header
 def show_entry(req, post, comment_form):
     """Show as post and give users the possibility to comment to this
@@ -257,6 +397,7 @@ def show_entry(req, post, comment_form):
 
     return render_response('show_entry.html',
         entry=post,
+        comment_thread=_get_comment_thread(req, post),
         form=comment_form.as_widget()
     )
 
@@ -271,6 +412,7 @@ def show_page(req, post, comment_form):
     return render_response(['pages/%s.html' % post.slug.strip('/'),
                             post.extra.get('page_template'), 'page.html'],
         page=post,
+        comment_thread=_get_comment_thread(req, post),
         form=comment_form.as_widget(),
         show_title=cfg['show_page_title']
     )
@@ -333,7 +475,9 @@ def xml_service(req, identifier):
     return Response(dump_xml(result), mimetype='text/xml')
 
 
-@cache.response(vary=('user',))
+@cache.conditional(_validate_feed)
+@cache.response(vary=('user',), timeout=_get_timeout, dogpile=True,
+                tags=('feeds',))
 def atom_feed(req, author=None, year=None, month=None, day=None,
               category=None, tag=None, post=None):
     feed = Atom1Feed(req.app.cfg['blog_title'], req.app.cfg['blog_url'],
@@ -346,7 +490,9 @@ def atom_feed(req, author=None, year=None, month=None, day=None,
     return Response(results, mimetype="application/atom+xml")
 
 
-@cache.response(vary=('user',))
+@cache.conditional(_validate_feed)
+@cache.response(vary=('user',), timeout=_get_timeout, dogpile=True,
+                tags=('feeds',))
 def rss_feed(req, author=None, year=None, month=None, day=None,
               category=None, tag=None, post=None):
     feed = RssFeed(req.app.cfg['blog_title'], req.app.cfg['blog_url'],
@@ -402,6 +548,7 @@ def populate_feed(req, feed, author=None, year=None, month=None, day=None,
     # otherwise we create a feed for all the comments of a post.
     # the function is called this way by `dispatch_content_type`.
     else:
+        cache.tag(*post.cache_tags)
         comment_num = 1
         for comment in post.comments:
             if not comment.visible:
@@ -423,7 +570,9 @@ def populate_feed(req, feed, author=None, year=None, month=None, day=None,
     return feed.writeString('utf-8')
 
 
-@cache.response(vary=('user',))
+@cache.conditional(_validate_content)
+@cache.response(vary=('user',), timeout=_get_timeout,
+                dogpile=True, args=('comments_page',))
 def dispatch_content_type(req):
     """Show the post for a specific content type."""
     slug = req.path[1:]
@@ -435,14 +584,18 @@ def dispatch_content_type(req):
     else:
         want_feed = False
 
-    post = Post.query.filter_by(slug=slug).first()
+    # the comments are loaded with the comment thread (or the comments
+    # feed) so that the post isn't joined with all of them here.
+    post = Post.query.options(db.lazyload('comments')) \
+        .filter_by(slug=slug).first()
 
     if post is None:
         # if the post does not exist, check if a post with a trailing slash
         # exists.  If it does, redirect to that post.  This is allows users
         # to emulate folders and to get relative links working.
         if not slug.endswith('/'):
-            real_post = Post.query.filter_by(slug=slug + '/').first()
+            real_post = Post.query.options(db.lazyload('comments')) \
+                .filter_by(slug=slug + '/').first()
             if real_post is None:
                 raise NotFound()
             # if we want the feed, we don't want a redirect
@@ -456,6 +609,7 @@ def dispatch_content_type(req):
     # make sure the current user can access that page.
     if not post.can_read():
         raise Forbidden()
+    cache.tag(*post.cache_tags)
 
     # feed requested?  jump to the feed page
     if want_feed:
@@ -16,8 +16,25 @@
     :copyright: (c) 2010 by the Zine Team, see AUTHORS for more details.
     :license: BSD, see LICENSE for more details.
 """
-from zine.application import render_template
+try:
+    from hashlib import md5
+except ImportError:
+    from md5 import new as md5
+
+from zine import cache
+from zine.application import render_template, get_request
 from zine.models import Post, SummarizedPost, Category, Tag, Comment
+from zine.privileges import MODERATE_COMMENTS, MODERATE_OWN_ENTRIES, \
+     MODERATE_OWN_PAGES
+
+
+#: the events that change the posts shown by widgets
+POST_EVENTS = ('after-post-saved', 'before-post-deleted')
+
+#: the events that change the comments shown by widgets
+COMMENT_EVENTS = ('after-comment-saved', 'before-comment-deleted',
+                  'before-comment-approved', 'before-comment-blocked',
+                  'before-comment-mark-spam', 'before-comment-mark-ham')
 
 
 class Widget(object):
@@ -33,9 +50,68 @@ class Widget(object):
     #: in the template as `widget`.
     template = None
 
+    #: the cache key for the rendered widget or `None` if the widget is not
+    #: cached.  Cached widgets store the arguments of the constructor in
+    #: `_cache_args`, they are added to the key.  They must not query the
+    #: data they display in the constructor but in :meth:`load` which is
+    #: only called if the widget is rendered.
+    cache_key = None
+
+    #: the arguments of the constructor that are added to the cache key
+    _cache_args = ()
+
+    #: the events that invalidate the rendered widget in the cache.
+    invalidating_events = ()
+
+    def get_cache_key(self):
+        """Return the cache key for the rendered widget or `None` if it must
+        not be cached, for example because the output depends on the
+        privileges of the current user.
+        """
+        if self.cache_key is not None:
+            return '%s:%s' % (self.cache_key,
+                              md5(repr(self._cache_args)).hexdigest())
+
+    def get_cache_timeout(self):
+        """Return the number of seconds the rendered widget is cached or
+        `None` for the default timeout.  This is called after the widget
+        was rendered.
+        """
+
+    @classmethod
+    def invalidate(cls, *args):
+        """Drop the rendered widget from the cache.  This is connected to
+        the `invalidating_events`.
+        """
+        cache.invalidate_tags('widget/' + cls.name)
+
+    def load(self):
+        """Load the data displayed by the widget."""
+
+    def render(self):
+        """Load the data and render the template."""
+        if not self.__dict__.get('_loaded'):
+            self._loaded = True
+            self.load()
+        return render_template(self.template, widget=self)
+
+    def __getattr__(self, name):
+        # templates may access the data of a widget without rendering it,
+        # so load it on first access.
+        if name.startswith('__') or self.__dict__.get('_loaded'):
+            raise AttributeError(name)
+        self._loaded = True
+        self.load()
+        return getattr(self, name)
+
     def __unicode__(self):
         """Render the template."""
-        return render_template(self.template, widget=self)
+        key = self.get_cache_key()
+        if key is None:
+            return self.render()
+        return cache.get_or_create(key, self.render, ('widget/' + self.name,),
+                                   self.get_cache_timeout,
+                                   stats_key=self.cache_key)
 
     def __str__(self):
         return unicode(self).encode('utf-8')
@@ -46,12 +122,23 @@ class PostArchiveSummary(Widget):
 
     name = 'post_archive_summary'
     template = 'widgets/post_archive_summary.html'
+    cache_key = 'widget/post_archive_summary'
+    invalidating_events = POST_EVENTS
 
     def __init__(self, detail='months', limit=6, show_title=False):
-        self.__dict__.update(SummarizedPost.query
-            .get_archive_summary(detail, limit))
+        self._cache_args = (detail, limit, show_title)
+        self.detail = detail
+        self.limit = limit
         self.show_title = show_title
 
+    def get_cache_timeout(self):
+        return cache.get_scheduled_timeout()
+
+    def load(self):
+        self.__dict__.update(SummarizedPost.query
+            .get_archive_summary(self.detail, self.limit,
+                                 ignore_privileges=True))
+
 
 class LatestPosts(Widget):
     """Show the latest n posts."""
@@ -74,11 +161,28 @@ class LatestComments(Widget):
 
     name = 'latest_comments'
     template = 'widgets/latest_comments.html'
+    cache_key = 'widget/latest_comments'
+    invalidating_events = COMMENT_EVENTS
 
     def __init__(self, limit=5, show_title=False, ignore_blocked=False):
-        self.comments = Comment.query. \
-            latest(ignore_blocked=ignore_blocked).limit(limit).all()
+        self.limit = limit
         self.show_title = show_title
+        self.ignore_blocked = ignore_blocked
+
+    def get_cache_key(self):
+        # moderators see the blocked comments as well, everybody else gets
+        # the same list as if blocked comments are ignored.
+        if not self.ignore_blocked:
+            request = get_request()
+            if request is not None and request.user.has_privilege(
+                    MODERATE_COMMENTS | MODERATE_OWN_ENTRIES |
+                    MODERATE_OWN_PAGES):
+                return None
+        return '%s:%d:%d' % (self.cache_key, self.limit, self.show_title)
+
+    def load(self):
+        self.comments = Comment.query. \
+            latest(ignore_blocked=self.ignore_blocked).limit(self.limit).all()
 
 
 class TagCloud(Widget):
@@ -86,11 +190,20 @@ class TagCloud(Widget):
 
     name = 'tag_cloud'
     template = 'widgets/tag_cloud.html'
+    cache_key = 'widget/tag_cloud'
+    invalidating_events = POST_EVENTS
 
     def __init__(self, max=None, show_title=False):
-        self.tags = Tag.query.get_cloud(max)
+        self._cache_args = (max, show_title)
+        self.max = max
         self.show_title = show_title
 
+    def get_cache_timeout(self):
+        return cache.get_scheduled_timeout()
+
+    def load(self):
+        self.tags = Tag.query.get_cloud(self.max)
+
 
 class CategoryList(Widget):
     """Show a list of all categories."""
@@ -123,12 +236,27 @@ class PagesNavigation(Widget):
 
     name = 'pages_navigation'
     template = 'widgets/pages_navigation.html'
+    cache_key = 'widget/pages_navigation'
+    invalidating_events = POST_EVENTS
 
     def __init__(self, show_title=False, show_drafts=False):
+        self._cache_args = (show_title, show_drafts)
+        self.show_title = show_title
+        self.show_drafts = show_drafts
+
+    def get_cache_key(self):
+        # logged in users may see private and protected pages
+        request = get_request()
+        if request is None or not request.user.is_somebody:
+            return Widget.get_cache_key(self)
+
+    def get_cache_timeout(self):
+        return cache.get_scheduled_timeout()
+
+    def load(self):
         self.pages = Post.query.type('page').published().all()
-        if show_drafts:
+        if self.show_drafts:
             self.pages += Post.query.type('page').drafts().all()
-        self.show_title = show_title
 
 #: list of all core widgets
 all_widgets = [PostArchiveSummary, LatestPosts, LatestComments, TagCloud,
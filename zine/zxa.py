@@ -10,17 +10,30 @@
     somewhat hack around the limitation by using a separate element tree for
     each item and wrap it in hand written XML.
 
+    The export can run in a background thread (see :func:`start_export`),
+    which writes the file gzipped into the instance folder.  The posts,
+    comments and users are loaded in windows, so the memory used does not
+    depend on the size of the blog.
+
     :copyright: (c) 2010 by the Zine Team, see AUTHORS for more details.
     :license: BSD, see LICENSE for more details.
 """
+import os
+import gzip
+import threading
+from time import time
+from tempfile import mkstemp
 from cPickle import dumps
 from datetime import datetime
-from itertools import chain
 
 import zine
 from lxml import etree
+from sqlalchemy.orm.attributes import set_committed_value
 from zine.api import *
-from zine.models import Post, User
+from zine.database import posts, comments, users, post_categories, \
+     post_tags, cleanup_session
+from zine.models import Post, User, Comment, Category, Tag
+from zine.utils import log
 from zine.utils.text import build_tag_uri
 from zine.utils.dates import format_iso8601
 from zine.utils.xml import escape, XML_NS
@@ -78,12 +91,145 @@ XML_EPILOG = '</feed>'
 
 NAMESPACES = {None: ATOM_NS, 'zine': ZINE_NS}
 
+#: the number of posts and users loaded at once
+WINDOW_SIZE = 100
+
+#: the folder in the instance folder with the exported file
+EXPORT_FOLDER = 'export'
+
+#: an export is considered dead if its lock file was not touched for
+#: that many seconds
+LOCK_TIMEOUT = 300
+
 
 def export(app):
     """Dump all the application data into an ZXA response."""
     return Response(Writer(app)._generate(), mimetype='application/atom+xml')
 
 
+def get_export_filename(app):
+    """Return the filename of the gzipped export in the instance folder."""
+    return os.path.join(app.instance_folder, EXPORT_FOLDER, 'blog.zxa.gz')
+
+
+def _get_lock_filename(app):
+    return get_export_filename(app) + '.lock'
+
+
+def _is_locked(lock_filename):
+    """Check if the lock file of an export exists and was touched by the
+    exporting process recently.
+    """
+    try:
+        return time() - os.path.getmtime(lock_filename) < LOCK_TIMEOUT
+    except OSError:
+        return False
+
+
+def get_export_status(app):
+    """Return a dict with the status of the background export.  `running`
+    is `True` if any process of the blog is exporting right now,
+    `finished` is the datetime of the last finished export or `None` and
+    `size` the size of the file in bytes.
+    """
+    filename = get_export_filename(app)
+    rv = {
+        'running':  _is_locked(_get_lock_filename(app)),
+        'finished': None,
+        'size':     0
+    }
+    if os.path.isfile(filename):
+        rv['finished'] = datetime.utcfromtimestamp(os.path.getmtime(filename))
+        rv['size'] = os.path.getsize(filename)
+    return rv
+
+
+def write_export(app, filename, callback=None):
+    """Write the export gzipped into a file.  The file is written under a
+    temporary name first, so an unfinished export never replaces the last
+    one.  If given, `callback` is called after every window of posts.
+    """
+    folder = os.path.dirname(filename)
+    if not os.path.isdir(folder):
+        os.makedirs(folder)
+    fd, tmp_filename = mkstemp(dir=folder, suffix='.part')
+    raw = os.fdopen(fd, 'wb')
+    f = gzip.GzipFile(filename=os.path.basename(filename)[:-3],
+                      fileobj=raw, mode='wb')
+    try:
+        try:
+            Writer(app, callback).write(f)
+        finally:
+            f.close()
+            raw.close()
+    except:
+        os.remove(tmp_filename)
+        raise
+    # windows can't rename over an existing file
+    if os.name == 'nt' and os.path.exists(filename):
+        os.remove(filename)
+    os.rename(tmp_filename, filename)
+
+
+def start_export(app):
+    """Start the export in a background thread.  Returns `False` if an
+    export is running already.  The running export is tracked with a lock
+    file next to the export that is touched while the export runs, so that
+    all processes of the blog see it.
+    """
+    lock_filename = _get_lock_filename(app)
+    folder = os.path.dirname(lock_filename)
+    if not os.path.isdir(folder):
+        os.makedirs(folder)
+    if os.path.exists(lock_filename):
+        if _is_locked(lock_filename):
+            return False
+        # the process that exported died
+        try:
+            os.remove(lock_filename)
+        except OSError:
+            pass
+    try:
+        os.close(os.open(lock_filename, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+    except OSError:
+        return False
+
+    def touch():
+        os.utime(lock_filename, None)
+
+    def run():
+        try:
+            write_export(app, get_export_filename(app), touch)
+        except Exception:
+            log.exception(_(u'Error while exporting the blog'), 'zxa')
+        finally:
+            cleanup_session()
+            os.remove(lock_filename)
+
+    thread = threading.Thread(target=run)
+    thread.setDaemon(True)
+    thread.start()
+    return True
+
+
+def _iter_windows(query, column):
+    """Iterate over the results of a query in lists of `WINDOW_SIZE`
+    objects, ordered by `column` (an unique column).  Every window is
+    loaded with its own query that continues after the last object of the
+    previous window, so no database driver has to keep the whole result.
+    """
+    last = None
+    while 1:
+        window_query = query.order_by(column)
+        if last is not None:
+            window_query = window_query.filter(column > last)
+        window = window_query.limit(WINDOW_SIZE).all()
+        if not window:
+            break
+        yield window
+        last = getattr(window[-1], column.key)
+
+
 class _ElementHelper(object):
 
     def __init__(self, ns):
@@ -128,25 +274,28 @@ class Participant(object):
 
 class Writer(object):
 
-    def __init__(self, app):
+    def __init__(self, app, callback=None):
         self.app = app
+        self.callback = callback
         self.atom = _ElementHelper(ATOM_NS)
         self.z = _ElementHelper(ZINE_NS)
         self._dependencies = {}
+        self._dependency_count = 0
+        #: the ids of the users that are exported mapped to the
+        #: dependency ids of their nodes.
         self.users = {}
         self.participants = [x(self) for x in
                              emit_event('get-zxa-participants') if x]
 
+    def write(self, fd):
+        """Write the export into a file object."""
+        for chunk in self._generate():
+            fd.write(chunk)
+
     def _generate(self):
         now = datetime.utcnow()
-        posts = iter(Post.query.order_by(Post.last_update.desc()))
-        try:
-            first_post = posts.next()
-            last_update = first_post.last_update
-            posts = chain((first_post,), posts)
-        except StopIteration:
-            first_post = None
-            last_update = now
+        last_update = db.execute(db.select([db.func.max(
+            posts.c.last_update)])).scalar() or now
 
         feed_id = build_tag_uri(self.app, last_update, 'zxa_export', 'full')
         yield (XML_PREAMBLE % {
@@ -179,33 +328,91 @@ class Writer(object):
             if rv is not None:
                 yield dump_node(rv)
 
-        # look up all the users and add them as dependencies if they
-        # have written a comment or created a post.
-        for user in User.query.all():
-            if user.posts.count() > 0 or user.comments.count() > 0:
-                self._register_user(user)
+        # the users that have written a comment or created a post are
+        # dependencies.  Only their ids are looked up now, the nodes
+        # are created when the dependencies are dumped.
+        active_users = self._get_active_users()
+        for user_id, in db.execute(db.select([users.c.user_id],
+                                             users.c.user_id.in_(active_users),
+                                             order_by=[users.c.user_id])):
+            self.users[user_id] = self._next_dependency_id()
 
         # dump all the posts
-        for post in posts:
-            yield dump_node(self._dump_post(post))
-
-        # if we have dependencies (very likely) dump them now
-        if self._dependencies:
-            yield '<zine:dependencies>'
-            for node in self._dependencies.itervalues():
-                yield dump_node(node)
-            yield '</zine:dependencies>'
+        for window in self._iter_post_windows():
+            for post in window:
+                yield dump_node(self._dump_post(post))
+            if self.callback is not None:
+                self.callback()
+
+        yield '<zine:dependencies>'
+        for window in _iter_windows(User.query.filter(
+                                    User.id.in_(active_users)), User.id):
+            for user in window:
+                yield dump_node(self._dump_user(user))
+            if self.callback is not None:
+                self.callback()
+        for node in self._dependencies.itervalues():
+            yield dump_node(node)
+        yield '</zine:dependencies>'
 
         yield XML_EPILOG.encode('utf-8')
 
+    def _get_active_users(self):
+        """Return a select for the ids of the users that created a post or
+        wrote a comment.
+        """
+        return db.union(db.select([posts.c.author_id],
+                                  posts.c.author_id != None),
+                        db.select([comments.c.user_id],
+                                  comments.c.user_id != None))
+
+    def _iter_post_windows(self):
+        """Iterate over the posts in lists of `WINDOW_SIZE` posts.  The
+        comments, categories and tags of the posts in a window are loaded
+        with one query each.
+        """
+        query = Post.query.options(db.lazyload('comments'),
+                                   db.lazyload('categories'),
+                                   db.lazyload('tags'),
+                                   db.eagerload('author'))
+        for window in _iter_windows(query, Post.id):
+            self._load_window(window)
+            yield window
+
+    def _load_window(self, window):
+        post_ids = [post.id for post in window]
+        found = dict((post_id, ([], [], [])) for post_id in post_ids)
+        for comment in Comment.query.filter(Comment.post_id.in_(post_ids)) \
+                                    .order_by(Comment.pub_date):
+            found[comment.post_id][0].append(comment)
+        for index, model, table, column in (
+                (1, Category, post_categories, 'category_id'),
+                (2, Tag, post_tags, 'tag_id')):
+            query = db.session.query(table.c.post_id, model) \
+                .filter(table.c[column] == model.id) \
+                .filter(table.c.post_id.in_(post_ids)) \
+                .order_by(model.name)
+            for post_id, obj in query:
+                found[post_id][index].append(obj)
+        for post in window:
+            comments_of_post, categories_of_post, tags_of_post = found[post.id]
+            set_committed_value(post, 'comments', comments_of_post)
+            set_committed_value(post, 'categories', categories_of_post)
+            set_committed_value(post, 'tags', tags_of_post)
+
+    def _next_dependency_id(self):
+        self._dependency_count += 1
+        return '%x' % self._dependency_count
+
     def new_dependency(self, tag):
-        id = '%x' % (len(self._dependencies) + 1)
+        id = self._next_dependency_id()
         node = etree.Element(tag, {'dependency': id}, nsmap=NAMESPACES)
         self._dependencies[id] = node
         return node
 
-    def _register_user(self, user):
-        rv = self.new_dependency(self.z.user)
+    def _dump_user(self, user):
+        rv = etree.Element(self.z.user, {'dependency': self.users[user.id]},
+                           nsmap=NAMESPACES)
         self.z('username', text=user.username, parent=rv)
         self.z('email', text=user.email, parent=rv)
         self.z('pw_hash', text=user.pw_hash.encode('base64'), parent=rv)
@@ -220,7 +427,7 @@ class Writer(object):
         privileges = self.z('privileges', parent=rv)
         for privilege in user.own_privileges:
             self.z('privilege', text=privilege.name, parent=privileges)
-        self.users[user.id] = rv
+        return rv
 
     def _dump_post(self, post):
         url = url_for(post, _external=True)
@@ -234,8 +441,7 @@ class Writer(object):
         self.atom('link', href=url, parent=entry)
 
         author = self.atom('author', parent=entry)
-        author.attrib[self.z.dependency] = self.users[post.author.id] \
-                                                .attrib['dependency']
+        author.attrib[self.z.dependency] = self.users[post.author.id]
         self.atom('name', text=post.author.display_name, parent=author)
         self.atom('email', text=post.author.email, parent=author)
 
@@ -277,9 +483,8 @@ class Writer(object):
             self.z('name', text=c.author, parent=author)
             self.z('email', text=c.email, parent=author)
             self.z('uri', text=c.www, parent=author)
-            if c.user is not None:
-                author.attrib['dependency'] = self.users[c.user.id] \
-                                                  .attrib['dependency']
+            if c.user_id is not None:
+                author.attrib['dependency'] = self.users[c.user_id]
             self.z('published', text=format_iso8601(c.pub_date),
                    parent=comment)
             self.z('blocked', text=c.blocked and 'yes' or 'no',